@@ -3,141 +3,377 @@ Utilidades de autenticación y seguridad
 Implementa E-06, E-07, E-08
 """
 from datetime import datetime, timedelta
-from typing import Optional
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+from typing import List, NamedTuple, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from cachetools import TTLCache
+import jwt
+from jwt import InvalidTokenError
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import text
 from config import settings
 from database import get_db
 from models import Usuario
 
-# Configuración de hashing de passwords
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+# Hashing de passwords: PBKDF2-SHA256 nativo (OpenSSL vía hashlib) con el
+# formato heredado de passlib, compatible con los hashes ya almacenados:
+# $pbkdf2-sha256$<rondas>$<salt ab64>$<hash ab64>
+PBKDF2_PREFIX = "$pbkdf2-sha256$"
+# Rondas para hashes nuevos (costo de CPU configurable); la verificación usa
+# las rondas guardadas en cada hash, así que cambiarlo no invalida los existentes
+PBKDF2_ROUNDS = settings.PASSWORD_HASH_ROUNDS
+PBKDF2_SALT_BYTES = 16
+
+# Pool para el hashing (CPU) fuera del event loop. Se usan hilos y no procesos:
+# hashlib.pbkdf2_hmac libera el GIL, así que escala con los núcleos sin el
+# costo de serializar argumentos entre procesos.
+_hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="pwd-hash")
+
+# Verificador/firmador JWT único, construido una sola vez al importar.
+# Evita reconstruir opciones y clave en cada request.
+_jwt = jwt.PyJWT(options={"require": ["exp", "sub"]})
+_jwt_key = settings.SECRET_KEY
+_jwt_algorithms = (settings.ALGORITHM,)
+
+
+# Firma especializada para HS256/384/512: el header es fijo para el algoritmo
+# configurado, así que se serializa una sola vez al importar.
+_HMAC_DIGESTS = {"HS256": hashlib.sha256, "HS384": hashlib.sha384, "HS512": hashlib.sha512}
+_hmac_digest = _HMAC_DIGESTS.get(settings.ALGORITHM)
+_jwt_key_bytes = _jwt_key.encode("utf-8")
+
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return int(value.timestamp()) if value.tzinfo else int((value - datetime(1970, 1, 1)).total_seconds())
+    raise TypeError(f"Tipo no serializable en JWT: {type(value).__name__}")
+
+
+_HEADER_B64 = _b64url(
+    json.dumps({"alg": settings.ALGORITHM, "typ": "JWT"}, separators=(",", ":"), sort_keys=True).encode()
+)
+
+
+def _encode(payload: dict) -> str:
+    if _hmac_digest is None:
+        # Algoritmos asimétricos: se delega en PyJWT
+        return _jwt.encode(payload, _jwt_key, algorithm=settings.ALGORITHM)
+    body = _b64url(json.dumps(payload, separators=(",", ":"), default=_json_default).encode())
+    signing_input = _HEADER_B64 + b"." + body
+    signature = hmac.new(_jwt_key_bytes, signing_input, _hmac_digest).digest()
+    return (signing_input + b"." + _b64url(signature)).decode("ascii")
+
+
+def _decode(token: str) -> dict:
+    return _jwt.decode(token, _jwt_key, algorithms=_jwt_algorithms)
+
+
+# Datos constantes de los errores de autenticación/autorización.
+# La excepción se crea en cada raise: una instancia compartida acumularía
+# en __traceback__ los frames (y locals) de cada request que la lanzó.
+_UNAUTH_DETAIL = "No se pudo validar las credenciales"
+_UNAUTH_HEADERS = {"WWW-Authenticate": "Bearer"}
+_INACTIVE_DETAIL = "Usuario inactivo"
+_NOT_ADMIN_DETAIL = "Se requieren permisos de administrador"
+_NOT_COCINERO_DETAIL = "Se requieren permisos de cocinero"
+
+
+def _unauthorized() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=_UNAUTH_DETAIL,
+        headers=_UNAUTH_HEADERS,
+    )
+
+
+def _forbidden(detail: str) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=detail)
+
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/auth/login")
 
+# Cache de payloads JWT ya verificados (clave: sha256 del token).
+# Evita repetir HMAC + parseo JSON para tokens vistos hace pocos segundos.
+# Solo se accede desde el event loop, por lo que no requiere lock.
+PAYLOAD_CACHE_TTL = 5
+_payload_cache: TTLCache = TTLCache(maxsize=10000, ttl=PAYLOAD_CACHE_TTL)
+
+# Cache del usuario autenticado por email, evita un SELECT por request.
+# Se invalida con invalidate_user() al modificar datos del usuario.
+_user_cache: TTLCache = TTLCache(maxsize=5000, ttl=30)
+
+
+class UsuarioActual(NamedTuple):
+    """
+    Snapshot del usuario autenticado
+    
+    Copia inmutable de los campos de Usuario, segura de compartir entre
+    requests (no depende de una sesión abierta). Para modificar el usuario
+    se debe cargar la entidad con db.get(Usuario, current_user.id).
+    """
+    id: int
+    email: str
+    nombre: str
+    telefono: Optional[str]
+    direccion: Optional[str]
+    rol: str
+    activo: bool
+    email_verificado: bool
+    fecha_registro: Optional[datetime]
+    
+    @classmethod
+    def desde_modelo(cls, user: Usuario) -> "UsuarioActual":
+        return cls(
+            id=user.id,
+            email=user.email,
+            nombre=user.nombre,
+            telefono=user.telefono,
+            direccion=user.direccion,
+            rol=user.rol,
+            activo=user.activo,
+            email_verificado=user.email_verificado,
+            fecha_registro=user.fecha_registro
+        )
+
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+# Consulta Core para get_current_user: sin identity map ni instrumentación ORM.
+# .columns() tipa el resultado (DateTime/Boolean) igual que el ORM.
+_user_query = text(
+    "SELECT id, email, nombre, telefono, direccion, rol, activo, "
+    "email_verificado, fecha_registro FROM usuarios WHERE email = :email"
+).columns(
+    Usuario.id, Usuario.email, Usuario.nombre, Usuario.telefono, Usuario.direccion,
+    Usuario.rol, Usuario.activo, Usuario.email_verificado, Usuario.fecha_registro
+)
+
+
+def invalidate_user(email: str) -> None:
+    """Quitar un usuario del cache tras modificar sus datos"""
+    _user_cache.pop(email, None)
+
+
+def _ab64_encode(data: bytes) -> str:
+    """Base64 adaptado de passlib ('.' en vez de '+', sin padding)"""
+    return base64.b64encode(data).decode("ascii").rstrip("=").replace("+", ".")
+
+
+def _ab64_decode(data: str) -> bytes:
+    data = data.replace(".", "+")
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+def _pbkdf2_verify(plain_password: str, hashed_password: str) -> bool:
+    """Verificar un hash $pbkdf2-sha256$ con hashlib y comparación en tiempo constante"""
+    try:
+        rounds, salt, checksum = hashed_password[len(PBKDF2_PREFIX):].split("$")
+        expected = _ab64_decode(checksum)
+        derived = hashlib.pbkdf2_hmac(
+            "sha256", plain_password.encode("utf-8"), _ab64_decode(salt), int(rounds), len(expected)
+        )
+    except (ValueError, TypeError):
+        return False
+    return hmac.compare_digest(derived, expected)
+
+
+def _verify_password_sync(plain_password: str, hashed_password: str) -> bool:
+    if not hashed_password.startswith(PBKDF2_PREFIX):
+        return False
+    return _pbkdf2_verify(plain_password, hashed_password)
+
+
+def _hash_password_sync(password: str) -> str:
+    salt = secrets.token_bytes(PBKDF2_SALT_BYTES)
+    derived = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PBKDF2_ROUNDS)
+    return f"{PBKDF2_PREFIX}{PBKDF2_ROUNDS}${_ab64_encode(salt)}${_ab64_encode(derived)}"
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verificar password contra hash (E-06)"""
-    return pwd_context.verify(plain_password, hashed_password)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_pool, _verify_password_sync, plain_password, hashed_password)
 
 
-def get_password_hash(password: str) -> str:
+async def get_password_hash(password: str) -> str:
     """Hashear password (E-01)"""
-    return pwd_context.hash(password)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_pool, _hash_password_sync, password)
+
+
+async def get_password_hashes(passwords: List[str]) -> List[str]:
+    """Hashear varias passwords en paralelo (carga inicial / importación masiva)"""
+    return list(await asyncio.gather(*(get_password_hash(p) for p in passwords)))
+
+
+def shutdown_hash_pool() -> None:
+    """Cerrar el pool de hashing (shutdown de la aplicación)"""
+    _hash_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _decode_cached(token: str) -> dict:
+    """Decodificar JWT reutilizando el payload si ya fue verificado recientemente"""
+    key = hashlib.sha256(token.encode()).digest()
+    now = time.time()
+    cached = _payload_cache.get(key)
+    if cached is not None:
+        payload, expires_at = cached
+        if now < expires_at:
+            return payload
+    
+    payload = _decode(token)
+    
+    # No cachear más allá de la expiración del propio token
+    expires_at = now + PAYLOAD_CACHE_TTL
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        expires_at = min(expires_at, exp)
+    _payload_cache[key] = (payload, expires_at)
+    return payload
+
+
+ACCESS_TOKEN_TTL = settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+RECOVERY_TOKEN_TTL = 3600  # Token de recuperación válido por 1 hora
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """Crear JWT token (E-06)"""
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
-    return encoded_jwt
+    ttl = int(expires_delta.total_seconds()) if expires_delta else ACCESS_TOKEN_TTL
+    to_encode["exp"] = int(time.time()) + ttl
+    return _encode(to_encode)
+
 
+def _huella_password(hashed_password: str) -> str:
+    """Huella corta del hash del password vigente (invalida el token al cambiarlo)"""
+    return hashlib.sha256(hashed_password.encode("utf-8")).hexdigest()[:16]
 
-def create_recovery_token(email: str) -> str:
-    """Crear token de recuperación de password (E-08)"""
-    expire = datetime.utcnow() + timedelta(hours=1)  # Token válido por 1 hora
-    to_encode = {"sub": email, "exp": expire, "type": "recovery"}
-    return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+
+def create_recovery_token(email: str, hashed_password: str) -> str:
+    """
+    Crear token de recuperación de password (E-08)
+    
+    Sin estado en BD: expira por "exp" y es de un solo uso porque lleva la
+    huella del password vigente, que deja de coincidir tras el reset.
+    """
+    to_encode = {
+        "sub": email,
+        "exp": int(time.time()) + RECOVERY_TOKEN_TTL,
+        "type": "recovery",
+        "pwd": _huella_password(hashed_password),
+    }
+    return _encode(to_encode)
 
 
-def verify_recovery_token(token: str) -> Optional[str]:
-    """Verificar token de recuperación de password (E-08)"""
+def verify_recovery_token(token: str) -> Optional[Tuple[str, str]]:
+    """Verificar token de recuperación de password (E-08); devuelve (email, huella)"""
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        payload = _decode_cached(token)
         email: str = payload.get("sub")
         token_type: str = payload.get("type")
+        huella: str = payload.get("pwd")
         
-        if email is None or token_type != "recovery":
+        if email is None or token_type != "recovery" or huella is None:
             return None
         
-        return email
-    except JWTError:
+        return email, huella
+    except InvalidTokenError:
         return None
 
 
+def recovery_token_vigente(huella: str, hashed_password: str) -> bool:
+    """True si el token se emitió para el password actual (no fue usado)"""
+    return hmac.compare_digest(huella, _huella_password(hashed_password))
+
+
+def hash_token(token: str) -> str:
+    """SHA-256 (hex) de un token de un solo uso; en BD nunca se guarda en claro"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
     db: AsyncSession = Depends(get_db)
-) -> Usuario:
+) -> UsuarioActual:
     """Obtener usuario actual desde token JWT (E-06)"""
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="No se pudo validar las credenciales",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        payload = _decode_cached(token)
         email: str = payload.get("sub")
         if email is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    
-    # Buscar usuario en la base de datos
-    result = await db.execute(select(Usuario).where(Usuario.email == email))
-    user = result.scalar_one_or_none()
+            raise _unauthorized()
+    except InvalidTokenError:
+        raise _unauthorized() from None
     
+    # Buscar usuario en cache y, si no está, en la base de datos
+    user = _user_cache.get(email)
     if user is None:
-        raise credentials_exception
+        row = (await db.execute(_user_query, {"email": email})).first()
+        
+        if row is None:
+            raise _unauthorized()
+        
+        user = UsuarioActual._make(row)
+        _user_cache[email] = user
     
     if not user.activo:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Usuario inactivo"
-        )
+        raise _forbidden(_INACTIVE_DETAIL)
     
     return user
 
 
 async def get_current_active_user(
-    current_user: Usuario = Depends(get_current_user)
-) -> Usuario:
+    current_user: UsuarioActual = Depends(get_current_user)
+) -> UsuarioActual:
     """Verificar que el usuario esté activo"""
     if not current_user.activo:
-        raise HTTPException(status_code=400, detail="Usuario inactivo")
+        raise HTTPException(status_code=400, detail=_INACTIVE_DETAIL)
     return current_user
 
 
+@lru_cache(maxsize=None)
 def require_role(*roles: str):
-    """Decorator para requerir roles específicos (E-07)"""
-    async def role_checker(current_user: Usuario = Depends(get_current_user)) -> Usuario:
-        if current_user.rol not in roles:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail=f"Se requiere uno de los siguientes roles: {', '.join(roles)}"
-            )
+    """
+    Decorator para requerir roles específicos (E-07)
+    
+    Memoizado por tupla de roles: cada combinación reutiliza el mismo checker,
+    con el conjunto de roles y el mensaje de error construidos una sola vez.
+    """
+    roles_set = frozenset(roles)
+    detail = f"Se requiere uno de los siguientes roles: {', '.join(roles)}"
+    
+    async def role_checker(current_user: UsuarioActual = Depends(get_current_user)) -> UsuarioActual:
+        if current_user.rol not in roles_set:
+            raise _forbidden(detail)
         return current_user
     return role_checker
 
 
 # Dependencias de autorización por rol (E-07)
-async def require_admin(current_user: Usuario = Depends(get_current_user)) -> Usuario:
+ROLES_COCINA = frozenset(("cocinero", "administrador"))
+
+
+async def require_admin(current_user: UsuarioActual = Depends(get_current_user)) -> UsuarioActual:
     """Requiere rol de administrador"""
     if current_user.rol != "administrador":
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Se requieren permisos de administrador"
-        )
+        raise _forbidden(_NOT_ADMIN_DETAIL)
     return current_user
 
 
-async def require_cocinero(current_user: Usuario = Depends(get_current_user)) -> Usuario:
+async def require_cocinero(current_user: UsuarioActual = Depends(get_current_user)) -> UsuarioActual:
     """Requiere rol de cocinero o administrador"""
-    if current_user.rol not in ["cocinero", "administrador"]:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Se requieren permisos de cocinero"
-        )
+    if current_user.rol not in ROLES_COCINA:
+        raise _forbidden(_NOT_COCINERO_DETAIL)
     return current_user
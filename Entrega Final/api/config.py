@@ -1,6 +1,7 @@
 """
 Configuración de la aplicación FastAPI
 """
+from functools import cached_property
 from pydantic_settings import BaseSettings
 from typing import List, Optional
 
@@ -10,11 +11,17 @@ class Settings(BaseSettings):
     
     # Database
     DATABASE_URL: str
+    DB_NULLPOOL: bool = False  # True si se usa pgbouncer en modo transacción
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: int = 30  # Segundos esperando una conexión libre antes de fallar
+    DB_POOL_RECYCLE: int = 1800  # Segundos antes de renovar una conexión inactiva
     
     # JWT
     SECRET_KEY: str
     ALGORITHM: str
     ACCESS_TOKEN_EXPIRE_MINUTES: int
+    PASSWORD_HASH_ROUNDS: int = 29000  # Rondas PBKDF2-SHA256 (costo de CPU por hash)
     
     # CORS
     ALLOWED_ORIGINS: str
@@ -25,24 +32,30 @@ class Settings(BaseSettings):
     SMTP_USERNAME: Optional[str] = None
     SMTP_PASSWORD: Optional[str] = None
     EMAIL_FROM: Optional[str] = None
+    EMAIL_CONCURRENCY: int = 10  # Envíos SMTP simultáneos en campañas
     
     # Storage
     STORAGE_TYPE: str = "local"
     STORAGE_PATH: str = "./uploads"
+    PDF_ACCEL_REDIRECT_PREFIX: Optional[str] = None  # Ej: "/internal/pdf/" si nginx sirve los PDF
     
     # App
     APP_NAME: str = "Pizzería La Fornace API"
     APP_VERSION: str = "1.0.0"
     DEBUG: bool = True
+    SQL_ECHO: bool = False  # Loguear cada sentencia SQL (costoso, solo diagnóstico)
     RADIO_COBERTURA_KM: float = 15.0
     
-    @property
+    @cached_property
     def allowed_origins_list(self) -> List[str]:
-        return [origin.strip() for origin in self.ALLOWED_ORIGINS.split(",")]
+        # Se calcula una sola vez; se omiten entradas vacías (p.ej. coma final)
+        origenes = (origin.strip() for origin in self.ALLOWED_ORIGINS.split(","))
+        return [origin for origin in origenes if origin]
     
     class Config:
         env_file = ".env"
         case_sensitive = True
+        ignored_types = (cached_property,)
 
 
 settings = Settings()
@@ -1,18 +1,88 @@
 """
 Configuración de Base de Datos con SQLAlchemy
 """
+import logging
+from contextvars import ContextVar
+from sqlalchemy import event, inspect, text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, AsyncAdaptedQueuePool
+from sqlalchemy.dialects import postgresql, sqlite
 from config import settings
-from models import Base
+from models import Base, Dinero
+
+# Pool de conexiones dimensionado explícitamente (ajustable por entorno):
+# conexiones reutilizadas en ráfagas de tráfico en vez de abrir una nueva por request
+# (LIFO: se reutiliza la conexión más reciente, que sigue "caliente")
+POOL_OPTIONS = {
+    "poolclass": AsyncAdaptedQueuePool,
+    "pool_size": settings.DB_POOL_SIZE,
+    "max_overflow": settings.DB_MAX_OVERFLOW,
+    "pool_timeout": settings.DB_POOL_TIMEOUT,
+    "pool_recycle": settings.DB_POOL_RECYCLE,
+    "pool_pre_ping": True,
+    "pool_use_lifo": True,
+}
+
+
+def _pool_options(url: str) -> dict:
+    """
+    Opciones de pool según el despliegue
+    
+    - DB_NULLPOOL: detrás de pgbouncer en modo transacción el pooling lo hace
+      pgbouncer, así que SQLAlchemy no debe retener conexiones.
+    - SQLite en memoria usa StaticPool y no acepta opciones de pool.
+    """
+    if settings.DB_NULLPOOL:
+        return {"poolclass": NullPool}
+    if url.startswith("sqlite") and ":memory:" in url:
+        return {}
+    return POOL_OPTIONS
+
+
+# El log de SQL se activa solo con SQL_ECHO, independiente de DEBUG
+if not settings.SQL_ECHO:
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
 
 # Motor de base de datos asíncrono
 engine = create_async_engine(
     settings.DATABASE_URL,
-    echo=settings.DEBUG,
-    future=True
+    echo=settings.SQL_ECHO,
+    future=True,
+    **_pool_options(settings.DATABASE_URL)
 )
 
+# SQLite: las conexiones del pool conservan su caché de páginas entre requests;
+# se configuran una sola vez al abrirse
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _configurar_sqlite(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-64000")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+# Contador de consultas por contexto para detectar N+1 (middleware en DEBUG y
+# tests). El listener queda siempre registrado: sin conteo iniciado solo cuesta
+# una lectura de ContextVar por sentencia.
+_query_count: ContextVar = ContextVar("query_count", default=None)
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _contar_consulta(conn, cursor, statement, parameters, context, executemany):
+    contador = _query_count.get()
+    if contador is not None:
+        contador[0] += 1
+
+
+def iniciar_conteo_consultas() -> list:
+    """Iniciar el conteo de consultas del contexto actual; devuelve el contador"""
+    contador = [0]
+    _query_count.set(contador)
+    return contador
+
 # Sesión asíncrona
 AsyncSessionLocal = sessionmaker(
     engine,
@@ -23,10 +93,70 @@ AsyncSessionLocal = sessionmaker(
 )
 
 
+def is_postgresql() -> bool:
+    """True si la base de datos configurada es PostgreSQL"""
+    return engine.dialect.name == "postgresql"
+
+
+def dialect_insert(model):
+    """
+    INSERT específico del motor (PostgreSQL o SQLite)
+    
+    Permite usar on_conflict_do_nothing / on_conflict_do_update en ambos motores.
+    """
+    if is_postgresql():
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+def migracion_aplicada(conn, nombre: str) -> bool:
+    """Registrar migraciones de datos de una sola vez (idempotencia)"""
+    conn.execute(text("CREATE TABLE IF NOT EXISTS migraciones_aplicadas (nombre VARCHAR(100) PRIMARY KEY)"))
+    existe = conn.execute(
+        text("SELECT 1 FROM migraciones_aplicadas WHERE nombre = :nombre"), {"nombre": nombre}
+    ).first()
+    if existe:
+        return True
+    conn.execute(text("INSERT INTO migraciones_aplicadas (nombre) VALUES (:nombre)"), {"nombre": nombre})
+    return False
+
+
+def montos_a_centavos(conn):
+    """Convertir columnas monetarias Numeric(10,2) a enteros de centavos (tipo Dinero)"""
+    if migracion_aplicada(conn, "montos_a_centavos"):
+        return
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        tipos = {col["name"]: col["type"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if not isinstance(column.type, Dinero) or column.name not in tipos:
+                continue
+            # Solo columnas creadas antes del cambio (aún decimales)
+            if not hasattr(tipos[column.name], "scale"):
+                continue
+            if conn.dialect.name == "postgresql":
+                conn.execute(text(
+                    f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE bigint "
+                    f"USING round({column.name} * 100)::bigint"
+                ))
+            else:
+                # SQLite: el tipo declarado no cambia, pero los valores pasan a centavos
+                conn.execute(text(
+                    f"UPDATE {table.name} SET {column.name} = CAST(ROUND({column.name} * 100) AS INTEGER)"
+                ))
+            print(f"  ~ {table.name}.{column.name} -> centavos")
+
+
 async def init_db():
-    """Inicializar tablas de la base de datos"""
+    """
+    Inicializar tablas de la base de datos
+    
+    Incluye la conversión de montos a centavos: leer columnas aún decimales
+    con Dinero daría montos 100 veces menores, así que no se deja a update_db.py.
+    """
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(montos_a_centavos)
 
 
 async def get_db() -> AsyncSession:
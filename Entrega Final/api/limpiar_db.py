@@ -8,6 +8,9 @@ import os
 # Ruta a la base de datos
 DB_PATH = os.path.join(os.path.dirname(__file__), 'pizzeria.db')
 
+# VACUUM reescribe el archivo completo: solo vale la pena en limpiezas grandes
+VACUUM_MIN_FILAS = 1000
+
 def limpiar_base_datos():
     print("=" * 50)
     print("🧹 LIMPIEZA DE BASE DE DATOS - La Fornace")
@@ -17,7 +20,14 @@ def limpiar_base_datos():
         print("❌ No se encontró la base de datos en:", DB_PATH)
         return
     
-    conn = sqlite3.connect(DB_PATH)
+    # Transacciones manejadas explícitamente (BEGIN/COMMIT)
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    conn.execute("PRAGMA foreign_keys = ON")
+    # Menos fsync y tablas temporales en memoria para los DELETE ... IN
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -200000")
     cursor = conn.cursor()
     
     try:
@@ -77,71 +87,45 @@ def limpiar_base_datos():
         
         print("\n🗑️  Limpiando datos...")
         
-        # Orden de eliminación (respetando foreign keys)
-        # 1. Eliminar reembolsos
-        cursor.execute("DELETE FROM reembolsos")
-        print(f"   ✓ Reembolsos eliminados: {cursor.rowcount}")
-        
-        # 2. Eliminar solicitudes de anulación
-        cursor.execute("DELETE FROM solicitudes_anulacion")
-        print(f"   ✓ Solicitudes de anulación eliminadas: {cursor.rowcount}")
-        
-        # 3. Eliminar cola de impresión
-        cursor.execute("DELETE FROM cola_impresion")
-        print(f"   ✓ Cola de impresión eliminada: {cursor.rowcount}")
-        
-        # 4. Eliminar emails de confirmación
-        cursor.execute("DELETE FROM emails_confirmacion")
-        print(f"   ✓ Emails de confirmación eliminados: {cursor.rowcount}")
-        
-        # 5. Eliminar pedidos (de usuarios no protegidos)
-        cursor.execute("DELETE FROM pedidos")
-        print(f"   ✓ Pedidos eliminados: {cursor.rowcount}")
-        
-        # 6. Eliminar items de carrito (de usuarios no protegidos)
-        cursor.execute("""
-            DELETE FROM carrito_items WHERE carrito_id IN (
-                SELECT id FROM carritos WHERE user_id NOT IN ({})
-            )
-        """.format(','.join('?' * len(ids_protegidos))), ids_protegidos)
-        print(f"   ✓ Items de carrito eliminados: {cursor.rowcount}")
-        
-        # 7. Eliminar carritos (de usuarios no protegidos)
-        cursor.execute("""
-            DELETE FROM carritos WHERE user_id NOT IN ({})
-        """.format(','.join('?' * len(ids_protegidos))), ids_protegidos)
-        print(f"   ✓ Carritos eliminados: {cursor.rowcount}")
-        
-        # 8. Eliminar preferencias promo (de usuarios no protegidos)
-        cursor.execute("""
-            DELETE FROM preferencias_promo WHERE cliente_id NOT IN ({})
-        """.format(','.join('?' * len(ids_protegidos))), ids_protegidos)
-        print(f"   ✓ Preferencias promocionales eliminadas: {cursor.rowcount}")
-        
-        # 9. Eliminar campañas
-        cursor.execute("DELETE FROM campanias_segmentadas")
-        print(f"   ✓ Campañas eliminadas: {cursor.rowcount}")
-        
-        # 10. Eliminar rankings
-        cursor.execute("DELETE FROM ranking_productos")
-        print(f"   ✓ Rankings eliminados: {cursor.rowcount}")
-        
-        # 11. Eliminar PDFs exportados
-        cursor.execute("DELETE FROM pdf_exports")
-        print(f"   ✓ PDFs exportados eliminados: {cursor.rowcount}")
+        # Placeholders de usuarios protegidos, construidos una sola vez
+        pp = tuple(ids_protegidos)
+        placeholders = ','.join('?' * len(pp))
+        
+        # Orden de eliminación (respetando foreign keys).
+        # (sentencia, parámetros, descripción)
+        eliminaciones = [
+            ("DELETE FROM reembolsos", (), "Reembolsos eliminados"),
+            ("DELETE FROM solicitudes_anulacion", (), "Solicitudes de anulación eliminadas"),
+            ("DELETE FROM cola_impresion", (), "Cola de impresión eliminada"),
+            ("DELETE FROM emails_confirmacion", (), "Emails de confirmación eliminados"),
+            ("DELETE FROM pedidos", (), "Pedidos eliminados"),
+            (f"""DELETE FROM carrito_items WHERE carrito_id IN (
+                SELECT id FROM carritos WHERE user_id NOT IN ({placeholders})
+            )""", pp, "Items de carrito eliminados"),
+            (f"DELETE FROM carritos WHERE user_id NOT IN ({placeholders})", pp, "Carritos eliminados"),
+            (f"DELETE FROM preferencias_promo WHERE cliente_id NOT IN ({placeholders})", pp,
+             "Preferencias promocionales eliminadas"),
+            ("DELETE FROM campanias_segmentadas", (), "Campañas eliminadas"),
+            ("DELETE FROM ranking_productos", (), "Rankings eliminados"),
+            ("DELETE FROM pdf_exports", (), "PDFs exportados eliminados"),
+            (f"DELETE FROM usuarios WHERE id NOT IN ({placeholders})", pp, "Usuarios eliminados"),
+        ]
         
-        # 12. Eliminar usuarios NO protegidos
-        cursor.execute("""
-            DELETE FROM usuarios WHERE id NOT IN ({})
-        """.format(','.join('?' * len(ids_protegidos))), ids_protegidos)
-        print(f"   ✓ Usuarios eliminados: {cursor.rowcount}")
+        # Todas las eliminaciones en una única transacción
+        total_eliminadas = 0
+        cursor.execute("BEGIN IMMEDIATE")
+        for sql, params, descripcion in eliminaciones:
+            cursor.execute(sql, params)
+            total_eliminadas += cursor.rowcount
+            print(f"   ✓ {descripcion}: {cursor.rowcount}")
         
         # Commit cambios
         conn.commit()
         
         # Vacuum para reducir tamaño del archivo
-        print("\n🔧 Optimizando base de datos...")
-        cursor.execute("VACUUM")
+        if total_eliminadas >= VACUUM_MIN_FILAS:
+            print("\n🔧 Optimizando base de datos...")
+            cursor.execute("VACUUM")
         
         # Mostrar resultado final
         print("\n📊 Datos DESPUÉS de limpiar:")
@@ -159,7 +143,8 @@ def limpiar_base_datos():
         
     except Exception as e:
         print(f"\n❌ Error durante la limpieza: {e}")
-        conn.rollback()
+        if conn.in_transaction:
+            conn.rollback()
     finally:
         conn.close()
 
@@ -17,7 +17,7 @@ Enablers (E-01 a E-08): Infraestructura tecnica
     - E-03: Gestion de stock en tiempo real
     - E-04: Calculo de ETA (tiempo estimado de entrega)
     - E-05: Validacion de cobertura geografica
-    - E-06: Login con credenciales cifradas (bcrypt)
+    - E-06: Login con credenciales cifradas (PBKDF2-SHA256)
     - E-07: Roles y permisos diferenciados (RBAC)
     - E-08: Recuperacion de contrasena segura
 
@@ -42,16 +42,18 @@ Curso: Desarrollo Web y Movil - UNAB
 Fecha: Diciembre 2025
 ============================================================================
 """
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from contextlib import asynccontextmanager
+import asyncio
+import logging
 
 from config import settings
-from database import init_db, AsyncSessionLocal
+from database import init_db, AsyncSessionLocal, dialect_insert, engine, iniciar_conteo_consultas
 from models import Usuario
-from auth import get_password_hash
-from sqlalchemy import select
+from auth import get_password_hashes, shutdown_hash_pool
+from services.email_service import email_service
 from routers import (
     auth,
     productos,
@@ -62,6 +64,27 @@ from routers import (
 )
 
 
+# Usuarios creados por defecto al iniciar la API
+SEED_USERS = [
+    {
+        "email": "admin@lafornace.cl",
+        "password": "admin123",
+        "nombre": "Administrador Sistema",
+        "telefono": "+56912345678",
+        "direccion": "Oficina Central",
+        "rol": "administrador",
+    },
+    {
+        "email": "cocinero@lafornace.cl",
+        "password": "cocina123",
+        "nombre": "Chef Mario",
+        "telefono": "+56987654321",
+        "direccion": "Cocina La Fornace",
+        "rol": "cocinero",
+    },
+]
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Eventos de inicio y cierre de la aplicación"""
@@ -70,57 +93,47 @@ async def lifespan(app: FastAPI):
     print(f"Version: {settings.APP_VERSION}")
     print(f"Debug: {settings.DEBUG}")
     
-    # Inicializar base de datos
-    await init_db()
+    # Inicializar base de datos mientras se hashean las passwords de los
+    # usuarios por defecto (DDL e hashing son independientes)
+    _, hashes = await asyncio.gather(
+        init_db(),
+        get_password_hashes([seed["password"] for seed in SEED_USERS])
+    )
     print("Base de datos inicializada")
     
-    # Crear usuario administrador por defecto si no existe
+    # Crear usuarios por defecto (administrador y cocinero) si no existen
+    valores = []
+    for seed, hashed_password in zip(SEED_USERS, hashes):
+        datos = {k: v for k, v in seed.items() if k != "password"}
+        valores.append({
+            **datos,
+            "hashed_password": hashed_password,
+            "email_verificado": True,
+            "activo": True
+        })
+    
+    # Un solo INSERT idempotente: los usuarios existentes se omiten
     async with AsyncSessionLocal() as db:
-        result = await db.execute(select(Usuario).where(Usuario.email == "admin@lafornace.cl"))
-        admin_user = result.scalar_one_or_none()
-        
-        if not admin_user:
-            print("Creando usuario administrador por defecto...")
-            hashed_password = get_password_hash("admin123")
-            new_admin = Usuario(
-                email="admin@lafornace.cl",
-                nombre="Administrador Sistema",
-                telefono="+56912345678",
-                direccion="Oficina Central",
-                hashed_password=hashed_password,
-                rol="administrador",
-                email_verificado=True,
-                activo=True
-            )
-            db.add(new_admin)
-            await db.commit()
-            print("Usuario administrador creado: admin@lafornace.cl / admin123")
-        
-        # Crear usuario cocinero por defecto si no existe
-        result = await db.execute(select(Usuario).where(Usuario.email == "cocinero@lafornace.cl"))
-        cocinero_user = result.scalar_one_or_none()
-        
-        if not cocinero_user:
-            print("Creando usuario cocinero por defecto...")
-            hashed_password = get_password_hash("cocina123")
-            new_cocinero = Usuario(
-                email="cocinero@lafornace.cl",
-                nombre="Chef Mario",
-                telefono="+56987654321",
-                direccion="Cocina La Fornace",
-                hashed_password=hashed_password,
-                rol="cocinero",
-                email_verificado=True,
-                activo=True
-            )
-            db.add(new_cocinero)
-            await db.commit()
-            print("Usuario cocinero creado: cocinero@lafornace.cl / cocina123")
+        stmt = (
+            dialect_insert(Usuario)
+            .values(valores)
+            .on_conflict_do_nothing(index_elements=["email"])
+            .returning(Usuario.email)
+        )
+        result = await db.execute(stmt)
+        creados = set(result.scalars().all())
+        await db.commit()
+    
+    for seed in SEED_USERS:
+        if seed["email"] in creados:
+            print(f"Usuario {seed['rol']} creado: {seed['email']} / {seed['password']}")
     
     yield
     
     # Shutdown
     print("Cerrando API...")
+    shutdown_hash_pool()
+    await email_service.close()
 
 
 # Crear aplicación FastAPI
@@ -168,6 +181,7 @@ app = FastAPI(
     """,
     docs_url="/docs",
     redoc_url="/redoc",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -180,6 +194,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Consultas por request sobre las que se advierte un posible N+1 (solo DEBUG)
+MAX_CONSULTAS_REQUEST = 10
+
+if settings.DEBUG:
+    @app.middleware("http")
+    async def contar_consultas(request: Request, call_next):
+        """Exponer X-Query-Count y advertir de requests con demasiadas consultas"""
+        contador = iniciar_conteo_consultas()
+        response = await call_next(request)
+        response.headers["X-Query-Count"] = str(contador[0])
+        if contador[0] > MAX_CONSULTAS_REQUEST:
+            logging.getLogger("uvicorn.error").warning(
+                "%s %s ejecutó %d consultas (posible N+1)",
+                request.method, request.url.path, contador[0]
+            )
+        return response
+
 
 # ============================================================================
 # REGISTRAR ROUTERS
@@ -234,6 +265,14 @@ async def health_check():
     }
 
 
+@app.get("/debug/pool", tags=["Health"], include_in_schema=settings.DEBUG)
+async def pool_status():
+    """Estado del pool de conexiones (solo en modo DEBUG)"""
+    if not settings.DEBUG:
+        return JSONResponse(status_code=404, content={"status": 404, "message": "Recurso no encontrado"})
+    return {"pool": engine.pool.status()}
+
+
 @app.get("/api/v1/info", tags=["Info"])
 async def api_info():
     """Información de la API y cobertura de historias de usuario"""
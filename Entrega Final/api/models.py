@@ -34,32 +34,77 @@ Relaciones:
 - Pedido 1:1 SolicitudAnulacion (un pedido puede tener una anulacion)
 ============================================================================
 """
-from sqlalchemy import Boolean, Column, Integer, String, Numeric, DateTime, ForeignKey, Table, Text, JSON
+from sqlalchemy import Boolean, Column, Integer, BigInteger, String, Numeric, DateTime, ForeignKey, Table, Text, JSON, Index, text, DDL, event
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
 from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
 
 Base = declarative_base()
 
+# JSON genérico; en PostgreSQL se almacena como JSONB (binario, indexable con GIN)
+JSONType = JSON().with_variant(JSONB(), "postgresql")
+
+# pg_trgm: índices GIN de trigramas para búsquedas ILIKE '%texto%' (solo PostgreSQL)
+event.listen(
+    Base.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql")
+)
+
+
+class Dinero(TypeDecorator):
+    """
+    Monto monetario almacenado como entero de centavos (BIGINT)
+    
+    Hacia la aplicación se sigue exponiendo como Decimal con 2 decimales,
+    por lo que schemas y cálculos no cambian.
+    """
+    impl = BigInteger
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, Decimal):
+            value = Decimal(str(value))
+        return int((value * 100).to_integral_value(rounding=ROUND_HALF_UP))
+    
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(value).scaleb(-2)
+
 
 # ============================================================================
 # TABLAS INTERMEDIAS (Relaciones Muchos a Muchos)
 # ============================================================================
 
 # Tabla intermedia para extras en items del carrito
+# FKs diferidas: se verifican una sola vez al COMMIT en las escrituras en bloque
 carrito_item_extras = Table(
     'carrito_item_extras',
     Base.metadata,
-    Column('carrito_item_id', Integer, ForeignKey('carrito_items.id', ondelete='CASCADE')),
-    Column('extra_id', Integer, ForeignKey('extras.id', ondelete='CASCADE'))
+    Column('carrito_item_id', Integer,
+           ForeignKey('carrito_items.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+           primary_key=True),
+    Column('extra_id', Integer,
+           ForeignKey('extras.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+           primary_key=True)
 )
 
 # Tabla intermedia para relacion Producto-Extra (Muchos a Muchos)
 producto_extras = Table(
     'producto_extras',
     Base.metadata,
-    Column('producto_id', Integer, ForeignKey('productos.id', ondelete='CASCADE'), primary_key=True),
-    Column('extra_id', Integer, ForeignKey('extras.id', ondelete='CASCADE'), primary_key=True)
+    Column('producto_id', Integer,
+           ForeignKey('productos.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+           primary_key=True),
+    Column('extra_id', Integer,
+           ForeignKey('extras.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+           primary_key=True)
 )
 
 
@@ -89,18 +134,17 @@ class Usuario(Base):
     nombre = Column(String(255), nullable=False)
     hashed_password = Column(String(255), nullable=False)
     email_verificado = Column(Boolean, default=False)
-    token_verificacion = Column(String(255), nullable=True)
-    token_recuperacion = Column(String(255), nullable=True)
-    token_expiracion = Column(DateTime, nullable=True)
+    token_verificacion_hash = Column(String(64), nullable=True, index=True)  # sha256 del token
     rol = Column(String(50), default="cliente")  # cliente, administrador, cocinero
     activo = Column(Boolean, default=True)
-    fecha_registro = Column(DateTime, default=func.now())
-    fecha_actualizacion = Column(DateTime, default=func.now(), onupdate=func.now())
+    fecha_registro = Column(DateTime, default=func.now(), server_default=func.now())
+    fecha_actualizacion = Column(DateTime, default=func.now(), server_default=func.now(), onupdate=func.now())
     
     # Relaciones
-    pedidos = relationship("Pedido", back_populates="usuario", cascade="all, delete-orphan")
-    carrito = relationship("Carrito", back_populates="usuario", uselist=False, cascade="all, delete-orphan")
-    preferencias_promo = relationship("PreferenciaPromo", back_populates="cliente", uselist=False, cascade="all, delete-orphan")
+    # lazy="raise_on_sql": cargar explícitamente con selectinload/joinedload
+    pedidos = relationship("Pedido", back_populates="usuario", cascade="all, delete-orphan", lazy="raise_on_sql")
+    carrito = relationship("Carrito", back_populates="usuario", uselist=False, cascade="all, delete-orphan", lazy="raise_on_sql")
+    preferencias_promo = relationship("PreferenciaPromo", back_populates="cliente", uselist=False, cascade="all, delete-orphan", lazy="raise_on_sql")
 
 
 class Categoria(Base):
@@ -123,19 +167,32 @@ class Producto(Base):
     id = Column(Integer, primary_key=True, index=True)
     nombre = Column(String(255), nullable=False)
     descripcion = Column(Text, nullable=True)
-    precio = Column(Numeric(10, 2), nullable=False)
+    precio = Column(Dinero, nullable=False)
     image_url = Column(String(500), nullable=True)
     categoria_id = Column(Integer, ForeignKey("categorias.id"), nullable=False)
     disponible = Column(Boolean, default=True)
     stock = Column(Integer, default=100)  # E-03: Control de stock
     activo = Column(Boolean, default=True)
-    fecha_creacion = Column(DateTime, default=func.now())
-    fecha_actualizacion = Column(DateTime, default=func.now(), onupdate=func.now())
+    fecha_creacion = Column(DateTime, default=func.now(), server_default=func.now())
+    fecha_actualizacion = Column(DateTime, default=func.now(), server_default=func.now(), onupdate=func.now())
     
     # Relaciones
     categoria = relationship("Categoria", back_populates="productos")
-    rankings = relationship("RankingProducto", back_populates="producto")
-    extras = relationship("Extra", secondary=producto_extras, back_populates="productos")
+    rankings = relationship("RankingProducto", back_populates="producto", lazy="raise_on_sql")
+    extras = relationship("Extra", secondary=producto_extras, back_populates="productos", lazy="raise_on_sql")
+    
+    __table_args__ = (
+        # Menú (B-07): filtros de igualdad + orden por nombre sin sort adicional
+        Index("idx_productos_menu", "activo", "disponible", "categoria_id", "nombre"),
+        # Búsqueda del menú (ILIKE '%texto%') con trigramas, solo PostgreSQL
+        Index(
+            "idx_productos_busqueda_trgm",
+            "nombre",
+            "descripcion",
+            postgresql_using="gin",
+            postgresql_ops={"nombre": "gin_trgm_ops", "descripcion": "gin_trgm_ops"}
+        ).ddl_if(dialect="postgresql"),
+    )
 
 
 class Tamanio(Base):
@@ -143,8 +200,8 @@ class Tamanio(Base):
     __tablename__ = "tamanios"
     
     id = Column(Integer, primary_key=True, index=True)
-    nombre = Column(String(50), nullable=False)  # Personal, Mediana, Familiar
-    precio_adicional = Column(Numeric(10, 2), default=0)
+    nombre = Column(String(50), unique=True, nullable=False)  # Personal, Mediana, Familiar
+    precio_adicional = Column(Dinero, default=0)
     activo = Column(Boolean, default=True)
 
 
@@ -154,15 +211,16 @@ class Extra(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     nombre = Column(String(100), nullable=False)
-    precio = Column(Numeric(10, 2), nullable=False)
+    precio = Column(Dinero, nullable=False)
     disponible = Column(Boolean, default=True)
     activo = Column(Boolean, default=True)
 
     # Relaciones
-    productos = relationship("Producto", secondary=producto_extras, back_populates="extras")
+    productos = relationship("Producto", secondary=producto_extras, back_populates="extras", lazy="raise_on_sql")
 
     @property
     def productos_ids(self):
+        # Requiere Extra.productos precargado (ver EXTRA_PRODUCTOS_IDS en routers/productos.py)
         return [p.id for p in self.productos]
 
 
@@ -172,8 +230,8 @@ class Carrito(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"), unique=True, nullable=False)
-    fecha_creacion = Column(DateTime, default=func.now())
-    fecha_actualizacion = Column(DateTime, default=func.now(), onupdate=func.now())
+    fecha_creacion = Column(DateTime, default=func.now(), server_default=func.now())
+    fecha_actualizacion = Column(DateTime, default=func.now(), server_default=func.now(), onupdate=func.now())
     
     # Relaciones
     usuario = relationship("Usuario", back_populates="carrito")
@@ -189,7 +247,7 @@ class CarritoItem(Base):
     producto_id = Column(Integer, ForeignKey("productos.id"), nullable=False)
     tamanio_id = Column(Integer, ForeignKey("tamanios.id"), nullable=True)
     cantidad = Column(Integer, default=1)
-    precio_unitario = Column(Numeric(10, 2), nullable=False)
+    precio_unitario = Column(Dinero, nullable=False)
     notas = Column(Text, nullable=True)
     
     # Relaciones
@@ -205,13 +263,13 @@ class Pedido(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("usuarios.id"), nullable=False)
-    fecha = Column(DateTime, default=func.now())
+    fecha = Column(DateTime, default=func.now(), server_default=func.now())
     estado = Column(String(50), default="pendiente")  # pendiente, confirmado, preparando, enviado, entregado, cancelado
-    subtotal = Column(Numeric(10, 2), nullable=False)
-    costo_envio = Column(Numeric(10, 2), default=0)
-    impuestos = Column(Numeric(10, 2), default=0)
-    descuento = Column(Numeric(10, 2), default=0)
-    total = Column(Numeric(10, 2), nullable=False)
+    subtotal = Column(Dinero, nullable=False)
+    costo_envio = Column(Dinero, default=0)
+    impuestos = Column(Dinero, default=0)
+    descuento = Column(Dinero, default=0)
+    total = Column(Dinero, nullable=False)
     
     # Detalles de entrega (E-04, E-05)
     direccion = Column(String(500), nullable=False)
@@ -222,17 +280,38 @@ class Pedido(Base):
     longitud = Column(Numeric(10, 7), nullable=True)
     
     # Datos del pedido
-    items_json = Column(JSON, nullable=False)  # Snapshot de los items al momento de confirmar
+    items_json = Column(JSONType, nullable=False)  # Snapshot de los items al momento de confirmar
     metodo_pago = Column(String(50), nullable=True)  # E-02
     transaccion_id = Column(String(255), nullable=True)  # ID de transacción de la pasarela
     
-    fecha_actualizacion = Column(DateTime, default=func.now(), onupdate=func.now())
+    fecha_actualizacion = Column(DateTime, default=func.now(), server_default=func.now(), onupdate=func.now())
     
     # Relaciones
     usuario = relationship("Usuario", back_populates="pedidos")
-    anulacion = relationship("SolicitudAnulacion", back_populates="pedido", uselist=False)
+    anulacion = relationship("SolicitudAnulacion", back_populates="pedido", uselist=False, lazy="raise_on_sql")
     cola_impresion = relationship("ColaImpresion", back_populates="pedido", uselist=False)
     email_confirmacion = relationship("EmailConfirmacion", back_populates="pedido", uselist=False)
+    
+    __table_args__ = (
+        # Índice parcial: solo los pedidos aún anulables (B-05)
+        Index(
+            "idx_pedidos_anulables",
+            "user_id",
+            fecha.desc(),
+            postgresql_where=text("estado IN ('pendiente', 'confirmado')"),
+            sqlite_where=text("estado IN ('pendiente', 'confirmado')")
+        ),
+        # Reportes de ventas y ranking: rango de fechas + estado; en PostgreSQL
+        # incluye total para que SUM/COUNT del reporte sea un index-only scan
+        Index("idx_pedidos_fecha_estado", "fecha", "estado", postgresql_include=["total"]),
+        # Búsquedas por contenido de items (items_json @> '[{"producto_id": 42}]'), solo PostgreSQL
+        Index(
+            "idx_pedidos_items_gin",
+            "items_json",
+            postgresql_using="gin",
+            postgresql_ops={"items_json": "jsonb_path_ops"}
+        ).ddl_if(dialect="postgresql"),
+    )
 
 
 class SolicitudAnulacion(Base):
@@ -243,10 +322,15 @@ class SolicitudAnulacion(Base):
     pedido_id = Column(Integer, ForeignKey("pedidos.id"), unique=True, nullable=False)
     motivo = Column(Text, nullable=False)
     estado = Column(String(50), default="pendiente")  # pendiente, aprobada, rechazada
-    monto_reembolso = Column(Numeric(10, 2), nullable=False)
-    fecha_solicitud = Column(DateTime, default=func.now())
+    monto_reembolso = Column(Dinero, nullable=False)
+    fecha_solicitud = Column(DateTime, default=func.now(), server_default=func.now())
     fecha_procesado = Column(DateTime, nullable=True)
     
+    # Copia de datos del pedido (inmutables tras la anulación) para
+    # consultar reembolsos sin pasar por la tabla pedidos
+    user_id = Column(Integer, ForeignKey("usuarios.id"), nullable=True, index=True)
+    pedido_fecha = Column(DateTime, nullable=True)
+    
     # Relaciones
     pedido = relationship("Pedido", back_populates="anulacion")
     reembolso = relationship("Reembolso", back_populates="anulacion", uselist=False)
@@ -258,11 +342,11 @@ class Reembolso(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     anulacion_id = Column(Integer, ForeignKey("solicitudes_anulacion.id"), unique=True, nullable=False)
-    monto = Column(Numeric(10, 2), nullable=False)
+    monto = Column(Dinero, nullable=False)
     metodo_pago = Column(String(50), nullable=False)
     estado = Column(String(50), default="pendiente")  # pendiente, procesado, completado, fallido
     transaccion_id = Column(String(255), nullable=True)
-    fecha_proceso = Column(DateTime, default=func.now())
+    fecha_proceso = Column(DateTime, default=func.now(), server_default=func.now())
     
     # Relaciones
     anulacion = relationship("SolicitudAnulacion", back_populates="reembolso")
@@ -275,7 +359,7 @@ class ColaImpresion(Base):
     id = Column(Integer, primary_key=True, index=True)
     pedido_id = Column(Integer, ForeignKey("pedidos.id"), unique=True, nullable=False)
     estado = Column(String(50), default="pendiente")  # pendiente, impreso, error
-    fecha_envio_cocina = Column(DateTime, default=func.now())
+    fecha_envio_cocina = Column(DateTime, default=func.now(), server_default=func.now())
     fecha_impresion = Column(DateTime, nullable=True)
     reintentos = Column(Integer, default=0)
     
@@ -293,8 +377,8 @@ class RankingProducto(Base):
     periodo_fin = Column(DateTime, nullable=False)
     posicion = Column(Integer, nullable=False)
     cantidad_vendida = Column(Integer, nullable=False)
-    ingreso_total = Column(Numeric(10, 2), nullable=False)
-    fecha_calculo = Column(DateTime, default=func.now())
+    ingreso_total = Column(Dinero, nullable=False)
+    fecha_calculo = Column(DateTime, default=func.now(), server_default=func.now())
     
     # Relaciones
     producto = relationship("Producto", back_populates="rankings")
@@ -309,8 +393,8 @@ class PDFExport(Base):
     nombre_archivo = Column(String(255), nullable=False)
     ruta_archivo = Column(String(500), nullable=False)
     tamano_bytes = Column(Integer, nullable=True)
-    metadata_json = Column(JSON, nullable=True)
-    fecha_generacion = Column(DateTime, default=func.now())
+    metadata_json = Column(JSONType, nullable=True)
+    fecha_generacion = Column(DateTime, default=func.now(), server_default=func.now())
     fecha_expiracion = Column(DateTime, nullable=True)
 
 
@@ -340,7 +424,7 @@ class PreferenciaPromo(Base):
     email_opt_in = Column(Boolean, default=True)
     sms_opt_in = Column(Boolean, default=False)
     whatsapp_opt_in = Column(Boolean, default=False)
-    fecha_ultima_actualizacion = Column(DateTime, default=func.now(), onupdate=func.now())
+    fecha_ultima_actualizacion = Column(DateTime, default=func.now(), server_default=func.now(), onupdate=func.now())
     
     # Relaciones
     cliente = relationship("Usuario", back_populates="preferencias_promo")
@@ -352,10 +436,15 @@ class CampaniaSegmentada(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     nombre = Column(String(255), nullable=False)
-    criterios_json = Column(JSON, nullable=False)  # Criterios de segmentación
+    criterios_json = Column(JSONType, nullable=False)  # Criterios de segmentación
     mensaje = Column(Text, nullable=False)
     canal = Column(String(50), nullable=False)  # email, sms, whatsapp
     estado = Column(String(50), default="draft")  # draft, enviada, programada
     cliente_count = Column(Integer, default=0)
-    fecha_creacion = Column(DateTime, default=func.now())
+    fecha_creacion = Column(DateTime, default=func.now(), server_default=func.now())
     fecha_envio = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        # Listado de campañas filtrado por estado, más recientes primero
+        Index("idx_campanias_estado_fecha", "estado", "fecha_creacion"),
+    )
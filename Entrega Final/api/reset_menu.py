@@ -7,7 +7,61 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from database import init_db, AsyncSessionLocal
 from models import Categoria, Producto, Tamanio, Extra, CarritoItem, RankingProducto
-from sqlalchemy import delete, text
+from sqlalchemy import delete, insert, text
+from sqlalchemy.types import TypeDecorator
+from decimal import Decimal
+
+# Datos base del menú: (columnas, filas) por tabla
+CATEGORIAS = (
+    ("nombre", "descripcion", "activo"),
+    [
+        ("Pizzas", "Nuestras deliciosas pizzas artesanales", True),
+        ("Bebestibles", "Bebidas y jugos refrescantes", True),
+    ],
+)
+TAMANIOS = (
+    ("nombre", "precio_adicional", "activo"),
+    [
+        ("Personal", Decimal(0), True),
+        ("Mediana", Decimal(2000), True),
+        ("Familiar", Decimal(4000), True),
+    ],
+)
+EXTRAS = (
+    ("nombre", "precio", "disponible", "activo"),
+    [
+        ("Queso Extra", Decimal(1000), True, True),
+        ("Peperoni", Decimal(1000), True, True),
+        ("Champiñones", Decimal(800), True, True),
+    ],
+)
+
+
+async def bulk_insert(db, model, columns, records):
+    """
+    Insertar varias filas en una tabla en una sola operación
+    
+    En PostgreSQL (asyncpg) usa COPY; en otros motores un INSERT executemany.
+    La columna id se omite para que la secuencia asigne los valores.
+    """
+    connection = await db.connection()
+    if connection.dialect.name == "postgresql" and connection.dialect.driver == "asyncpg":
+        # COPY no pasa por los tipos de SQLAlchemy: convertir (p. ej. Dinero -> centavos)
+        tipos = [model.__table__.c[col].type for col in columns]
+        records = [
+            tuple(
+                tipo.process_bind_param(valor, connection.dialect) if isinstance(tipo, TypeDecorator) else valor
+                for tipo, valor in zip(tipos, record)
+            )
+            for record in records
+        ]
+        raw = await connection.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            model.__tablename__, records=records, columns=list(columns)
+        )
+    else:
+        await db.execute(insert(model), [dict(zip(columns, record)) for record in records])
+
 
 async def reset_menu():
     print("Iniciando limpieza y reinicio del menú...")
@@ -17,59 +71,42 @@ async def reset_menu():
             # 1. Limpiar tablas relacionadas con productos
             print("Eliminando datos existentes...")
             
-            # Eliminar items de carrito primero (por FK)
-            await db.execute(delete(CarritoItem))
-            
-            # Eliminar rankings
-            await db.execute(delete(RankingProducto))
-            
-            # Eliminar productos
-            await db.execute(delete(Producto))
-            
-            # Eliminar categorías, tamaños y extras
-            await db.execute(delete(Categoria))
-            await db.execute(delete(Tamanio))
-            await db.execute(delete(Extra))
-            
-            # Reiniciar secuencias de IDs (opcional pero recomendado para limpieza total)
-            # Nota: Esto es específico de PostgreSQL
-            try:
-                await db.execute(text("ALTER SEQUENCE productos_id_seq RESTART WITH 1"))
-                await db.execute(text("ALTER SEQUENCE categorias_id_seq RESTART WITH 1"))
-                await db.execute(text("ALTER SEQUENCE tamanios_id_seq RESTART WITH 1"))
-                await db.execute(text("ALTER SEQUENCE extras_id_seq RESTART WITH 1"))
-            except Exception as e:
-                print(f"Nota: No se pudieron reiniciar secuencias (posiblemente no es PostgreSQL o permisos insuficientes): {e}")
+            connection = await db.connection()
+            if connection.dialect.name == "postgresql":
+                # Una sola sentencia: vacía las tablas y reinicia las secuencias de IDs
+                await db.execute(text(
+                    "TRUNCATE carrito_items, carrito_item_extras, ranking_productos, "
+                    "producto_extras, productos, categorias, tamanios, extras "
+                    "RESTART IDENTITY CASCADE"
+                ))
+            else:
+                # Eliminar items de carrito primero (por FK)
+                await db.execute(delete(CarritoItem))
+                
+                # Eliminar rankings
+                await db.execute(delete(RankingProducto))
+                
+                # Eliminar productos
+                await db.execute(delete(Producto))
+                
+                # Eliminar categorías, tamaños y extras
+                await db.execute(delete(Categoria))
+                await db.execute(delete(Tamanio))
+                await db.execute(delete(Extra))
 
             print("Datos eliminados correctamente.")
             
             # 2. Crear Categorías Básicas
             print("Creando categorías...")
-            cat_pizzas = Categoria(nombre="Pizzas", descripcion="Nuestras deliciosas pizzas artesanales", activo=True)
-            cat_bebestibles = Categoria(nombre="Bebestibles", descripcion="Bebidas y jugos refrescantes", activo=True)
-            
-            db.add(cat_pizzas)
-            db.add(cat_bebestibles)
+            await bulk_insert(db, Categoria, *CATEGORIAS)
             
             # 3. Crear Tamaños Estándar
             print("Creando tamaños...")
-            t_personal = Tamanio(nombre="Personal", precio_adicional=0, activo=True)
-            t_mediana = Tamanio(nombre="Mediana", precio_adicional=2000, activo=True)
-            t_familiar = Tamanio(nombre="Familiar", precio_adicional=4000, activo=True)
-            
-            db.add(t_personal)
-            db.add(t_mediana)
-            db.add(t_familiar)
+            await bulk_insert(db, Tamanio, *TAMANIOS)
             
             # 4. Crear Extras Básicos (para que no quede vacío)
             print("Creando extras básicos...")
-            e_queso = Extra(nombre="Queso Extra", precio=1000, disponible=True, activo=True)
-            e_peperoni = Extra(nombre="Peperoni", precio=1000, disponible=True, activo=True)
-            e_champi = Extra(nombre="Champiñones", precio=800, disponible=True, activo=True)
-            
-            db.add(e_queso)
-            db.add(e_peperoni)
-            db.add(e_champi)
+            await bulk_insert(db, Extra, *EXTRAS)
             
             await db.commit()
             print("¡Menú reiniciado exitosamente!")
@@ -4,21 +4,89 @@ Implementa: B-05, E-02
 """
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, insert, update, literal
+from sqlalchemy.orm import joinedload, defer
 from datetime import datetime, timedelta
+from cachetools import TTLCache
+import time
 
-from database import get_db
-from models import Pedido, SolicitudAnulacion, Reembolso, Usuario
+from database import get_db, is_postgresql
+from models import Pedido, SolicitudAnulacion, Reembolso
 from schemas import AnulacionInput, AnulacionResponse, ReembolsoResponse, Response
-from auth import get_current_user
+from auth import get_current_user, UsuarioActual
 
 router = APIRouter(prefix="/api/v1/anulaciones", tags=["Anulaciones"])
 
+# Un pedido es anulable solo en estos estados y dentro de la ventana de tiempo
+ESTADOS_ANULABLES = ("pendiente", "confirmado")
+VENTANA_ANULACION = timedelta(minutes=10)
+
+# Cache de /puede-anular (consultado periódicamente por el frontend).
+# Clave: pedido_id -> (user_id, respuesta, expira_en). Cada entrada vive como
+# máximo PUEDE_ANULAR_TTL segundos y nunca más allá del fin de la ventana.
+PUEDE_ANULAR_TTL = 30
+_puede_anular_cache: TTLCache = TTLCache(maxsize=10000, ttl=PUEDE_ANULAR_TTL)
+
+
+# La anulación no usa el snapshot de items: no se transfiere ni se decodifica el JSON
+SIN_ITEMS_JSON = defer(Pedido.items_json, raiseload=True)
+
+
+def invalidar_puede_anular(pedido_id: int) -> None:
+    """Quitar del cache la respuesta de /puede-anular al cambiar el pedido"""
+    _puede_anular_cache.pop(pedido_id, None)
+
+
+async def _get_pedido_con_anulacion(db: AsyncSession, pedido_id: int, user_id: int):
+    """
+    Obtener pedido del usuario junto con su anulación
+    
+    Búsqueda por clave primaria (db.get consulta primero el identity map);
+    Pedido.anulacion es uno-a-uno y se carga con JOIN en el mismo SELECT.
+    La pertenencia al usuario se verifica después de obtenerlo.
+    """
+    pedido = await db.get(Pedido, pedido_id, options=[joinedload(Pedido.anulacion), SIN_ITEMS_JSON])
+    if pedido is None or pedido.user_id != user_id:
+        return None
+    return pedido
+
+
+async def _get_pedido_anulable(db: AsyncSession, pedido_id: int, user_id: int):
+    """
+    Obtener el pedido solo si es anulable (estado y ventana filtrados en SQL)
+    
+    Usa el índice parcial idx_pedidos_anulables. El límite de tiempo se
+    calcula en Python y se envía como parámetro, portable entre motores.
+    """
+    limite = datetime.utcnow() - VENTANA_ANULACION
+    result = await db.execute(
+        select(Pedido)
+        .options(joinedload(Pedido.anulacion), SIN_ITEMS_JSON)
+        .where(
+            Pedido.id == pedido_id,
+            Pedido.user_id == user_id,
+            Pedido.estado.in_(ESTADOS_ANULABLES),
+            Pedido.fecha > limite
+        )
+    )
+    return result.unique().scalar_one_or_none()
+
+
+async def _get_estado_pedido(db: AsyncSession, pedido_id: int, user_id: int):
+    """Estado del pedido (None si no existe), para explicar por qué no es anulable"""
+    result = await db.execute(
+        select(Pedido.estado).where(
+            Pedido.id == pedido_id,
+            Pedido.user_id == user_id
+        )
+    )
+    return result.scalar_one_or_none()
+
 
 @router.post("", response_model=AnulacionResponse, status_code=status.HTTP_201_CREATED)
 async def solicitar_anulacion(
     anulacion_data: AnulacionInput,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -30,81 +98,112 @@ async def solicitar_anulacion(
     - El pedido no debe haber iniciado preparación
     - Motivo justificado (mínimo 10 caracteres)
     """
-    # Buscar pedido
-    result = await db.execute(
-        select(Pedido).where(
-            Pedido.id == anulacion_data.pedido_id,
-            Pedido.user_id == current_user.id
-        )
-    )
-    pedido = result.scalar_one_or_none()
+    # Buscar pedido anulable (con su anulación, si existe)
+    pedido = await _get_pedido_anulable(db, anulacion_data.pedido_id, current_user.id)
     
     if not pedido:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Pedido no encontrado"
-        )
-    
-    # Verificar que no esté ya cancelado
-    if pedido.estado == "cancelado":
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="El pedido ya está cancelado"
-        )
-    
-    # Verificar que no haya iniciado preparación
-    if pedido.estado in ["preparando", "enviado", "entregado"]:
+        # Determinar el motivo solo en el caso de rechazo
+        estado = await _get_estado_pedido(db, anulacion_data.pedido_id, current_user.id)
+        
+        if estado is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Pedido no encontrado"
+            )
+        
+        # Verificar que no esté ya cancelado
+        if estado == "cancelado":
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="El pedido ya está cancelado"
+            )
+        
+        # Verificar que no haya iniciado preparación
+        if estado not in ESTADOS_ANULABLES:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"No se puede anular el pedido porque ya está en estado: {estado}"
+            )
+        
+        # Fuera de la ventana de tiempo (máximo 10 minutos después de confirmar)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"No se puede anular el pedido porque ya está en estado: {pedido.estado}"
+            detail="El tiempo límite para anular el pedido ha expirado (10 minutos)"
         )
     
     # Verificar que no exista ya una solicitud de anulación
-    result = await db.execute(
-        select(SolicitudAnulacion).where(SolicitudAnulacion.pedido_id == pedido.id)
-    )
-    existing_anulacion = result.scalar_one_or_none()
-    
-    if existing_anulacion:
+    if pedido.anulacion:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Ya existe una solicitud de anulación para este pedido"
         )
     
-    # Verificar ventana de tiempo (ejemplo: máximo 10 minutos después de confirmar)
-    tiempo_transcurrido = datetime.utcnow() - pedido.fecha
-    if tiempo_transcurrido > timedelta(minutes=10):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="El tiempo límite para anular el pedido ha expirado (10 minutos)"
-        )
-    
-    # Crear solicitud de anulación
-    nueva_anulacion = SolicitudAnulacion(
+    valores_anulacion = dict(
         pedido_id=pedido.id,
         motivo=anulacion_data.motivo,
         estado="pendiente",
-        monto_reembolso=pedido.total
+        monto_reembolso=pedido.total,
+        user_id=pedido.user_id,
+        pedido_fecha=pedido.fecha
     )
+    metodo_pago = pedido.metodo_pago or "transferencia"
     
-    db.add(nueva_anulacion)
-    await db.flush()
-    
-    # Actualizar estado del pedido
-    pedido.estado = "cancelado"
-    
-    # Crear registro de reembolso
-    reembolso = Reembolso(
-        anulacion_id=nueva_anulacion.id,
-        monto=pedido.total,
-        metodo_pago=pedido.metodo_pago or "transferencia",
-        estado="pendiente"
-    )
-    
-    db.add(reembolso)
+    if is_postgresql():
+        # Las tres escrituras (anulación, estado del pedido y reembolso) en
+        # una sola sentencia con CTEs; devuelve la anulación creada
+        anulacion_cte = (
+            insert(SolicitudAnulacion)
+            .values(**valores_anulacion)
+            .returning(*SolicitudAnulacion.__table__.c)
+            .cte("nueva_anulacion")
+        )
+        pedido_cte = (
+            update(Pedido)
+            .where(Pedido.id == pedido.id)
+            .values(estado="cancelado")
+            .returning(Pedido.id)
+            .cte("pedido_cancelado")
+        )
+        reembolso_cte = (
+            insert(Reembolso)
+            .from_select(
+                ["anulacion_id", "monto", "metodo_pago", "estado"],
+                select(
+                    anulacion_cte.c.id,
+                    anulacion_cte.c.monto_reembolso,
+                    literal(metodo_pago),
+                    literal("pendiente")
+                )
+            )
+            .returning(Reembolso.id)
+            .cte("nuevo_reembolso")
+        )
+        result = await db.execute(select(anulacion_cte).add_cte(pedido_cte, reembolso_cte))
+        nueva_anulacion = dict(result.mappings().one())
+    else:
+        # Crear solicitud de anulación (RETURNING trae id y fecha_solicitud sin refresh)
+        result = await db.execute(
+            insert(SolicitudAnulacion)
+            .values(**valores_anulacion)
+            .returning(SolicitudAnulacion)
+        )
+        nueva_anulacion = result.scalar_one()
+        
+        # Actualizar estado del pedido
+        pedido.estado = "cancelado"
+        
+        # Crear registro de reembolso
+        await db.execute(
+            insert(Reembolso).values(
+                anulacion_id=nueva_anulacion.id,
+                monto=pedido.total,
+                metodo_pago=metodo_pago,
+                estado="pendiente"
+            )
+        )
     
     await db.commit()
-    await db.refresh(nueva_anulacion)
+    invalidar_puede_anular(pedido.id)
     
     # TODO: Notificar al administrador
     # TODO: Procesar reembolso automático si aplica
@@ -115,20 +214,14 @@ async def solicitar_anulacion(
 @router.get("/{pedido_id}", response_model=AnulacionResponse)
 async def get_anulacion_by_pedido(
     pedido_id: int,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
     Obtener detalles de anulación por pedido
     """
     # Verificar que el pedido pertenezca al usuario
-    result = await db.execute(
-        select(Pedido).where(
-            Pedido.id == pedido_id,
-            Pedido.user_id == current_user.id
-        )
-    )
-    pedido = result.scalar_one_or_none()
+    pedido = await _get_pedido_con_anulacion(db, pedido_id, current_user.id)
     
     if not pedido:
         raise HTTPException(
@@ -136,11 +229,7 @@ async def get_anulacion_by_pedido(
             detail="Pedido no encontrado"
         )
     
-    # Buscar anulación
-    result = await db.execute(
-        select(SolicitudAnulacion).where(SolicitudAnulacion.pedido_id == pedido_id)
-    )
-    anulacion = result.scalar_one_or_none()
+    anulacion = pedido.anulacion
     
     if not anulacion:
         raise HTTPException(
@@ -154,36 +243,31 @@ async def get_anulacion_by_pedido(
 @router.get("/{pedido_id}/reembolso", response_model=ReembolsoResponse)
 async def get_reembolso(
     pedido_id: int,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
     Obtener estado del reembolso
     """
-    # Verificar que el pedido pertenezca al usuario
-    result = await db.execute(
-        select(Pedido).where(
-            Pedido.id == pedido_id,
-            Pedido.user_id == current_user.id
-        )
-    )
-    pedido = result.scalar_one_or_none()
-    
-    if not pedido:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Pedido no encontrado"
-        )
-    
-    # Buscar anulación y reembolso
+    # Buscar reembolso; la anulación guarda el dueño del pedido
     result = await db.execute(
         select(Reembolso)
         .join(SolicitudAnulacion)
-        .where(SolicitudAnulacion.pedido_id == pedido_id)
+        .where(
+            SolicitudAnulacion.pedido_id == pedido_id,
+            SolicitudAnulacion.user_id == current_user.id
+        )
     )
     reembolso = result.scalar_one_or_none()
     
     if not reembolso:
+        # Verificar que el pedido pertenezca al usuario
+        if await _get_estado_pedido(db, pedido_id, current_user.id) is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Pedido no encontrado"
+            )
+
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="No existe reembolso para este pedido"
@@ -195,7 +279,7 @@ async def get_reembolso(
 @router.get("/pedido/{pedido_id}/puede-anular", response_model=dict)
 async def puede_anular_pedido(
     pedido_id: int,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -203,54 +287,61 @@ async def puede_anular_pedido(
     
     Útil para mostrar/ocultar botón de anulación en la interfaz
     """
-    # Buscar pedido
-    result = await db.execute(
-        select(Pedido).where(
-            Pedido.id == pedido_id,
-            Pedido.user_id == current_user.id
-        )
-    )
-    pedido = result.scalar_one_or_none()
-    
-    if not pedido:
-        return {
-            "puede_anular": False,
-            "razon": "Pedido no encontrado"
-        }
+    cached = _puede_anular_cache.get(pedido_id)
+    if cached is not None:
+        user_id, respuesta, expira_en = cached
+        if user_id == current_user.id and time.monotonic() < expira_en:
+            return respuesta
     
-    # Verificar condiciones
-    if pedido.estado == "cancelado":
-        return {
-            "puede_anular": False,
-            "razon": "El pedido ya está cancelado"
-        }
-    
-    if pedido.estado in ["preparando", "enviado", "entregado"]:
-        return {
-            "puede_anular": False,
-            "razon": f"El pedido ya está en estado: {pedido.estado}"
-        }
+    respuesta, ttl = await _calcular_puede_anular(db, pedido_id, current_user.id)
+    if ttl > 0:
+        _puede_anular_cache[pedido_id] = (current_user.id, respuesta, time.monotonic() + ttl)
+    return respuesta
+
+
+async def _calcular_puede_anular(db: AsyncSession, pedido_id: int, user_id: int):
+    """Respuesta de /puede-anular y segundos que puede mantenerse en cache"""
+    # Buscar pedido anulable (con su anulación, si existe)
+    pedido = await _get_pedido_anulable(db, pedido_id, user_id)
     
-    # Verificar ventana de tiempo
-    tiempo_transcurrido = datetime.utcnow() - pedido.fecha
-    if tiempo_transcurrido > timedelta(minutes=10):
+    if not pedido:
+        estado = await _get_estado_pedido(db, pedido_id, user_id)
+        
+        if estado is None:
+            return {
+                "puede_anular": False,
+                "razon": "Pedido no encontrado"
+            }, PUEDE_ANULAR_TTL
+        
+        # Verificar condiciones
+        if estado == "cancelado":
+            return {
+                "puede_anular": False,
+                "razon": "El pedido ya está cancelado"
+            }, PUEDE_ANULAR_TTL
+        
+        if estado not in ESTADOS_ANULABLES:
+            return {
+                "puede_anular": False,
+                "razon": f"El pedido ya está en estado: {estado}"
+            }, PUEDE_ANULAR_TTL
+        
         return {
             "puede_anular": False,
             "razon": "El tiempo límite para anular ha expirado (10 minutos)"
-        }
+        }, PUEDE_ANULAR_TTL
     
     # Verificar si ya existe solicitud
-    result = await db.execute(
-        select(SolicitudAnulacion).where(SolicitudAnulacion.pedido_id == pedido.id)
-    )
-    if result.scalar_one_or_none():
+    if pedido.anulacion:
         return {
             "puede_anular": False,
             "razon": "Ya existe una solicitud de anulación"
-        }
+        }, PUEDE_ANULAR_TTL
     
+    tiempo_transcurrido = datetime.utcnow() - pedido.fecha
+    segundos_restantes = (VENTANA_ANULACION - tiempo_transcurrido).total_seconds()
     return {
         "puede_anular": True,
         "razon": None,
         "tiempo_restante_minutos": int(10 - (tiempo_transcurrido.total_seconds() / 60))
-    }
+    }, min(PUEDE_ANULAR_TTL, segundos_restantes)
@@ -18,7 +18,7 @@ POST   /verify-email/{token}  - Verificacion de email (E-01)
 
 Seguridad:
 ----------
-- Passwords hasheados con bcrypt
+- Passwords hasheados con PBKDF2-SHA256
 - Tokens JWT con expiracion (30 min por defecto)
 - Proteccion contra enumeracion de usuarios
 - Tokens de recuperacion de un solo uso
@@ -39,13 +39,17 @@ Dependencias:
 ================================================================================
 """
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import ORJSONResponse
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, insert, bindparam, true, false
+from sqlalchemy.exc import IntegrityError
+from cachetools import TTLCache
 from typing import List
+import hashlib
 import secrets
-from datetime import datetime, timedelta
 
-from database import get_db
+from database import get_db, is_postgresql
 from models import Usuario, PreferenciaPromo
 from schemas import (
     UsuarioCreate, UsuarioResponse, UsuarioUpdate, ContactoUpdateInput,
@@ -54,11 +58,29 @@ from schemas import (
 )
 from auth import (
     get_password_hash, verify_password, create_access_token,
-    create_recovery_token, verify_recovery_token, get_current_user
+    verify_recovery_token, recovery_token_vigente, get_current_user,
+    invalidate_user, hash_token, UsuarioActual
 )
 
 router = APIRouter(prefix="/api/v1/auth", tags=["Autenticación"])
 
+# Sentencias a nivel de módulo: se compilan una vez y reutilizan el cache de SQLAlchemy
+USER_BY_EMAIL = select(Usuario).where(Usuario.email == bindparam("email"))
+EMAIL_EXISTS = select(Usuario.id).where(Usuario.email == bindparam("email"))
+
+# Adaptador de UsuarioResponse construido una vez (validación + serialización)
+USER_ADAPTER = TypeAdapter(UsuarioResponse)
+
+# Cache de existencia de emails para /register (clave: sha256 del email).
+# Desvía del DB los sondeos repetidos; el UNIQUE de la tabla sigue siendo la garantía.
+_email_existe_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+EMAIL_DUPLICADO = "El email ya está registrado"
+
+
+def _email_key(email: str) -> bytes:
+    return hashlib.sha256(email.encode("utf-8")).digest()
+
 
 @router.post("/register", response_model=UsuarioResponse, status_code=status.HTTP_201_CREATED)
 async def register(
@@ -73,44 +95,64 @@ async def register(
     - Password con mínimo 8 caracteres
     - Genera token de verificación de email
     """
-    # Verificar si el email ya existe
-    result = await db.execute(select(Usuario).where(Usuario.email == user_data.email))
-    existing_user = result.scalar_one_or_none()
-    
-    if existing_user:
+    # Verificar si el email ya existe (cache-aside)
+    email_key = _email_key(user_data.email)
+    existe = _email_existe_cache.get(email_key)
+    if existe is None:
+        result = await db.execute(EMAIL_EXISTS, {"email": user_data.email})
+        existe = result.first() is not None
+        _email_existe_cache[email_key] = existe
+    
+    if existe:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="El email ya está registrado"
+            detail=EMAIL_DUPLICADO
         )
     
     # Crear usuario
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash(user_data.password)
     verification_token = secrets.token_urlsafe(32)
     
-    new_user = Usuario(
+    valores_usuario = dict(
         email=user_data.email,
         nombre=user_data.nombre,
         telefono=user_data.telefono,
         direccion=user_data.direccion,
         hashed_password=hashed_password,
-        token_verificacion=verification_token,
+        token_verificacion_hash=hash_token(verification_token),
         rol="cliente"
     )
     
-    db.add(new_user)
-    await db.flush()
-    
-    # Crear preferencias promocionales por defecto (B-13)
-    preferencias = PreferenciaPromo(
-        cliente_id=new_user.id,
-        email_opt_in=True,
-        sms_opt_in=False,
-        whatsapp_opt_in=False
-    )
-    db.add(preferencias)
-    
-    await db.commit()
-    await db.refresh(new_user)
+    # Crear usuario y sus preferencias promocionales por defecto (B-13).
+    # RETURNING entrega la fila completa (id, fechas por defecto) sin un refresh.
+    columnas_preferencias = ["cliente_id", "email_opt_in", "sms_opt_in", "whatsapp_opt_in"]
+    insert_usuario = insert(Usuario).values(**valores_usuario).returning(*Usuario.__table__.c)
+    try:
+        if is_postgresql():
+            # Una sola sentencia: el INSERT del usuario (CTE) alimenta el
+            # INSERT de sus preferencias y se devuelve la fila creada
+            nuevo_usuario = insert_usuario.cte("nuevo_usuario")
+            nuevas_preferencias = insert(PreferenciaPromo).from_select(
+                columnas_preferencias, select(nuevo_usuario.c.id, true(), false(), false())
+            ).cte("nuevas_preferencias")
+            result = await db.execute(select(nuevo_usuario).add_cte(nuevas_preferencias))
+            new_user = dict(result.mappings().one())
+        else:
+            result = await db.execute(insert_usuario)
+            new_user = dict(result.mappings().one())
+            await db.execute(
+                insert(PreferenciaPromo).values(dict(zip(columnas_preferencias, (new_user["id"], True, False, False))))
+            )
+        await db.commit()
+    except IntegrityError:
+        # Registro concurrente del mismo email (el cache pudo estar desactualizado)
+        await db.rollback()
+        _email_existe_cache[email_key] = True
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=EMAIL_DUPLICADO
+        )
+    _email_existe_cache[email_key] = True
     
     # TODO: Enviar email de verificación
     
@@ -131,10 +173,10 @@ async def login(
     - Generar JWT token
     """
     # Buscar usuario por email
-    result = await db.execute(select(Usuario).where(Usuario.email == user_data.email))
+    result = await db.execute(USER_BY_EMAIL, {"email": user_data.email})
     user = result.scalar_one_or_none()
     
-    if not user or not verify_password(user_data.password, user.hashed_password):
+    if not user or not await verify_password(user_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Email o password incorrectos",
@@ -150,16 +192,18 @@ async def login(
     # Crear token de acceso
     access_token = create_access_token(data={"sub": user.email})
     
-    return TokenResponse(
-        access_token=access_token,
-        token_type="bearer",
-        user=UsuarioResponse.model_validate(user)
-    )
+    # Respuesta ya serializada: evita validar de nuevo con response_model
+    usuario = USER_ADAPTER.validate_python(user, from_attributes=True)
+    return ORJSONResponse(content={
+        "access_token": access_token,
+        "token_type": "bearer",
+        "user": USER_ADAPTER.dump_python(usuario, mode="json")
+    })
 
 
 @router.get("/me", response_model=UsuarioResponse)
 async def get_current_user_profile(
-    current_user: Usuario = Depends(get_current_user)
+    current_user: UsuarioActual = Depends(get_current_user)
 ):
     """
     Obtener perfil del usuario actual (B-01)
@@ -170,7 +214,7 @@ async def get_current_user_profile(
 @router.put("/me", response_model=UsuarioResponse)
 async def update_profile(
     user_update: UsuarioUpdate,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -181,25 +225,26 @@ async def update_profile(
     - Teléfono
     - Dirección
     """
+    user = await db.get(Usuario, current_user.id)
+    
     if user_update.nombre is not None:
-        current_user.nombre = user_update.nombre
+        user.nombre = user_update.nombre
     if user_update.telefono is not None:
-        current_user.telefono = user_update.telefono
+        user.telefono = user_update.telefono
     if user_update.direccion is not None:
-        current_user.direccion = user_update.direccion
-    
-    current_user.fecha_actualizacion = datetime.utcnow()
+        user.direccion = user_update.direccion
     
     await db.commit()
-    await db.refresh(current_user)
+    await db.refresh(user)
+    invalidate_user(current_user.email)
     
-    return current_user
+    return user
 
 
 @router.put("/me/contacto", response_model=UsuarioResponse)
 async def update_contact_info(
     contacto_update: ContactoUpdateInput,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -209,37 +254,35 @@ async def update_contact_info(
     - Email único si se modifica
     - Formato válido de datos
     """
+    user = await db.get(Usuario, current_user.id)
+    
+    # Unicidad del email garantizada por el índice UNIQUE (sin SELECT previo)
     if contacto_update.email is not None:
-        # Verificar que el nuevo email no esté en uso
-        result = await db.execute(
-            select(Usuario).where(
-                Usuario.email == contacto_update.email,
-                Usuario.id != current_user.id
-            )
-        )
-        existing_user = result.scalar_one_or_none()
-        
-        if existing_user:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="El email ya está en uso por otro usuario"
-            )
-        
-        current_user.email = contacto_update.email
-        current_user.email_verificado = False  # Requerir nueva verificación
+        user.email = contacto_update.email
+        user.email_verificado = False  # Requerir nueva verificación
     
     if contacto_update.telefono is not None:
-        current_user.telefono = contacto_update.telefono
+        user.telefono = contacto_update.telefono
     
     if contacto_update.direccion is not None:
-        current_user.direccion = contacto_update.direccion
+        user.direccion = contacto_update.direccion
     
-    current_user.fecha_actualizacion = datetime.utcnow()
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="El email ya está en uso por otro usuario"
+        )
+    await db.refresh(user)
+    invalidate_user(current_user.email)
     
-    await db.commit()
-    await db.refresh(current_user)
+    if user.email != current_user.email:
+        _email_existe_cache.pop(_email_key(current_user.email), None)
+        _email_existe_cache[_email_key(user.email)] = True
     
-    return current_user
+    return user
 
 
 @router.post("/password-recovery/request", response_model=Response)
@@ -253,7 +296,7 @@ async def request_password_recovery(
     Genera token único con expiración y envía email
     """
     # Buscar usuario
-    result = await db.execute(select(Usuario).where(Usuario.email == request_data.email))
+    result = await db.execute(USER_BY_EMAIL, {"email": request_data.email})
     user = result.scalar_one_or_none()
     
     # Siempre responder con éxito para evitar enumeración de usuarios
@@ -263,16 +306,9 @@ async def request_password_recovery(
             message="Si el email existe, recibirás instrucciones para recuperar tu password"
         )
     
-    # Generar token de recuperación
-    recovery_token = create_recovery_token(user.email)
-    
-    # Guardar token en BD con expiración
-    user.token_recuperacion = recovery_token
-    user.token_expiracion = datetime.utcnow() + timedelta(hours=1)
-    
-    await db.commit()
-    
-    # TODO: Enviar email con enlace de recuperación
+    # TODO: Enviar email con enlace de recuperación. El token es sin estado
+    # (no se escribe la fila del usuario):
+    # recovery_token = create_recovery_token(user.email, user.hashed_password)
     # URL: https://domain.com/reset-password?token={recovery_token}
     
     return Response(
@@ -290,20 +326,21 @@ async def reset_password(
     Resetear password con token (E-08)
     
     Validaciones:
-    - Token válido y no expirado
-    - Token no reutilizado
+    - Token válido y no expirado (claim "exp")
+    - Token no reutilizado (huella del password vigente)
     """
     # Verificar token
-    email = verify_recovery_token(reset_data.token)
+    datos_token = verify_recovery_token(reset_data.token)
     
-    if not email:
+    if not datos_token:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Token inválido o expirado"
         )
+    email, huella = datos_token
     
     # Buscar usuario
-    result = await db.execute(select(Usuario).where(Usuario.email == email))
+    result = await db.execute(USER_BY_EMAIL, {"email": email})
     user = result.scalar_one_or_none()
     
     if not user:
@@ -312,25 +349,18 @@ async def reset_password(
             detail="Usuario no encontrado"
         )
     
-    # Verificar que el token coincida y no haya expirado
-    if user.token_recuperacion != reset_data.token:
+    # Un token ya usado no coincide con el password actual
+    if not recovery_token_vigente(huella, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Token inválido"
         )
     
-    if user.token_expiracion and user.token_expiracion < datetime.utcnow():
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Token expirado. Solicita un nuevo enlace de recuperación"
-        )
-    
     # Actualizar password
-    user.hashed_password = get_password_hash(reset_data.nueva_password)
-    user.token_recuperacion = None
-    user.token_expiracion = None
+    user.hashed_password = await get_password_hash(reset_data.nueva_password)
     
     await db.commit()
+    invalidate_user(user.email)
     
     return Response(
         status=200,
@@ -346,7 +376,9 @@ async def verify_email(
     """
     Verificar email con token (E-01)
     """
-    result = await db.execute(select(Usuario).where(Usuario.token_verificacion == token))
+    result = await db.execute(
+        select(Usuario).where(Usuario.token_verificacion_hash == hash_token(token))
+    )
     user = result.scalar_one_or_none()
     
     if not user:
@@ -356,9 +388,10 @@ async def verify_email(
         )
     
     user.email_verificado = True
-    user.token_verificacion = None
+    user.token_verificacion_hash = None
     
     await db.commit()
+    invalidate_user(user.email)
     
     return Response(
         status=200,
@@ -54,7 +54,7 @@ Dependencias:
 """
 from fastapi import APIRouter, Depends, HTTPException, status, Query, BackgroundTasks
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_, func, desc, delete
+from sqlalchemy import select, and_, func, desc, delete, insert
 from sqlalchemy.orm import joinedload
 from typing import List, Optional
 from decimal import Decimal
@@ -63,9 +63,12 @@ import math
 import logging
 
 from database import get_db
+from routers.anulaciones import invalidar_puede_anular
+from routers.productos import invalidar_menu
+from routers.notificaciones import registrar_envio_confirmacion
 from models import (
-    Carrito, CarritoItem, Producto, Tamanio, Extra, Pedido, Usuario,
-    ColaImpresion, EmailConfirmacion
+    Carrito, CarritoItem, Producto, Tamanio, Extra, Pedido,
+    ColaImpresion, EmailConfirmacion, carrito_item_extras
 )
 from schemas import (
     CarritoItemInput, CarritoResponse, CarritoItemResponse,
@@ -74,9 +77,9 @@ from schemas import (
     PedidoQueryInput, ValidacionDireccionRequest, ValidacionDireccionResponse,
     CostosDetalle, DetalleEntrega, Response, PaginatedResponse
 )
-from auth import get_current_user
+from auth import get_current_user, UsuarioActual
 from config import settings
-from services.email_service import email_service, EmailTemplates
+from services.email_service import email_service, render_confirmacion_pedido, render_cambio_estado_pedido
 
 logger = logging.getLogger(__name__)
 
@@ -88,44 +91,57 @@ router_pedidos = APIRouter(prefix="/api/v1/pedidos", tags=["Pedidos"])
 # UTILIDADES
 # ============================================
 
-def calcular_distancia_km(lat1: Decimal, lon1: Decimal, lat2: Decimal, lon2: Decimal) -> Decimal:
-    """Calcular distancia entre dos puntos geográficos usando fórmula de Haversine"""
-    R = 6371  # Radio de la Tierra en km
-    
-    lat1_rad = math.radians(float(lat1))
-    lat2_rad = math.radians(float(lat2))
-    dlat = math.radians(float(lat2 - lat1))
-    dlon = math.radians(float(lon2 - lon1))
+RADIO_TIERRA_KM = 6371
+
+# Coordenadas de la pizzería (configurar según ubicación real): Santiago, Chile.
+# El origen es fijo, así que su parte de la fórmula de Haversine se calcula una vez.
+PIZZERIA_LAT = -33.4489
+PIZZERIA_LON = -70.6693
+_PIZZERIA_LAT_RAD = math.radians(PIZZERIA_LAT)
+_PIZZERIA_LON_RAD = math.radians(PIZZERIA_LON)
+_PIZZERIA_COS_LAT = math.cos(_PIZZERIA_LAT_RAD)
+
+
+def calcular_distancia_km(lat: Decimal, lon: Decimal) -> float:
+    """Calcular distancia desde la pizzería a un punto usando fórmula de Haversine"""
+    lat_rad = math.radians(float(lat))
+    dlat = lat_rad - _PIZZERIA_LAT_RAD
+    dlon = math.radians(float(lon)) - _PIZZERIA_LON_RAD
     
-    a = math.sin(dlat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    a = math.sin(dlat/2)**2 + _PIZZERIA_COS_LAT * math.cos(lat_rad) * math.sin(dlon/2)**2
+    c = 2 * math.asin(math.sqrt(a))
     
-    return Decimal(str(R * c))
+    return RADIO_TIERRA_KM * c
 
 
-def calcular_eta(distancia_km: Decimal) -> int:
+def calcular_eta(distancia_km: float) -> int:
     """Calcular tiempo estimado de entrega en minutos (E-04)"""
     tiempo_preparacion = 25  # minutos base de preparación
     tiempo_por_km = 3  # minutos por kilómetro
     
-    return tiempo_preparacion + int(float(distancia_km) * tiempo_por_km)
+    return tiempo_preparacion + int(distancia_km * tiempo_por_km)
 
 
-async def calcular_precio_item(
+def calcular_precio_item(
     producto: Producto,
     tamanio: Optional[Tamanio],
     extras: List[Extra]
 ) -> Decimal:
     """Calcular precio unitario de un item del carrito"""
-    precio = producto.precio
+    precio = (producto.precio + tamanio.precio_adicional) if tamanio else producto.precio
     
-    if tamanio:
-        precio += tamanio.precio_adicional
-    
-    for extra in extras:
-        precio += extra.precio
+    return sum((extra.precio for extra in extras), precio)
+
+
+async def eliminar_items_carrito(db: AsyncSession, item_ids: List[int]) -> None:
+    """Eliminar items del carrito y sus extras con dos DELETE en bloque"""
+    if not item_ids:
+        return
     
-    return precio
+    await db.execute(
+        delete(carrito_item_extras).where(carrito_item_extras.c.carrito_item_id.in_(item_ids))
+    )
+    await db.execute(delete(CarritoItem).where(CarritoItem.id.in_(item_ids)))
 
 
 # ============================================
@@ -134,7 +150,7 @@ async def calcular_precio_item(
 
 @router_carrito.get("", response_model=CarritoResponse)
 async def get_carrito(
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -193,7 +209,7 @@ async def get_carrito(
 @router_carrito.post("/items", response_model=CarritoResponse)
 async def add_item_to_carrito(
     item_data: CarritoItemInput,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -257,7 +273,7 @@ async def add_item_to_carrito(
             )
     
     # Calcular precio unitario
-    precio_unitario = await calcular_precio_item(producto, tamanio, extras)
+    precio_unitario = calcular_precio_item(producto, tamanio, extras)
     
     # Crear item del carrito
     nuevo_item = CarritoItem(
@@ -271,9 +287,14 @@ async def add_item_to_carrito(
     
     db.add(nuevo_item)
     
-    # Asociar extras
+    # Asociar extras con un solo INSERT multi-fila
     if extras:
-        nuevo_item.extras = extras
+        await db.flush()
+        await db.execute(
+            insert(carrito_item_extras).values([
+                {"carrito_item_id": nuevo_item.id, "extra_id": extra.id} for extra in extras
+            ])
+        )
     
     await db.commit()
     await db.refresh(carrito)
@@ -286,7 +307,7 @@ async def add_item_to_carrito(
 async def update_carrito_item(
     item_id: int,
     cantidad: int = Query(..., ge=1, description="Nueva cantidad"),
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -328,34 +349,28 @@ async def update_carrito_item(
 @router_carrito.delete("/items/{item_id}", response_model=CarritoResponse)
 async def remove_carrito_item(
     item_id: int,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
     Eliminar item del carrito (B-03)
     """
     result = await db.execute(
-        select(CarritoItem)
-        .options(joinedload(CarritoItem.extras))
+        select(CarritoItem.id)
         .join(Carrito)
         .where(
             CarritoItem.id == item_id,
             Carrito.user_id == current_user.id
         )
     )
-    item = result.unique().scalar_one_or_none()
     
-    if not item:
+    if result.scalar_one_or_none() is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Item no encontrado en el carrito"
         )
     
-    # Limpiar extras primero
-    item.extras = []
-    await db.flush()
-    
-    await db.delete(item)
+    await eliminar_items_carrito(db, [item_id])
     await db.commit()
     
     return await get_carrito(current_user, db)
@@ -363,7 +378,7 @@ async def remove_carrito_item(
 
 @router_carrito.delete("", response_model=Response)
 async def clear_carrito(
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """Vaciar carrito completamente"""
@@ -371,23 +386,10 @@ async def clear_carrito(
     carrito = result.scalar_one_or_none()
     
     if carrito:
-        # Obtener items con sus extras
         result = await db.execute(
-            select(CarritoItem)
-            .options(joinedload(CarritoItem.extras))
-            .where(CarritoItem.carrito_id == carrito.id)
+            select(CarritoItem.id).where(CarritoItem.carrito_id == carrito.id)
         )
-        items = result.unique().scalars().all()
-        
-        # Limpiar extras de cada item primero
-        for item in items:
-            item.extras = []
-        await db.flush()
-        
-        # Ahora eliminar los items
-        for item in items:
-            await db.delete(item)
-        
+        await eliminar_items_carrito(db, result.scalars().all())
         await db.commit()
     
     return Response(status=200, message="Carrito vaciado exitosamente")
@@ -408,20 +410,11 @@ async def validar_direccion(
     Coordenadas de la pizzería (ejemplo):
     Latitud: -33.4489, Longitud: -70.6693 (Santiago, Chile)
     """
-    # Coordenadas de la pizzería (configurar según ubicación real)
-    pizzeria_lat = Decimal("-33.4489")
-    pizzeria_lon = Decimal("-70.6693")
-    
-    # Calcular distancia
-    distancia = calcular_distancia_km(
-        pizzeria_lat,
-        pizzeria_lon,
-        direccion_data.latitud,
-        direccion_data.longitud
-    )
+    # Calcular distancia desde la pizzería
+    distancia = calcular_distancia_km(direccion_data.latitud, direccion_data.longitud)
     
     # Validar cobertura
-    dentro_cobertura = distancia <= Decimal(str(settings.RADIO_COBERTURA_KM))
+    dentro_cobertura = distancia <= settings.RADIO_COBERTURA_KM
     
     if not dentro_cobertura:
         return ValidacionDireccionResponse(
@@ -443,7 +436,7 @@ async def validar_direccion(
 
 @router_pedidos.get("/resumen", response_model=ResumenPedidoResponse)
 async def get_resumen_pedido(
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -498,7 +491,7 @@ async def get_resumen_pedido(
 async def create_pedido(
     pedido_data: PedidoCreate,
     background_tasks: BackgroundTasks,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -604,17 +597,12 @@ async def create_pedido(
     # Calcular ETA si hay coordenadas (E-04, E-05)
     eta_minutos = None
     if pedido_data.detalle_entrega.latitud and pedido_data.detalle_entrega.longitud:
-        pizzeria_lat = Decimal("-33.4489")
-        pizzeria_lon = Decimal("-70.6693")
-        
         distancia = calcular_distancia_km(
-            pizzeria_lat,
-            pizzeria_lon,
             pedido_data.detalle_entrega.latitud,
             pedido_data.detalle_entrega.longitud
         )
         
-        if distancia > Decimal(str(settings.RADIO_COBERTURA_KM)):
+        if distancia > settings.RADIO_COBERTURA_KM:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"La dirección está fuera del radio de cobertura ({settings.RADIO_COBERTURA_KM} km)"
@@ -669,23 +657,19 @@ async def create_pedido(
     )
     db.add(email_confirmacion)
     
-    # Vaciar carrito - primero limpiar extras, luego items
-    for item in items:
-        # Limpiar la lista de extras del item
-        item.extras = []
-        await db.flush()
-    
-    # Ahora eliminar los items
-    for item in items:
-        await db.delete(item)
+    # Vaciar carrito (extras e items en bloque)
+    await eliminar_items_carrito(db, [item.id for item in items])
     
     await db.commit()
+    invalidar_menu()  # El stock del menú cambió
     await db.refresh(nuevo_pedido)
     
     # Enviar email de confirmación en segundo plano (B-12)
+    email_id = email_confirmacion.id
+    
     async def enviar_email_confirmacion():
         try:
-            contenido_html = EmailTemplates.confirmacion_pedido(
+            contenido_html = render_confirmacion_pedido(
                 pedido_id=nuevo_pedido.id,
                 total=float(nuevo_pedido.total),
                 direccion=nuevo_pedido.direccion,
@@ -704,8 +688,10 @@ async def create_pedido(
                 logger.info(f"Email de confirmación enviado para pedido #{nuevo_pedido.id}")
             else:
                 logger.warning(f"No se pudo enviar email de confirmación para pedido #{nuevo_pedido.id}")
+            await registrar_envio_confirmacion(email_id, exito)
         except Exception as e:
             logger.error(f"Error enviando email de confirmación: {str(e)}")
+            await registrar_envio_confirmacion(email_id, False, str(e))
     
     background_tasks.add_task(enviar_email_confirmacion)
     
@@ -719,7 +705,7 @@ async def get_pedidos(
     fecha_hasta: Optional[datetime] = Query(None, description="Fecha fin"),
     page: int = Query(1, ge=1),
     page_size: int = Query(20, ge=1, le=100),
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -762,7 +748,7 @@ async def get_pedidos(
 @router_pedidos.get("/{pedido_id}", response_model=PedidoResponse)
 async def get_pedido(
     pedido_id: int,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -790,7 +776,7 @@ async def update_pedido_estado(
     pedido_id: int,
     estado_update: dict,
     background_tasks: BackgroundTasks,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -835,13 +821,14 @@ async def update_pedido_estado(
     # Actualizar estado
     pedido.estado = nuevo_estado
     await db.commit()
+    invalidar_puede_anular(pedido_id)
     await db.refresh(pedido)
     
     # Enviar email de notificación de cambio de estado (B-12)
     if email_destino and nuevo_estado in ["confirmado", "en_preparacion", "en_camino", "entregado"]:
         async def enviar_email_estado():
             try:
-                contenido_html = EmailTemplates.cambio_estado_pedido(
+                contenido_html = render_cambio_estado_pedido(
                     pedido_id=pedido_id,
                     estado=nuevo_estado,
                     nombre_cliente=nombre_cliente
@@ -3,13 +3,18 @@ Router de Notificaciones y Campañas
 Implementa: B-08, B-12, B-13, B-14
 """
 from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_, or_
+from sqlalchemy.orm import contains_eager
+from sqlalchemy import select, update, and_, or_, func, lambda_stmt
 from typing import List, Optional
-from datetime import datetime
+from functools import lru_cache
+from html import escape
+import asyncio
 import logging
 
-from database import get_db
+from database import get_db, AsyncSessionLocal, dialect_insert
+from routers.anulaciones import invalidar_puede_anular
 from models import (
     ColaImpresion, EmailConfirmacion, PreferenciaPromo,
     CampaniaSegmentada, Usuario, Pedido
@@ -21,12 +26,15 @@ from schemas import (
     CampaignInput, CampaniaResponse,
     Response
 )
-from auth import get_current_user, require_admin, require_cocinero
+from auth import get_current_user, require_admin, require_cocinero, UsuarioActual
 from config import settings
-from services.email_service import email_service, EmailTemplates
+from services.email_service import email_service, render_confirmacion_pedido, render_promocion_campania, MARCADOR_NOMBRE
 
 logger = logging.getLogger(__name__)
 
+# Clientes leídos del cursor y despachados por lote (los envíos del lote van en paralelo)
+LOTE_ENVIO_CAMPANIA = 500
+
 router_impresion = APIRouter(prefix="/api/v1/impresion", tags=["Impresión"])
 router_notificaciones = APIRouter(prefix="/api/v1/notificaciones", tags=["Notificaciones"])
 router_campanias = APIRouter(prefix="/api/v1/campanias", tags=["Campañas"])
@@ -39,7 +47,7 @@ router_campanias = APIRouter(prefix="/api/v1/campanias", tags=["Campañas"])
 @router_impresion.get("/cola", response_model=List[ImpresionResponse])
 async def get_cola_impresion(
     estado: Optional[str] = None,
-    current_user: Usuario = Depends(require_cocinero),
+    current_user: UsuarioActual = Depends(require_cocinero),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -47,21 +55,25 @@ async def get_cola_impresion(
     
     Estados: pendiente, impreso, error
     """
-    query = select(ColaImpresion).order_by(ColaImpresion.fecha_envio_cocina)
+    query = lambda_stmt(
+        lambda: select(
+            ColaImpresion.id, ColaImpresion.pedido_id, ColaImpresion.estado,
+            ColaImpresion.fecha_envio_cocina, ColaImpresion.fecha_impresion
+        ).order_by(ColaImpresion.fecha_envio_cocina)
+    )
     
     if estado:
-        query = query.where(ColaImpresion.estado == estado)
+        query += lambda s: s.where(ColaImpresion.estado == estado)
     
+    # Filas como dicts directo a orjson (sin objetos ORM ni validación)
     result = await db.execute(query)
-    cola = result.scalars().all()
-    
-    return cola
+    return ORJSONResponse([dict(row) for row in result.mappings()])
 
 
 @router_impresion.post("/{pedido_id}/imprimir", response_model=ImpresionResponse)
 async def marcar_como_impreso(
     pedido_id: int,
-    current_user: Usuario = Depends(require_cocinero),
+    current_user: UsuarioActual = Depends(require_cocinero),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -70,7 +82,10 @@ async def marcar_como_impreso(
     Actualiza el estado en la cola de impresión
     """
     result = await db.execute(
-        select(ColaImpresion).where(ColaImpresion.pedido_id == pedido_id)
+        update(ColaImpresion)
+        .where(ColaImpresion.pedido_id == pedido_id)
+        .values(estado="impreso", fecha_impresion=func.now())
+        .returning(ColaImpresion)
     )
     cola_item = result.scalar_one_or_none()
     
@@ -80,18 +95,15 @@ async def marcar_como_impreso(
             detail="Pedido no encontrado en cola de impresión"
         )
     
-    cola_item.estado = "impreso"
-    cola_item.fecha_impresion = datetime.utcnow()
-    
-    # Actualizar estado del pedido
-    result = await db.execute(select(Pedido).where(Pedido.id == pedido_id))
-    pedido = result.scalar_one_or_none()
-    
-    if pedido and pedido.estado == "pendiente":
-        pedido.estado = "preparando"
+    # Actualizar estado del pedido: UPDATE condicional, atómico en la misma transacción
+    await db.execute(
+        update(Pedido)
+        .where(Pedido.id == pedido_id, Pedido.estado == "pendiente")
+        .values(estado="preparando")
+    )
     
     await db.commit()
-    await db.refresh(cola_item)
+    invalidar_puede_anular(pedido_id)
     
     return cola_item
 
@@ -99,14 +111,17 @@ async def marcar_como_impreso(
 @router_impresion.post("/{pedido_id}/reimprimir", response_model=ImpresionResponse)
 async def reimprimir_pedido(
     pedido_id: int,
-    current_user: Usuario = Depends(require_cocinero),
+    current_user: UsuarioActual = Depends(require_cocinero),
     db: AsyncSession = Depends(get_db)
 ):
     """
     Reintentar impresión de un pedido (B-08)
     """
     result = await db.execute(
-        select(ColaImpresion).where(ColaImpresion.pedido_id == pedido_id)
+        update(ColaImpresion)
+        .where(ColaImpresion.pedido_id == pedido_id)
+        .values(estado="pendiente", reintentos=ColaImpresion.reintentos + 1)
+        .returning(ColaImpresion)
     )
     cola_item = result.scalar_one_or_none()
     
@@ -116,11 +131,7 @@ async def reimprimir_pedido(
             detail="Pedido no encontrado en cola de impresión"
         )
     
-    cola_item.estado = "pendiente"
-    cola_item.reintentos += 1
-    
     await db.commit()
-    await db.refresh(cola_item)
     
     # TODO: Integrar con sistema de impresión real
     
@@ -131,45 +142,38 @@ async def reimprimir_pedido(
 # ENDPOINTS DE EMAILS (B-12)
 # ============================================
 
-@router_notificaciones.post("/email-confirmacion", response_model=EmailConfirmacionResponse)
-async def enviar_email_confirmacion(
-    email_data: EmailConfirmacionInput,
-    background_tasks: BackgroundTasks,
-    db: AsyncSession = Depends(get_db)
-):
-    """
-    Enviar email de confirmación de pedido (B-12)
+async def registrar_envio_confirmacion(email_id: int, exito: bool, error: Optional[str] = None):
     """
-    # Verificar que el pedido existe
-    result = await db.execute(select(Pedido).where(Pedido.id == email_data.pedido_id))
-    pedido = result.scalar_one_or_none()
-    
-    if not pedido:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Pedido no encontrado"
-        )
-    
-    # Buscar registro de email existente
-    result = await db.execute(
-        select(EmailConfirmacion).where(EmailConfirmacion.pedido_id == email_data.pedido_id)
-    )
-    email_confirmacion = result.scalar_one_or_none()
+    Guardar el resultado del envío de una confirmación (B-12)
     
-    if not email_confirmacion:
-        # Crear nuevo registro
-        email_confirmacion = EmailConfirmacion(
-            pedido_id=email_data.pedido_id,
-            email_destino=email_data.email_destino,
-            asunto=f"Confirmación de pedido #{email_data.pedido_id} - Pizzería La Fornace",
-            enviado=False
-        )
-        db.add(email_confirmacion)
-        await db.flush()
+    Corre después de la respuesta con una sesión propia (nunca la del request):
+    el cliente no espera este commit.
+    """
+    if exito:
+        valores = {"enviado": True, "fecha_envio": func.now(), "error_mensaje": None}
+    else:
+        valores = {"error_mensaje": error or "No se pudo enviar el email"}
     
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(EmailConfirmacion).where(EmailConfirmacion.id == email_id).values(**valores)
+            )
+            await db.commit()
+    except Exception as e:
+        logger.error(f"Error registrando envío de confirmación #{email_id}: {str(e)}")
+
+
+def _programar_email_confirmacion(
+    pedido: Pedido,
+    email_confirmacion: EmailConfirmacion,
+    email_destino: str,
+    background_tasks: BackgroundTasks
+):
+    """Generar el email de confirmación del pedido y enviarlo en segundo plano (B-12)"""
     # Generar contenido del email usando el servicio
     items = pedido.items_json.get("items", []) if pedido.items_json else []
-    contenido_html = EmailTemplates.confirmacion_pedido(
+    contenido_html = render_confirmacion_pedido(
         pedido_id=pedido.id,
         total=float(pedido.total),
         direccion=pedido.direccion or "No especificada",
@@ -177,26 +181,63 @@ async def enviar_email_confirmacion(
         items=items,
         nombre_cliente="Cliente"
     )
-    
-    # Guardar referencia para actualizar estado después del envío
+    asunto = email_confirmacion.asunto
     email_id = email_confirmacion.id
-    email_destino = email_data.email_destino
     
     # Enviar email en segundo plano
     async def enviar_email_task():
         try:
             exito = await email_service.send_email(
                 destinatario=email_destino,
-                asunto=email_confirmacion.asunto,
+                asunto=asunto,
                 contenido_html=contenido_html
             )
             
-            # Actualizar registro (nota: esto puede tener problemas de sesión, pero es aceptable para este caso)
             logger.info(f"Email confirmación enviado: {exito}")
+            await registrar_envio_confirmacion(email_id, exito)
         except Exception as e:
             logger.error(f"Error enviando email de confirmación: {str(e)}")
+            await registrar_envio_confirmacion(email_id, False, str(e))
     
     background_tasks.add_task(enviar_email_task)
+
+
+@router_notificaciones.post("/email-confirmacion", response_model=EmailConfirmacionResponse)
+async def enviar_email_confirmacion(
+    email_data: EmailConfirmacionInput,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Enviar email de confirmación de pedido (B-12)
+    """
+    # Pedido y su registro de email (si existe) en una sola consulta
+    result = await db.execute(
+        select(Pedido, EmailConfirmacion)
+        .outerjoin(EmailConfirmacion, EmailConfirmacion.pedido_id == Pedido.id)
+        .where(Pedido.id == email_data.pedido_id)
+        .limit(1)
+    )
+    pedido, email_confirmacion = result.first() or (None, None)
+    
+    if not pedido:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Pedido no encontrado"
+        )
+    
+    if not email_confirmacion:
+        # Crear nuevo registro
+        email_confirmacion = EmailConfirmacion(
+            pedido_id=email_data.pedido_id,
+            email_destino=email_data.email_destino,
+            asunto=f"Confirmación de pedido #{email_data.pedido_id} - Pizzería La Fornace",
+            enviado=False
+        )
+        db.add(email_confirmacion)
+        await db.commit()
+    
+    _programar_email_confirmacion(pedido, email_confirmacion, email_data.email_destino, background_tasks)
     
     return email_confirmacion
 
@@ -205,25 +246,18 @@ async def enviar_email_confirmacion(
 async def reenviar_email_confirmacion(
     pedido_id: int,
     background_tasks: BackgroundTasks,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
     Reenviar email de confirmación (B-12)
     """
     # Verificar que el pedido pertenece al usuario o es admin
-    if current_user.rol in ["admin", "administrador"]:
-        result = await db.execute(
-            select(Pedido).where(Pedido.id == pedido_id)
-        )
-    else:
-        result = await db.execute(
-            select(Pedido).where(
-                Pedido.id == pedido_id,
-                Pedido.user_id == current_user.id
-            )
-        )
+    query = select(Pedido).where(Pedido.id == pedido_id)
+    if current_user.rol not in ["admin", "administrador"]:
+        query = query.where(Pedido.user_id == current_user.id)
     
+    result = await db.execute(query)
     pedido = result.scalar_one_or_none()
     
     if not pedido:
@@ -232,15 +266,30 @@ async def reenviar_email_confirmacion(
             detail="Pedido no encontrado"
         )
     
-    # Reenviar email
-    return await enviar_email_confirmacion(
-        EmailConfirmacionInput(
-            pedido_id=pedido_id,
-            email_destino=current_user.email
-        ),
-        background_tasks,
-        db
+    # Marcar el registro existente para reenvío en una sola sentencia
+    result = await db.execute(
+        update(EmailConfirmacion)
+        .where(EmailConfirmacion.pedido_id == pedido_id)
+        .values(enviado=False, reintentos=EmailConfirmacion.reintentos + 1)
+        .returning(EmailConfirmacion)
     )
+    email_confirmacion = result.scalars().first()
+    
+    if not email_confirmacion:
+        email_confirmacion = EmailConfirmacion(
+            pedido_id=pedido_id,
+            email_destino=current_user.email,
+            asunto=f"Confirmación de pedido #{pedido_id} - Pizzería La Fornace",
+            enviado=False
+        )
+        db.add(email_confirmacion)
+    
+    await db.commit()
+    
+    # Reenviar email
+    _programar_email_confirmacion(pedido, email_confirmacion, current_user.email, background_tasks)
+    
+    return email_confirmacion
 
 
 # ============================================
@@ -249,7 +298,7 @@ async def reenviar_email_confirmacion(
 
 @router_campanias.get("/preferencias", response_model=PreferenciaPromoResponse)
 async def get_preferencias_promo(
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -261,16 +310,27 @@ async def get_preferencias_promo(
     preferencias = result.scalar_one_or_none()
     
     if not preferencias:
-        # Crear preferencias por defecto
-        preferencias = PreferenciaPromo(
-            cliente_id=current_user.id,
-            email_opt_in=True,
-            sms_opt_in=False,
-            whatsapp_opt_in=False
+        # Crear preferencias por defecto; ON CONFLICT evita el error si otra
+        # pestaña del mismo usuario las creó en paralelo
+        result = await db.execute(
+            dialect_insert(PreferenciaPromo)
+            .values(
+                cliente_id=current_user.id,
+                email_opt_in=True,
+                sms_opt_in=False,
+                whatsapp_opt_in=False
+            )
+            .on_conflict_do_nothing(index_elements=["cliente_id"])
+            .returning(PreferenciaPromo)
         )
-        db.add(preferencias)
+        preferencias = result.scalar_one_or_none()
         await db.commit()
-        await db.refresh(preferencias)
+        
+        if not preferencias:
+            result = await db.execute(
+                select(PreferenciaPromo).where(PreferenciaPromo.cliente_id == current_user.id)
+            )
+            preferencias = result.scalar_one()
     
     return preferencias
 
@@ -278,7 +338,7 @@ async def get_preferencias_promo(
 @router_campanias.put("/preferencias", response_model=PreferenciaPromoResponse)
 async def update_preferencias_promo(
     preferencias_update: PreferenciaPromoInput,
-    current_user: Usuario = Depends(get_current_user),
+    current_user: UsuarioActual = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -289,24 +349,28 @@ async def update_preferencias_promo(
     - SMS marketing
     - WhatsApp marketing
     """
-    result = await db.execute(
-        select(PreferenciaPromo).where(PreferenciaPromo.cliente_id == current_user.id)
-    )
-    preferencias = result.scalar_one_or_none()
-    
-    if not preferencias:
-        preferencias = PreferenciaPromo(cliente_id=current_user.id)
-        db.add(preferencias)
-    
-    # Actualizar preferencias
     update_data = preferencias_update.model_dump(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(preferencias, field, value)
     
-    preferencias.fecha_ultima_actualizacion = datetime.utcnow()
+    # Upsert en una sola sentencia: crea las preferencias si no existen
+    query = dialect_insert(PreferenciaPromo).values(cliente_id=current_user.id, **update_data)
+    if update_data:
+        query = query.on_conflict_do_update(
+            index_elements=["cliente_id"],
+            set_={**update_data, "fecha_ultima_actualizacion": func.now()}
+        )
+    else:
+        query = query.on_conflict_do_nothing(index_elements=["cliente_id"])
     
+    result = await db.execute(query.returning(PreferenciaPromo))
+    preferencias = result.scalar_one_or_none()
     await db.commit()
-    await db.refresh(preferencias)
+    
+    if not preferencias:
+        # Sin cambios y ya existían: solo leerlas
+        result = await db.execute(
+            select(PreferenciaPromo).where(PreferenciaPromo.cliente_id == current_user.id)
+        )
+        preferencias = result.scalar_one()
     
     return preferencias
 
@@ -318,7 +382,7 @@ async def update_preferencias_promo(
 @router_campanias.post("", response_model=CampaniaResponse, status_code=status.HTTP_201_CREATED)
 async def crear_campania(
     campania_data: CampaignInput,
-    current_user: Usuario = Depends(require_admin),
+    current_user: UsuarioActual = Depends(require_admin),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -352,7 +416,7 @@ async def crear_campania(
 async def enviar_campania(
     campania_id: int,
     background_tasks: BackgroundTasks,
-    current_user: Usuario = Depends(require_admin),
+    current_user: UsuarioActual = Depends(require_admin),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -376,114 +440,163 @@ async def enviar_campania(
             detail="La campaña ya fue enviada"
         )
     
-    # Obtener clientes que cumplen criterios
-    clientes = await obtener_clientes_segmentados(campania.criterios_json, db)
-    
-    # Filtrar por preferencias de email
-    clientes_filtrados = []
-    for cliente in clientes:
-        result = await db.execute(
-            select(PreferenciaPromo).where(PreferenciaPromo.cliente_id == cliente.id)
-        )
-        preferencias = result.scalar_one_or_none()
-        
-        # Si no tiene preferencias, asumimos que acepta emails por defecto
-        # Si tiene preferencias, verificamos email_opt_in
-        if not preferencias or preferencias.email_opt_in:
-            clientes_filtrados.append(cliente)
-    
-    # Preparar datos para el envío
-    emails_destinatarios = [c.email for c in clientes_filtrados if c.email]
-    mensaje_campania = campania.mensaje
-    nombre_campania = campania.nombre
-    
-    # Enviar notificaciones en segundo plano
-    async def enviar_notificaciones_task():
-        try:
-            enviados = 0
-            for cliente in clientes_filtrados:
-                if not cliente.email:
-                    continue
-                
-                # Usar plantilla de promoción
-                contenido_html = EmailTemplates.promocion(
-                    asunto=nombre_campania,
-                    mensaje=mensaje_campania,
-                    nombre_cliente=cliente.nombre or "Cliente"
-                )
-                
-                exito = await email_service.send_email(
-                    destinatario=cliente.email,
-                    asunto=f"🍕 {nombre_campania}",
-                    contenido_html=contenido_html
-                )
-                
-                if exito:
-                    enviados += 1
-            
-            logger.info(f"Campaña #{campania_id} enviada: {enviados}/{len(clientes_filtrados)} emails")
-        except Exception as e:
-            logger.error(f"Error enviando campaña #{campania_id}: {str(e)}")
-    
-    background_tasks.add_task(enviar_notificaciones_task)
+    # Contar destinatarios; la tarea vuelve a consultarlos con su propia sesión
+    cliente_count = await contar_clientes_segmentados(campania.criterios_json, db)
     
     # Actualizar estado de la campaña
     campania.estado = "enviada"
-    campania.fecha_envio = datetime.utcnow()
-    campania.cliente_count = len(clientes_filtrados)
+    campania.fecha_envio = func.now()
+    campania.cliente_count = cliente_count
     await db.commit()
     
+    # Enviar notificaciones en segundo plano (solo se pasa el id, no objetos ORM)
+    background_tasks.add_task(enviar_campania_task, campania_id)
+    
     return Response(
         status=200,
-        message=f"Campaña programada para envío a {len(clientes_filtrados)} clientes"
+        message=f"Campaña programada para envío a {cliente_count} clientes"
     )
 
 
 @router_campanias.get("", response_model=List[CampaniaResponse])
 async def get_campanias(
     estado: Optional[str] = None,
-    current_user: Usuario = Depends(require_admin),
+    current_user: UsuarioActual = Depends(require_admin),
     db: AsyncSession = Depends(get_db)
 ):
     """
     Obtener listado de campañas (B-14)
     """
-    query = select(CampaniaSegmentada).order_by(CampaniaSegmentada.fecha_creacion.desc())
+    query = lambda_stmt(
+        lambda: select(
+            CampaniaSegmentada.id, CampaniaSegmentada.nombre, CampaniaSegmentada.criterios_json,
+            CampaniaSegmentada.mensaje, CampaniaSegmentada.canal, CampaniaSegmentada.estado,
+            CampaniaSegmentada.cliente_count, CampaniaSegmentada.fecha_creacion,
+            CampaniaSegmentada.fecha_envio
+        ).order_by(CampaniaSegmentada.fecha_creacion.desc())
+    )
     
     if estado:
-        query = query.where(CampaniaSegmentada.estado == estado)
+        query += lambda s: s.where(CampaniaSegmentada.estado == estado)
     
+    # Filas como dicts directo a orjson (sin objetos ORM ni validación)
     result = await db.execute(query)
-    campanias = result.scalars().all()
-    
-    return campanias
+    return ORJSONResponse([dict(row) for row in result.mappings()])
 
 
 # ============================================
 # UTILIDADES
 # ============================================
 
-async def calcular_clientes_segmentados(criterios: dict, db: AsyncSession) -> int:
-    """Calcular cantidad de clientes que cumplen criterios de segmentación"""
+def _criterios_key(criterios: dict) -> tuple:
+    """Clave hashable con las reglas de segmentación que afectan la consulta"""
+    return (bool(criterios.get("email_verificado")),)
+
+
+@lru_cache(maxsize=64)
+def _segment_stmt(criterios_key: tuple):
+    """Clientes del segmento: única fuente de las reglas de segmentación"""
+    (email_verificado,) = criterios_key
     query = select(Usuario).where(Usuario.rol == "cliente", Usuario.activo == True)
     
     # Aplicar criterios (ejemplo simple)
-    if criterios.get("email_verificado"):
+    if email_verificado:
         query = query.where(Usuario.email_verificado == True)
     
-    result = await db.execute(query)
-    clientes = result.scalars().all()
-    
-    return len(clientes)
+    return query
 
 
-async def obtener_clientes_segmentados(criterios: dict, db: AsyncSession) -> List[Usuario]:
-    """Obtener clientes que cumplen criterios de segmentación"""
-    query = select(Usuario).where(Usuario.rol == "cliente", Usuario.activo == True)
+@lru_cache(maxsize=64)
+def _destinatarios_stmt(criterios_key: tuple):
+    """
+    Clientes del segmento que aceptan emails
     
-    # Aplicar criterios
-    if criterios.get("email_verificado"):
-        query = query.where(Usuario.email_verificado == True)
+    Sin preferencias registradas se asume que el cliente acepta emails.
+    """
+    return (
+        _segment_stmt(criterios_key)
+        .outerjoin(PreferenciaPromo, PreferenciaPromo.cliente_id == Usuario.id)
+        .where(
+            Usuario.email.isnot(None),
+            or_(PreferenciaPromo.id.is_(None), PreferenciaPromo.email_opt_in == True)
+        )
+    )
+
+
+async def calcular_clientes_segmentados(criterios: dict, db: AsyncSession) -> int:
+    """Calcular cantidad de clientes que cumplen criterios de segmentación"""
+    query = _segment_stmt(_criterios_key(criterios)).with_only_columns(func.count(Usuario.id))
+    result = await db.execute(query)
+    return result.scalar_one()
+
+
+async def stream_clientes_segmentados(criterios: dict, db: AsyncSession):
+    """
+    Recorrer por lotes los clientes que cumplen criterios y aceptan emails
     
+    Cursor del lado del servidor: en memoria solo hay LOTE_ENVIO_CAMPANIA
+    clientes a la vez. Uso: ``async for lote in resultado.partitions()``.
+    """
+    # Las preferencias vienen en el mismo LEFT JOIN (sin consultas extra por cliente)
+    query = (
+        _destinatarios_stmt(_criterios_key(criterios))
+        .options(contains_eager(Usuario.preferencias_promo))
+        .execution_options(yield_per=LOTE_ENVIO_CAMPANIA)
+    )
+    return await db.stream_scalars(query)
+
+
+async def contar_clientes_segmentados(criterios: dict, db: AsyncSession) -> int:
+    """Contar en SQL los destinatarios de una campaña"""
+    query = _destinatarios_stmt(_criterios_key(criterios)).with_only_columns(func.count(Usuario.id))
     result = await db.execute(query)
-    return result.scalars().all()
+    return result.scalar_one()
+
+
+async def enviar_campania_task(campania_id: int):
+    """
+    Enviar por email una campaña ya marcada como enviada (B-14)
+    
+    Se ejecuta después de la respuesta, con una sesión propia: la sesión del
+    request ya está cerrada y no se comparten objetos ORM entre ambas. La
+    sesión sigue abierta mientras se consume el cursor de destinatarios.
+    """
+    try:
+        async with AsyncSessionLocal() as db:
+            campania = await db.get(CampaniaSegmentada, campania_id)
+            if not campania:
+                return
+            nombre_campania = campania.nombre
+            mensaje_campania = campania.mensaje
+            
+            sem = asyncio.Semaphore(settings.EMAIL_CONCURRENCY)
+            
+            # Plantilla de promoción renderizada una vez; por cliente solo el nombre
+            html_base = render_promocion_campania(nombre_campania, mensaje_campania)
+            
+            async def _send_one(cliente: Usuario) -> bool:
+                async with sem:
+                    contenido_html = html_base.replace(
+                        MARCADOR_NOMBRE, escape(cliente.nombre or "Cliente")
+                    )
+                    
+                    return await email_service.send_email(
+                        destinatario=cliente.email,
+                        asunto=f"🍕 {nombre_campania}",
+                        contenido_html=contenido_html
+                    )
+            
+            enviados = 0
+            total = 0
+            clientes = await stream_clientes_segmentados(campania.criterios_json, db)
+            async for lote in clientes.partitions():
+                resultados = await asyncio.gather(
+                    *(_send_one(cliente) for cliente in lote),
+                    return_exceptions=True
+                )
+                enviados += sum(1 for exito in resultados if exito is True)
+                total += len(lote)
+        
+        logger.info(f"Campaña #{campania_id} enviada: {enviados}/{total} emails")
+    except Exception as e:
+        logger.error(f"Error enviando campaña #{campania_id}: {str(e)}")
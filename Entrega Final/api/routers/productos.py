@@ -2,14 +2,20 @@
 Router de Productos y Menú
 Implementa: B-06, B-07, E-03
 """
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request
+from fastapi.responses import ORJSONResponse, Response as RawResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, or_, and_
-from sqlalchemy.orm import selectinload
-from typing import List, Optional
+from sqlalchemy import select, update, delete, insert, literal, or_, lambda_stmt
+from sqlalchemy.orm import selectinload, raiseload
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from cachetools import LRUCache, TTLCache
+from itertools import groupby
+from typing import Awaitable, Callable, List, Optional
+import hashlib
+import logging
 
 from database import get_db
-from models import Producto, Categoria, Tamanio, Extra, Usuario
+from models import Producto, Categoria, Tamanio, Extra, producto_extras
 from schemas import (
     ProductoCreate, ProductoUpdate, ProductoResponse,
     CategoriaCreate, CategoriaResponse,
@@ -17,10 +23,125 @@ from schemas import (
     ExtraResponse, ExtraCreate, ExtraUpdate,
     MenuQueryInput, Response
 )
-from auth import get_current_user, require_admin
+from auth import get_current_user, require_admin, UsuarioActual
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/v1/productos", tags=["Productos"])
 
+# Carga de Extra.productos solo con el id (lo único que usa productos_ids)
+EXTRA_PRODUCTOS_IDS = selectinload(Extra.productos).load_only(Producto.id)
+
+# Cache en proceso del catálogo (lectura dominante): cuerpo JSON ya codificado + ETag.
+# Se vacía en cada escritura; el TTL acota lo desfasado entre workers.
+MENU_CACHE_TTL = 60
+_menu_cache: TTLCache = TTLCache(maxsize=256, ttl=MENU_CACHE_TTL)
+
+# Última versión buena de cada clave (sin TTL): se sirve si la BD falla
+_menu_respaldo: LRUCache = LRUCache(maxsize=256)
+
+
+def invalidar_menu() -> None:
+    """Vaciar el cache del catálogo (categorías, productos, tamaños, extras) tras una escritura"""
+    _menu_cache.clear()
+
+
+async def _menu_cacheado(
+    request: Request,
+    cache_key: tuple,
+    cargar: Callable[[], Awaitable]
+) -> RawResponse:
+    """
+    Respuesta del catálogo desde el cache; en un miss se ejecuta ``cargar``
+    
+    ``cargar`` devuelve dicts/listas serializables por orjson; se codifican
+    una sola vez y se guardan los bytes junto a su ETag, de modo que un hit no
+    pasa por la BD, Pydantic ni el encoder, y un cliente con la misma versión
+    recibe 304 sin cuerpo. Si la BD falla se sirve la última versión buena
+    (stale-on-error).
+    """
+    entrada = _menu_cache.get(cache_key)
+    if entrada is None:
+        try:
+            cuerpo = ORJSONResponse(await cargar()).body
+        except SQLAlchemyError:
+            entrada = _menu_respaldo.get(cache_key)
+            if entrada is None:
+                raise
+            logger.warning(f"BD no disponible, sirviendo catálogo en cache: {cache_key[0]}")
+        else:
+            etag = f'W/"{hashlib.blake2s(cuerpo, digest_size=16).hexdigest()}"'
+            entrada = (cuerpo, etag)
+            _menu_cache[cache_key] = entrada
+            _menu_respaldo[cache_key] = entrada
+    
+    cuerpo, etag = entrada
+    if request.headers.get("if-none-match") == etag:
+        return RawResponse(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    
+    return RawResponse(content=cuerpo, media_type="application/json", headers={"ETag": etag})
+
+
+def _producto_a_dict(row) -> dict:
+    """Fila Core (producto + categoría) con la forma de ProductoResponse"""
+    return {
+        "id": row.id,
+        "nombre": row.nombre,
+        "descripcion": row.descripcion,
+        "precio": str(row.precio),
+        "categoria_id": row.categoria_id,
+        "image_url": row.image_url,
+        "disponible": row.disponible,
+        "stock": row.stock,
+        "activo": row.activo,
+        "fecha_creacion": row.fecha_creacion,
+        "categoria": {
+            "id": row.categoria_id,
+            "nombre": row.categoria_nombre,
+            "descripcion": row.categoria_descripcion,
+            "activo": row.categoria_activo,
+        },
+    }
+
+
+def _tamanio_a_dict(tamanio: Tamanio) -> dict:
+    """Tamaño con la forma de TamanioResponse"""
+    return {
+        "id": tamanio.id,
+        "nombre": tamanio.nombre,
+        "precio_adicional": str(tamanio.precio_adicional),
+        "activo": tamanio.activo,
+    }
+
+
+def _extra_a_dict(extra: Extra, productos_ids: Optional[List[int]] = None) -> dict:
+    """Extra con la forma de ExtraResponse (sin productos_ids requiere Extra.productos cargado)"""
+    return {
+        "id": extra.id,
+        "nombre": extra.nombre,
+        "precio": str(extra.precio),
+        "disponible": extra.disponible,
+        "activo": extra.activo,
+        "productos_ids": extra.productos_ids if productos_ids is None else productos_ids,
+    }
+
+
+async def _insertar_productos_extra(db: AsyncSession, extra_id: int, productos_ids: List[int]) -> List[int]:
+    """
+    Asociar productos a un extra con un solo INSERT ... SELECT
+    
+    Solo se insertan los ids de productos existentes; devuelve los asociados.
+    """
+    if not productos_ids:
+        return []
+    result = await db.execute(
+        insert(producto_extras).from_select(
+            ["producto_id", "extra_id"],
+            select(Producto.id, literal(extra_id)).where(Producto.id.in_(productos_ids))
+        ).returning(producto_extras.c.producto_id)
+    )
+    return list(result.scalars())
+
 
 # ============================================
 # ENDPOINTS DE CATEGORÍAS
@@ -28,38 +149,41 @@ router = APIRouter(prefix="/api/v1/productos", tags=["Productos"])
 
 @router.get("/categorias", response_model=List[CategoriaResponse])
 async def get_categorias(
+    request: Request,
     db: AsyncSession = Depends(get_db)
 ):
     """Obtener todas las categorías activas"""
-    result = await db.execute(
-        select(Categoria).where(Categoria.activo == True).order_by(Categoria.nombre)
-    )
-    categorias = result.scalars().all()
-    return categorias
+    async def cargar() -> list:
+        # Columnas sueltas (sin objetos ORM) directo a dicts serializables por orjson
+        result = await db.execute(
+            select(Categoria.id, Categoria.nombre, Categoria.descripcion, Categoria.activo)
+            .where(Categoria.activo == True)
+            .order_by(Categoria.nombre)
+        )
+        return [dict(row) for row in result.mappings()]
+        
+    return await _menu_cacheado(request, ("categorias",), cargar)
 
 
 @router.post("/categorias", response_model=CategoriaResponse, status_code=status.HTTP_201_CREATED)
 async def create_categoria(
     categoria_data: CategoriaCreate,
     db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_admin)
+    current_user: UsuarioActual = Depends(require_admin)
 ):
     """Crear nueva categoría (B-06 - Solo administradores)"""
-    # Verificar que no exista una categoría con el mismo nombre
-    result = await db.execute(
-        select(Categoria).where(Categoria.nombre == categoria_data.nombre)
-    )
-    existing = result.scalar_one_or_none()
-    
-    if existing:
+    # Nombre único garantizado por el índice UNIQUE (sin SELECT previo)
+    nueva_categoria = Categoria(**categoria_data.model_dump())
+    db.add(nueva_categoria)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Ya existe una categoría con ese nombre"
         )
-    
-    nueva_categoria = Categoria(**categoria_data.model_dump())
-    db.add(nueva_categoria)
-    await db.commit()
+    invalidar_menu()
     await db.refresh(nueva_categoria)
     
     return nueva_categoria
@@ -73,7 +197,7 @@ async def create_categoria(
 async def create_producto(
     producto_data: ProductoCreate,
     db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_admin)
+    current_user: UsuarioActual = Depends(require_admin)
 ):
     """
     Crear nuevo producto (B-06 - Solo administradores)
@@ -96,6 +220,7 @@ async def create_producto(
     nuevo_producto = Producto(**producto_data.model_dump())
     db.add(nuevo_producto)
     await db.commit()
+    invalidar_menu()
     await db.refresh(nuevo_producto)
     
     return nuevo_producto
@@ -103,6 +228,7 @@ async def create_producto(
 
 @router.get("", response_model=List[ProductoResponse])
 async def get_productos(
+    request: Request,
     categoria_id: Optional[int] = Query(None, description="Filtrar por categoría"),
     busqueda: Optional[str] = Query(None, description="Buscar en nombre o descripción"),
     solo_disponibles: bool = Query(True, description="Solo productos disponibles"),
@@ -118,39 +244,48 @@ async def get_productos(
     - Solo disponibles
     - Solo activos
     """
-    query = select(Producto).options(selectinload(Producto.categoria))
-    
-    # Aplicar filtros
-    conditions = []
-    
-    if categoria_id:
-        conditions.append(Producto.categoria_id == categoria_id)
-    
-    if solo_disponibles:
-        conditions.append(Producto.disponible == True)
-        conditions.append(Producto.stock > 0)  # E-03: Control de stock
-    
-    if solo_activos:
-        conditions.append(Producto.activo == True)
-    
-    if busqueda:
-        search_pattern = f"%{busqueda}%"
-        conditions.append(
-            or_(
-                Producto.nombre.ilike(search_pattern),
-                Producto.descripcion.ilike(search_pattern)
-            )
+    async def cargar() -> list:
+        # lambda_stmt: el SQL compilado se cachea según la combinación de filtros;
+        # los valores capturados (categoria_id, patrón) viajan como parámetros
+        # Columnas + JOIN a categoría en vez de objetos ORM (sin hidratación ni selectinload)
+        query = lambda_stmt(
+            lambda: select(
+                Producto.id, Producto.nombre, Producto.descripcion, Producto.precio,
+                Producto.categoria_id, Producto.image_url, Producto.disponible,
+                Producto.stock, Producto.activo, Producto.fecha_creacion,
+                Categoria.nombre.label("categoria_nombre"),
+                Categoria.descripcion.label("categoria_descripcion"),
+                Categoria.activo.label("categoria_activo"),
+            ).join(Categoria, Categoria.id == Producto.categoria_id)
         )
-    
-    if conditions:
-        query = query.where(and_(*conditions))
-    
-    query = query.order_by(Producto.nombre)
-    
-    result = await db.execute(query)
-    productos = result.scalars().all()
-    
-    return productos
+        
+        # Aplicar filtros
+        if categoria_id:
+            query += lambda s: s.where(Producto.categoria_id == categoria_id)
+        
+        if solo_disponibles:
+            # E-03: Control de stock
+            query += lambda s: s.where(Producto.disponible == True, Producto.stock > 0)
+        
+        if solo_activos:
+            query += lambda s: s.where(Producto.activo == True)
+        
+        if busqueda:
+            search_pattern = f"%{busqueda}%"
+            query += lambda s: s.where(
+                or_(
+                    Producto.nombre.ilike(search_pattern),
+                    Producto.descripcion.ilike(search_pattern)
+                )
+            )
+        
+        query += lambda s: s.order_by(Producto.nombre)
+        
+        result = await db.execute(query)
+        return [_producto_a_dict(row) for row in result]
+        
+    cache_key = ("productos", categoria_id, busqueda, solo_disponibles, solo_activos)
+    return await _menu_cacheado(request, cache_key, cargar)
 
 
 @router.get("/{producto_id}", response_model=ProductoResponse)
@@ -176,7 +311,7 @@ async def update_producto(
     producto_id: int,
     producto_update: ProductoUpdate,
     db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_admin)
+    current_user: UsuarioActual = Depends(require_admin)
 ):
     """
     Actualizar producto (B-06 - Solo administradores)
@@ -199,6 +334,7 @@ async def update_producto(
         setattr(producto, field, value)
     
     await db.commit()
+    invalidar_menu()
     await db.refresh(producto)
     
     return producto
@@ -208,7 +344,7 @@ async def update_producto(
 async def delete_producto(
     producto_id: int,
     db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_admin)
+    current_user: UsuarioActual = Depends(require_admin)
 ):
     """
     Eliminar (desactivar) producto (B-06 - Solo administradores)
@@ -228,6 +364,7 @@ async def delete_producto(
     producto.disponible = False
     
     await db.commit()
+    invalidar_menu()
     
     return Response(
         status=200,
@@ -240,14 +377,20 @@ async def update_stock(
     producto_id: int,
     cantidad: int = Query(..., description="Nueva cantidad de stock"),
     db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_admin)
+    current_user: UsuarioActual = Depends(require_admin)
 ):
     """
     Actualizar stock de producto (E-03 - Control de stock)
     
     Actualiza la disponibilidad automáticamente según el stock
     """
-    result = await db.execute(select(Producto).options(selectinload(Producto.categoria)).where(Producto.id == producto_id))
+    # Un solo UPDATE atómico que devuelve la fila actualizada
+    result = await db.execute(
+        update(Producto)
+        .where(Producto.id == producto_id)
+        .values(stock=cantidad, disponible=cantidad > 0)
+        .returning(Producto)
+    )
     producto = result.scalar_one_or_none()
     
     if not producto:
@@ -256,11 +399,9 @@ async def update_stock(
             detail="Producto no encontrado"
         )
     
-    producto.stock = cantidad
-    producto.disponible = cantidad > 0
-    
     await db.commit()
-    await db.refresh(producto)
+    invalidar_menu()
+    await db.refresh(producto, attribute_names=["categoria"])
     
     return producto
 
@@ -271,23 +412,26 @@ async def update_stock(
 
 @router.get("/tamanios/list", response_model=List[TamanioResponse])
 async def get_tamanios(
+    request: Request,
     solo_activos: bool = Query(True, description="Solo tamaños activos"),
     db: AsyncSession = Depends(get_db)
 ):
     """Obtener todos los tamaños disponibles"""
-    query = select(Tamanio).order_by(Tamanio.precio_adicional)
-    if solo_activos:
-        query = query.where(Tamanio.activo == True)
-    result = await db.execute(query)
-    tamanios = result.scalars().all()
-    return tamanios
+    async def cargar() -> list:
+        query = select(Tamanio).order_by(Tamanio.precio_adicional)
+        if solo_activos:
+            query = query.where(Tamanio.activo == True)
+        result = await db.execute(query)
+        return [_tamanio_a_dict(t) for t in result.scalars()]
+        
+    return await _menu_cacheado(request, ("tamanios", solo_activos), cargar)
 
 
 @router.post("/tamanios", response_model=TamanioResponse, status_code=status.HTTP_201_CREATED)
 async def create_tamanio(
     tamanio_data: TamanioCreate,
     db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_admin)
+    current_user: UsuarioActual = Depends(require_admin)
 ):
     """
     Crear nuevo tamaño (B-06 - Solo administradores)
@@ -295,21 +439,18 @@ async def create_tamanio(
     Permite crear tamaños de pizza (Personal, Mediana, Familiar, etc.)
     con su precio adicional correspondiente.
     """
-    # Verificar que no exista un tamaño con el mismo nombre
-    result = await db.execute(
-        select(Tamanio).where(Tamanio.nombre == tamanio_data.nombre)
-    )
-    existing = result.scalar_one_or_none()
-    
-    if existing:
+    # Nombre único garantizado por el índice UNIQUE (sin SELECT previo)
+    nuevo_tamanio = Tamanio(**tamanio_data.model_dump())
+    db.add(nuevo_tamanio)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Ya existe un tamaño con ese nombre"
         )
-    
-    nuevo_tamanio = Tamanio(**tamanio_data.model_dump())
-    db.add(nuevo_tamanio)
-    await db.commit()
+    invalidar_menu()
     await db.refresh(nuevo_tamanio)
     
     return nuevo_tamanio
@@ -320,14 +461,30 @@ async def update_tamanio(
     tamanio_id: int,
     tamanio_update: TamanioUpdate,
     db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_admin)
+    current_user: UsuarioActual = Depends(require_admin)
 ):
     """
     Actualizar tamaño (B-06 - Solo administradores)
     
     Permite modificar nombre y precio adicional del tamaño.
     """
-    result = await db.execute(select(Tamanio).where(Tamanio.id == tamanio_id))
+    # Actualizar solo los campos proporcionados
+    update_data = tamanio_update.model_dump(exclude_unset=True)
+    
+    # Un solo UPDATE ... RETURNING; el nombre repetido lo rechaza el índice UNIQUE
+    if update_data:
+        query = update(Tamanio).where(Tamanio.id == tamanio_id).values(**update_data).returning(Tamanio)
+    else:
+        query = select(Tamanio).where(Tamanio.id == tamanio_id)
+    
+    try:
+        result = await db.execute(query)
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Ya existe un tamaño con ese nombre"
+        )
     tamanio = result.scalar_one_or_none()
     
     if not tamanio:
@@ -336,25 +493,8 @@ async def update_tamanio(
             detail="Tamaño no encontrado"
         )
     
-    # Actualizar solo los campos proporcionados
-    update_data = tamanio_update.model_dump(exclude_unset=True)
-    
-    # Si se está cambiando el nombre, verificar que no exista otro con ese nombre
-    if 'nombre' in update_data and update_data['nombre'] != tamanio.nombre:
-        result_check = await db.execute(
-            select(Tamanio).where(Tamanio.nombre == update_data['nombre'])
-        )
-        if result_check.scalar_one_or_none():
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Ya existe un tamaño con ese nombre"
-            )
-    
-    for field, value in update_data.items():
-        setattr(tamanio, field, value)
-    
     await db.commit()
-    await db.refresh(tamanio)
+    invalidar_menu()
     
     return tamanio
 
@@ -363,28 +503,33 @@ async def update_tamanio(
 async def delete_tamanio(
     tamanio_id: int,
     db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_admin)
+    current_user: UsuarioActual = Depends(require_admin)
 ):
     """
     Eliminar (desactivar) tamaño (B-06 - Solo administradores)
     
     No se elimina de la BD, solo se marca como inactivo.
     """
-    result = await db.execute(select(Tamanio).where(Tamanio.id == tamanio_id))
-    tamanio = result.scalar_one_or_none()
+    result = await db.execute(
+        update(Tamanio)
+        .where(Tamanio.id == tamanio_id)
+        .values(activo=False)
+        .returning(Tamanio.nombre)
+    )
+    nombre = result.scalar_one_or_none()
     
-    if not tamanio:
+    if nombre is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Tamaño no encontrado"
         )
     
-    tamanio.activo = False
     await db.commit()
+    invalidar_menu()
     
     return Response(
         status=200,
-        message=f"Tamaño '{tamanio.nombre}' desactivado exitosamente"
+        message=f"Tamaño '{nombre}' desactivado exitosamente"
     )
 
 
@@ -394,21 +539,27 @@ async def delete_tamanio(
 
 @router.get("/extras/list", response_model=List[ExtraResponse])
 async def get_extras(
+    request: Request,
     db: AsyncSession = Depends(get_db)
 ):
     """Obtener todos los extras disponibles"""
-    result = await db.execute(
-        select(Extra).options(selectinload(Extra.productos)).where(Extra.activo == True).order_by(Extra.nombre)
-    )
-    extras = result.scalars().all()
-    return extras
+    async def cargar() -> list:
+        result = await db.execute(
+            select(Extra)
+            .options(EXTRA_PRODUCTOS_IDS, raiseload("*"))
+            .where(Extra.activo == True)
+            .order_by(Extra.nombre)
+        )
+        return [_extra_a_dict(e) for e in result.scalars()]
+        
+    return await _menu_cacheado(request, ("extras",), cargar)
 
 
 @router.post("/extras", response_model=ExtraResponse, status_code=status.HTTP_201_CREATED)
 async def create_extra(
     extra_data: ExtraCreate,
     db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_admin)
+    current_user: UsuarioActual = Depends(require_admin)
 ):
     """Crear nuevo extra y asociarlo a productos"""
     # Crear el extra
@@ -419,17 +570,16 @@ async def create_extra(
         activo=extra_data.activo
     )
     
-    # Asociar productos si se proporcionan
-    if extra_data.productos_ids:
-        result = await db.execute(select(Producto).where(Producto.id.in_(extra_data.productos_ids)))
-        productos = result.scalars().all()
-        nuevo_extra.productos = productos
-    
     db.add(nuevo_extra)
+    await db.flush()  # Asigna el id del extra
+    
+    # Asociar productos en un solo INSERT (sin cargar los Producto ni un INSERT por fila)
+    productos_ids = await _insertar_productos_extra(db, nuevo_extra.id, extra_data.productos_ids)
+    
     await db.commit()
-    await db.refresh(nuevo_extra)
+    invalidar_menu()
     
-    return nuevo_extra
+    return _extra_a_dict(nuevo_extra, productos_ids)
 
 
 @router.put("/extras/{extra_id}", response_model=ExtraResponse)
@@ -437,31 +587,33 @@ async def update_extra(
     extra_id: int,
     extra_update: ExtraUpdate,
     db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_admin)
+    current_user: UsuarioActual = Depends(require_admin)
 ):
     """Actualizar extra y sus asociaciones"""
-    # Cargar extra con sus productos
+    # Actualizar campos simples en un solo UPDATE (sin SELECT previo)
+    update_data = extra_update.model_dump(exclude_unset=True, exclude={'productos_ids'})
+    if update_data:
+        await db.execute(update(Extra).where(Extra.id == extra_id).values(**update_data))
+    
+    # Reemplazar asociaciones directo en la tabla intermedia: un DELETE + un INSERT
+    if extra_update.productos_ids is not None:
+        await db.execute(delete(producto_extras).where(producto_extras.c.extra_id == extra_id))
+        await _insertar_productos_extra(db, extra_id, extra_update.productos_ids)
+    
+    # Extra actualizado con sus productos (un SELECT + un IN); sin fila no se confirma nada
     result = await db.execute(
-        select(Extra).options(selectinload(Extra.productos)).where(Extra.id == extra_id)
+        select(Extra)
+        .options(EXTRA_PRODUCTOS_IDS, raiseload("*"))
+        .where(Extra.id == extra_id)
     )
     extra = result.scalar_one_or_none()
     
     if not extra:
         raise HTTPException(status_code=404, detail="Extra no encontrado")
     
-    # Actualizar campos simples
-    update_data = extra_update.model_dump(exclude_unset=True, exclude={'productos_ids'})
-    for field, value in update_data.items():
-        setattr(extra, field, value)
-    
-    # Actualizar asociaciones si se proporcionan
-    if extra_update.productos_ids is not None:
-        result_prods = await db.execute(select(Producto).where(Producto.id.in_(extra_update.productos_ids)))
-        productos = result_prods.scalars().all()
-        extra.productos = productos
-    
     await db.commit()
-    await db.refresh(extra)
+    invalidar_menu()
+    
     return extra
 
 
@@ -469,17 +621,18 @@ async def update_extra(
 async def delete_extra(
     extra_id: int,
     db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_admin)
+    current_user: UsuarioActual = Depends(require_admin)
 ):
     """Desactivar extra"""
-    result = await db.execute(select(Extra).where(Extra.id == extra_id))
-    extra = result.scalar_one_or_none()
+    result = await db.execute(
+        update(Extra).where(Extra.id == extra_id).values(activo=False).returning(Extra.id)
+    )
     
-    if not extra:
+    if result.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Extra no encontrado")
     
-    extra.activo = False
     await db.commit()
+    invalidar_menu()
     
     return Response(status=200, message="Extra desactivado correctamente")
 
@@ -490,6 +643,7 @@ async def delete_extra(
 
 @router.get("/menu/completo")
 async def get_menu_completo(
+    request: Request,
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -497,47 +651,54 @@ async def get_menu_completo(
     
     Respuesta optimizada para mostrar el menú en la interfaz
     """
-    # Obtener categorías con sus productos
-    result_categorias = await db.execute(
-        select(Categoria).where(Categoria.activo == True).order_by(Categoria.nombre)
-    )
-    categorias = result_categorias.scalars().all()
-    
-    # Obtener todos los productos activos y disponibles
-    result_productos = await db.execute(
-        select(Producto).options(selectinload(Producto.categoria)).where(
-            Producto.activo == True,
-            Producto.disponible == True,
-            Producto.stock > 0
-        ).order_by(Producto.categoria_id, Producto.nombre)
-    )
-    productos = result_productos.scalars().all()
-    
-    # Obtener tamaños
-    result_tamanios = await db.execute(
-        select(Tamanio).where(Tamanio.activo == True).order_by(Tamanio.precio_adicional)
-    )
-    tamanios = result_tamanios.scalars().all()
-    
-    # Obtener extras
-    result_extras = await db.execute(
-        select(Extra).options(selectinload(Extra.productos)).where(Extra.activo == True, Extra.disponible == True).order_by(Extra.nombre)
-    )
-    extras = result_extras.scalars().all()
-    
-    # Organizar productos por categoría
-    menu_por_categoria = []
-    for categoria in categorias:
-        productos_categoria = [p for p in productos if p.categoria_id == categoria.id]
+    async def cargar() -> dict:
+        # Productos visibles en el menú con su categoría en un solo SELECT de columnas,
+        # ordenados por categoría para agruparlos sin objetos ORM ni model_validate.
+        # Las consultas van en secuencia: una AsyncSession no admite consultas concurrentes.
+        result_productos = await db.execute(
+            select(
+                Producto.id, Producto.nombre, Producto.descripcion, Producto.precio,
+                Producto.categoria_id, Producto.image_url, Producto.disponible,
+                Producto.stock, Producto.activo, Producto.fecha_creacion,
+                Categoria.nombre.label("categoria_nombre"),
+                Categoria.descripcion.label("categoria_descripcion"),
+                Categoria.activo.label("categoria_activo"),
+            )
+            .join(Categoria, Categoria.id == Producto.categoria_id)
+            .where(
+                Categoria.activo == True,
+                Producto.activo == True,
+                Producto.disponible == True,
+                Producto.stock > 0
+            )
+            .order_by(Categoria.nombre, Categoria.id, Producto.nombre)
+        )
+        productos = [_producto_a_dict(row) for row in result_productos]
         
-        if productos_categoria:  # Solo incluir categorías con productos
-            menu_por_categoria.append({
-                "categoria": CategoriaResponse.model_validate(categoria),
-                "productos": [ProductoResponse.model_validate(p) for p in productos_categoria]
-            })
-    
-    return {
-        "categorias_con_productos": menu_por_categoria,
-        "tamanios": [TamanioResponse.model_validate(t) for t in tamanios],
-        "extras": [ExtraResponse.model_validate(e) for e in extras]
-    }
+        # Obtener tamaños
+        result_tamanios = await db.execute(
+            select(Tamanio).where(Tamanio.activo == True).order_by(Tamanio.precio_adicional)
+        )
+        tamanios = result_tamanios.scalars().all()
+        
+        # Obtener extras
+        result_extras = await db.execute(
+            select(Extra).options(EXTRA_PRODUCTOS_IDS).where(Extra.activo == True, Extra.disponible == True).order_by(Extra.nombre)
+        )
+        extras = result_extras.scalars().all()
+        
+        # Solo aparecen categorías con productos (las vacías no salen del JOIN)
+        menu_por_categoria = [
+            {"categoria": grupo[0]["categoria"], "productos": grupo}
+            for grupo in (
+                list(items) for _, items in groupby(productos, key=lambda p: p["categoria_id"])
+            )
+        ]
+        
+        return {
+            "categorias_con_productos": menu_por_categoria,
+            "tamanios": [_tamanio_a_dict(t) for t in tamanios],
+            "extras": [_extra_a_dict(e) for e in extras]
+        }
+        
+    return await _menu_cacheado(request, ("menu",), cargar)
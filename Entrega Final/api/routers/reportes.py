@@ -2,13 +2,15 @@
 Router de Reportes y Exportación
 Implementa: B-09, B-10, B-11
 """
-from fastapi import APIRouter, Depends, HTTPException, status, Query, Response as FastAPIResponse
+from fastapi import APIRouter, Depends, HTTPException, status, Query, BackgroundTasks, Response as FastAPIResponse
 from fastapi.responses import FileResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, desc
+from sqlalchemy import select, insert, delete, func, desc, column, true, cast, type_coerce, BigInteger, JSON
 from typing import List, Optional
 from datetime import datetime, timedelta
 from decimal import Decimal
+import asyncio
+import logging
 import os
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import getSampleStyleSheet
@@ -16,24 +18,135 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib import colors
 from reportlab.lib.units import inch
 
-from database import get_db
-from models import Pedido, Producto, RankingProducto, PDFExport, Usuario
+from database import get_db, is_postgresql, AsyncSessionLocal
+from models import Pedido, Producto, RankingProducto, PDFExport, Dinero
 from schemas import (
     ReporteQueryInput, ReporteVentasResponse,
     RankingQueryInput, RankingProductoResponse,
     PDFExportInput, PDFExportResponse, ProductoSimpleResponse,
     Response
 )
-from auth import get_current_user, require_admin
+from auth import get_current_user, require_admin, UsuarioActual
 from config import settings
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/api/v1/reportes", tags=["Reportes"])
 
+# Estados de pedido que cuentan como venta
+ESTADOS_VENTA = ("confirmado", "preparando", "enviado", "entregado")
+
+# Ranking por defecto (últimos RANKING_DIAS días) precalculado en ranking_productos;
+# se recalcula en segundo plano cuando la foto supera RANKING_VIGENCIA
+RANKING_DIAS = 30
+RANKING_MAX_POSICIONES = 100  # top_n máximo aceptado por el endpoint
+RANKING_VIGENCIA = timedelta(hours=1)
+_ranking_lock = asyncio.Lock()
+# Momento del último cálculo de la foto, independiente de sus filas (la foto
+# puede quedar vacía si no hubo ventas). None: aún no se conoce en este proceso.
+_ranking_calculado_en: Optional[datetime] = None
+
+
+def _filtros_ventas(fecha_inicio: datetime, fecha_fin: datetime) -> list:
+    """Condiciones de pedidos vendidos en el período"""
+    return [
+        Pedido.fecha >= fecha_inicio,
+        Pedido.fecha <= fecha_fin,
+        Pedido.estado.in_(ESTADOS_VENTA)
+    ]
+
+
+def _query_items_vendidos(filtros: list):
+    """
+    Cantidad e ingresos por producto, agregados en SQL desde items_json
+    
+    Los items se expanden como tabla con jsonb_array_elements (PostgreSQL)
+    o json_each (SQLite); ordenado por cantidad vendida. Los ingresos se suman
+    en centavos enteros y el total llega como Decimal vía Dinero (sin Decimal(str(...)) por fila).
+    """
+    if is_postgresql():
+        items = func.jsonb_array_elements(Pedido.items_json["items"])
+    else:
+        items = func.json_each(Pedido.items_json, "$.items")
+    it = items.table_valued(column("value", JSON)).alias("it")
+    item = it.c.value
+    
+    producto_id = item["producto_id"].as_integer()
+    cantidad = item["cantidad"].as_integer()
+    precio_centavos = cast(func.round(item["precio_unitario"].as_numeric(12, 2) * 100), BigInteger)
+    
+    return (
+        select(
+            producto_id.label("producto_id"),
+            func.max(item["nombre"].as_string()).label("nombre"),
+            func.sum(cantidad).label("cantidad_total"),
+            type_coerce(func.sum(precio_centavos * cantidad), Dinero).label("ingresos")
+        )
+        .select_from(Pedido)
+        .join(it, true())
+        .where(*filtros)
+        .group_by(producto_id)
+        .order_by(desc("cantidad_total"))
+    )
+
+
+async def _recalcular_ranking(db: AsyncSession) -> None:
+    """Reemplazar la foto del ranking de los últimos RANKING_DIAS días (una agregación SQL)"""
+    global _ranking_calculado_en
+    fecha_fin = datetime.utcnow()
+    fecha_inicio = fecha_fin - timedelta(days=RANKING_DIAS)
+    
+    result = await db.execute(
+        _query_items_vendidos(_filtros_ventas(fecha_inicio, fecha_fin)).limit(RANKING_MAX_POSICIONES)
+    )
+    ranking_ordenado = result.all()
+    
+    # Solo productos que siguen existiendo (FK); la posición conserva el orden de venta
+    ids = [item.producto_id for item in ranking_ordenado]
+    result = await db.execute(select(Producto.id).where(Producto.id.in_(ids)))
+    existentes = set(result.scalars())
+    
+    filas = [
+        {
+            "producto_id": item.producto_id,
+            "periodo_inicio": fecha_inicio,
+            "periodo_fin": fecha_fin,
+            "posicion": idx,
+            "cantidad_vendida": item.cantidad_total,
+            "ingreso_total": item.ingresos,
+            "fecha_calculo": fecha_fin,
+        }
+        for idx, item in enumerate(ranking_ordenado, start=1)
+        if item.producto_id in existentes
+    ]
+    
+    await db.execute(delete(RankingProducto))
+    if filas:
+        await db.execute(insert(RankingProducto), filas)
+    await db.commit()
+    _ranking_calculado_en = fecha_fin
+
+
+async def recalcular_ranking_task() -> None:
+    """
+    Recalcular la foto del ranking después de la respuesta (B-10)
+    
+    Usa una sesión propia; si ya hay un recálculo en curso no hace nada.
+    """
+    if _ranking_lock.locked():
+        return
+    try:
+        async with _ranking_lock, AsyncSessionLocal() as db:
+            await _recalcular_ranking(db)
+    except Exception as e:
+        logger.error(f"Error recalculando ranking de productos: {str(e)}")
+
+
 
 @router.post("/ventas", response_model=ReporteVentasResponse)
 async def generar_reporte_ventas(
     reporte_data: ReporteQueryInput,
-    current_user: Usuario = Depends(require_admin),
+    current_user: UsuarioActual = Depends(require_admin),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -45,17 +158,15 @@ async def generar_reporte_ventas(
     - Ticket promedio
     - Top productos vendidos
     """
-    # Obtener pedidos del período
+    filtros = _filtros_ventas(reporte_data.fecha_inicio, reporte_data.fecha_fin)
+    
+    # Totales agregados en SQL (una fila en vez de todos los pedidos)
     result = await db.execute(
-        select(Pedido).where(
-            Pedido.fecha >= reporte_data.fecha_inicio,
-            Pedido.fecha <= reporte_data.fecha_fin,
-            Pedido.estado.in_(["confirmado", "preparando", "enviado", "entregado"])
-        )
+        select(func.coalesce(func.sum(Pedido.total), 0), func.count(Pedido.id)).where(*filtros)
     )
-    pedidos = result.scalars().all()
+    ventas_totales, cantidad_pedidos = result.one()
     
-    if not pedidos:
+    if not cantidad_pedidos:
         return ReporteVentasResponse(
             fecha_inicio=reporte_data.fecha_inicio,
             fecha_fin=reporte_data.fecha_fin,
@@ -65,37 +176,19 @@ async def generar_reporte_ventas(
             productos_mas_vendidos=[]
         )
     
-    # Calcular métricas
-    ventas_totales = sum(p.total for p in pedidos)
-    cantidad_pedidos = len(pedidos)
-    ticket_promedio = ventas_totales / cantidad_pedidos if cantidad_pedidos > 0 else Decimal("0")
-    
-    # Calcular productos más vendidos
-    productos_vendidos = {}
-    for pedido in pedidos:
-        if pedido.items_json and "items" in pedido.items_json:
-            for item in pedido.items_json["items"]:
-                producto_id = item.get("producto_id")
-                cantidad = item.get("cantidad", 0)
-                nombre = item.get("nombre", "Desconocido")
-                
-                if producto_id not in productos_vendidos:
-                    productos_vendidos[producto_id] = {
-                        "producto_id": producto_id,
-                        "nombre": nombre,
-                        "cantidad_total": 0,
-                        "ingresos": Decimal("0")
-                    }
-                
-                productos_vendidos[producto_id]["cantidad_total"] += cantidad
-                productos_vendidos[producto_id]["ingresos"] += Decimal(str(item.get("precio_unitario", 0))) * cantidad
-    
-    # Ordenar por cantidad vendida
-    productos_mas_vendidos = sorted(
-        productos_vendidos.values(),
-        key=lambda x: x["cantidad_total"],
-        reverse=True
-    )[:10]  # Top 10
+    ticket_promedio = ventas_totales / cantidad_pedidos
+    
+    # Productos más vendidos: items_json expandido y agrupado en SQL
+    result = await db.execute(_query_items_vendidos(filtros).limit(10))  # Top 10
+    productos_mas_vendidos = [
+        {
+            "producto_id": row.producto_id,
+            "nombre": row.nombre or "Desconocido",
+            "cantidad_total": row.cantidad_total,
+            "ingresos": row.ingresos
+        }
+        for row in result
+    ]
     
     return ReporteVentasResponse(
         fecha_inicio=reporte_data.fecha_inicio,
@@ -109,17 +202,22 @@ async def generar_reporte_ventas(
 
 @router.get("/ranking-productos", response_model=List[RankingProductoResponse])
 async def get_ranking_productos(
+    background_tasks: BackgroundTasks,
     fecha_inicio: Optional[datetime] = Query(None),
     fecha_fin: Optional[datetime] = Query(None),
-    top_n: int = Query(10, ge=1, le=100),
-    current_user: Usuario = Depends(require_admin),
+    top_n: int = Query(10, ge=1, le=RANKING_MAX_POSICIONES),
+    current_user: UsuarioActual = Depends(require_admin),
     db: AsyncSession = Depends(get_db)
 ):
     """
     Obtener ranking de pizzas más vendidas (B-10)
     
-    Si no se especifican fechas, usa el último mes
+    Si no se especifican fechas, usa el último mes desde la foto precalculada
+    en ranking_productos (desfase máximo: RANKING_VIGENCIA)
     """
+    if fecha_inicio is None and fecha_fin is None:
+        return await _ranking_precalculado(top_n, background_tasks, db)
+    
     # Establecer fechas por defecto si no se proporcionan
     if not fecha_fin:
         fecha_fin = datetime.utcnow()
@@ -127,64 +225,77 @@ async def get_ranking_productos(
     if not fecha_inicio:
         fecha_inicio = fecha_fin - timedelta(days=30)
     
-    # Obtener pedidos del período
+    # Ranking agregado en SQL (sin recorrer pedidos en Python)
     result = await db.execute(
-        select(Pedido).where(
-            Pedido.fecha >= fecha_inicio,
-            Pedido.fecha <= fecha_fin,
-            Pedido.estado.in_(["confirmado", "preparando", "enviado", "entregado"])
-        )
+        _query_items_vendidos(_filtros_ventas(fecha_inicio, fecha_fin)).limit(top_n)
     )
-    pedidos = result.scalars().all()
-    
-    # Calcular ranking
-    productos_ranking = {}
-    for pedido in pedidos:
-        if pedido.items_json and "items" in pedido.items_json:
-            for item in pedido.items_json["items"]:
-                producto_id = item.get("producto_id")
-                cantidad = item.get("cantidad", 0)
-                
-                if producto_id not in productos_ranking:
-                    productos_ranking[producto_id] = {
-                        "producto_id": producto_id,
-                        "cantidad_vendida": 0,
-                        "ingreso_total": Decimal("0")
-                    }
-                
-                productos_ranking[producto_id]["cantidad_vendida"] += cantidad
-                productos_ranking[producto_id]["ingreso_total"] += Decimal(str(item.get("precio_unitario", 0))) * cantidad
-    
-    # Ordenar por cantidad vendida
-    ranking_ordenado = sorted(
-        productos_ranking.values(),
-        key=lambda x: x["cantidad_vendida"],
-        reverse=True
-    )[:top_n]
-    
-    # Obtener información completa de productos
+    ranking_ordenado = result.all()
+    
+    # Obtener información completa de productos en una sola consulta
+    ids = [item.producto_id for item in ranking_ordenado]
+    result = await db.execute(select(Producto).where(Producto.id.in_(ids)))
+    prod_by_id = {producto.id: producto for producto in result.scalars()}
+    
     resultado = []
     for idx, item in enumerate(ranking_ordenado, start=1):
-        result = await db.execute(
-            select(Producto).where(Producto.id == item["producto_id"])
-        )
-        producto = result.scalar_one_or_none()
+        producto = prod_by_id.get(item.producto_id)
         
         if producto:
             resultado.append(RankingProductoResponse(
                 posicion=idx,
                 producto=ProductoSimpleResponse.model_validate(producto),
-                cantidad_vendida=item["cantidad_vendida"],
-                ingreso_total=item["ingreso_total"]
+                cantidad_vendida=item.cantidad_total,
+                ingreso_total=item.ingresos
             ))
     
     return resultado
 
 
+async def _ranking_precalculado(
+    top_n: int,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession
+) -> List[RankingProductoResponse]:
+    """Ranking del último mes leído de ranking_productos; la foto vencida se recalcula tras la respuesta"""
+    global _ranking_calculado_en
+    query = (
+        select(RankingProducto, Producto)
+        .join(Producto, Producto.id == RankingProducto.producto_id)
+        .order_by(RankingProducto.posicion)
+        .limit(top_n)
+    )
+    filas = (await db.execute(query)).all()
+    
+    if _ranking_calculado_en is None and filas:
+        # Foto de un proceso anterior: su fecha de cálculo está en las filas
+        _ranking_calculado_en = filas[0].RankingProducto.fecha_calculo
+    
+    if _ranking_calculado_en is None:
+        # Sin foto todavía: se calcula en línea una sola vez; las requests que
+        # esperaban el lock no la repiten
+        async with _ranking_lock:
+            if _ranking_calculado_en is None:
+                await _recalcular_ranking(db)
+        filas = (await db.execute(query)).all()
+    elif datetime.utcnow() - _ranking_calculado_en > RANKING_VIGENCIA:
+        # Vencida (aunque esté vacía): se recalcula después de la respuesta
+        background_tasks.add_task(recalcular_ranking_task)
+    
+    return [
+        RankingProductoResponse(
+            posicion=ranking.posicion,
+            producto=ProductoSimpleResponse.model_validate(producto),
+            cantidad_vendida=ranking.cantidad_vendida,
+            ingreso_total=ranking.ingreso_total
+        )
+        for ranking, producto in filas
+    ]
+
+
 @router.post("/exportar-pdf", response_model=PDFExportResponse)
 async def exportar_reporte_pdf(
     export_data: PDFExportInput,
-    current_user: Usuario = Depends(require_admin),
+    current_user: UsuarioActual = Depends(require_admin),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -244,7 +355,7 @@ async def exportar_reporte_pdf(
 @router.get("/descargar-pdf/{pdf_id}")
 async def descargar_pdf(
     pdf_id: int,
-    current_user: Usuario = Depends(require_admin),
+    current_user: UsuarioActual = Depends(require_admin),
     db: AsyncSession = Depends(get_db)
 ):
     """
@@ -266,17 +377,30 @@ async def descargar_pdf(
             detail="El PDF ha expirado"
         )
     
-    # Verificar que el archivo existe
-    if not os.path.exists(pdf_export.ruta_archivo):
+    # Verificar que el archivo existe (el stat se reutiliza para Content-Length)
+    try:
+        stat_archivo = os.stat(pdf_export.ruta_archivo)
+    except FileNotFoundError:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Archivo no encontrado"
         )
     
+    # Con nginx delante, el archivo lo envía nginx (sendfile) y la API solo autoriza
+    if settings.PDF_ACCEL_REDIRECT_PREFIX:
+        return FastAPIResponse(
+            media_type="application/pdf",
+            headers={
+                "X-Accel-Redirect": settings.PDF_ACCEL_REDIRECT_PREFIX + os.path.basename(pdf_export.ruta_archivo),
+                "Content-Disposition": f'attachment; filename="{pdf_export.nombre_archivo}"'
+            }
+        )
+    
     return FileResponse(
         path=pdf_export.ruta_archivo,
         filename=pdf_export.nombre_archivo,
-        media_type="application/pdf"
+        media_type="application/pdf",
+        stat_result=stat_archivo
     )
 
 
@@ -327,7 +451,8 @@ async def generar_pdf_reporte_ventas(ruta: str, metadata: dict, db: AsyncSession
         
         story.append(table)
     
-    doc.build(story)
+    # ReportLab es síncrono: se construye en un hilo para no bloquear el event loop
+    await asyncio.to_thread(doc.build, story)
 
 
 async def generar_pdf_ranking(ruta: str, metadata: dict, db: AsyncSession):
@@ -367,4 +492,5 @@ async def generar_pdf_ranking(ruta: str, metadata: dict, db: AsyncSession):
         
         story.append(table)
     
-    doc.build(story)
+    # ReportLab es síncrono: se construye en un hilo para no bloquear el event loop
+    await asyncio.to_thread(doc.build, story)
@@ -2,11 +2,14 @@
 Servicio de Envío de Emails - Pizzería La Fornace
 Implementa: B-12 (Confirmación pedidos), B-14 (Campañas masivas)
 """
+import asyncio
 import aiosmtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from typing import Optional, List
+from types import MappingProxyType
+from typing import Mapping, Optional, List
 from datetime import datetime
+from html import escape
 import logging
 
 from config import settings
@@ -24,6 +27,62 @@ class EmailService:
         self.smtp_password = settings.SMTP_PASSWORD
         self.email_from = settings.EMAIL_FROM or "noreply@lafornace.cl"
         self.enabled = bool(self.smtp_host and self.smtp_username and self.smtp_password)
+        # Conexiones SMTP persistentes (una por envío simultáneo), creadas al primer uso
+        self._conexiones: Optional[asyncio.Queue] = None
+    
+    def _pool_conexiones(self) -> asyncio.Queue:
+        """Pool de clientes SMTP; cada uno conecta (STARTTLS + login) recién al usarse"""
+        if self._conexiones is None:
+            self._conexiones = asyncio.Queue()
+            for _ in range(settings.EMAIL_CONCURRENCY):
+                self._conexiones.put_nowait(aiosmtplib.SMTP(
+                    hostname=self.smtp_host,
+                    port=self.smtp_port,
+                    username=self.smtp_username,
+                    password=self.smtp_password,
+                    start_tls=True
+                ))
+        return self._conexiones
+    
+    async def _send_message(self, message: MIMEMultipart) -> None:
+        """
+        Enviar por una conexión SMTP del pool
+        
+        La conexión queda abierta para el siguiente email (solo DATA, sin
+        handshake TCP/TLS ni AUTH). Si el servidor la cerró se reconecta una vez.
+        """
+        conexiones = self._pool_conexiones()
+        smtp = await conexiones.get()
+        try:
+            for intento in range(2):
+                try:
+                    if not smtp.is_connected:
+                        await smtp.connect()
+                    await smtp.send_message(message)
+                    return
+                except aiosmtplib.SMTPServerDisconnected:
+                    smtp.close()
+                    if intento:
+                        raise
+                except Exception:
+                    # Estado de la sesión incierto: el próximo uso reconecta desde cero
+                    smtp.close()
+                    raise
+        finally:
+            conexiones.put_nowait(smtp)
+    
+    async def close(self) -> None:
+        """Cerrar las conexiones SMTP abiertas (shutdown de la aplicación)"""
+        if self._conexiones is None:
+            return
+        while not self._conexiones.empty():
+            smtp = self._conexiones.get_nowait()
+            if smtp.is_connected:
+                try:
+                    await smtp.quit()
+                except aiosmtplib.SMTPException:
+                    smtp.close()
+        self._conexiones = None
     
     async def send_email(
         self,
@@ -59,14 +118,7 @@ class EmailService:
             html_part = MIMEText(contenido_html, "html", "utf-8")
             message.attach(html_part)
             
-            await aiosmtplib.send(
-                message,
-                hostname=self.smtp_host,
-                port=self.smtp_port,
-                username=self.smtp_username,
-                password=self.smtp_password,
-                start_tls=True
-            )
+            await self._send_message(message)
             
             logger.info(f"Email sent successfully to {destinatario}")
             return True
@@ -84,38 +136,45 @@ class EmailService:
         """
         Enviar email a múltiples destinatarios
         
+        Los envíos se solapan hasta EMAIL_CONCURRENCY a la vez (en vez de uno
+        tras otro esperando cada handshake SMTP).
+        
         Returns:
             dict: {"enviados": int, "fallidos": int, "total": int}
         """
-        resultados = {"enviados": 0, "fallidos": 0, "total": len(destinatarios)}
+        sem = asyncio.Semaphore(settings.EMAIL_CONCURRENCY)
+        
+        async def _send_one(destinatario: str) -> bool:
+            async with sem:
+                return await self.send_email(destinatario, asunto, contenido_html)
         
-        for destinatario in destinatarios:
-            exito = await self.send_email(destinatario, asunto, contenido_html)
-            if exito:
-                resultados["enviados"] += 1
-            else:
-                resultados["fallidos"] += 1
+        resultados_envio = await asyncio.gather(
+            *(_send_one(destinatario) for destinatario in destinatarios),
+            return_exceptions=True
+        )
+        enviados = sum(1 for exito in resultados_envio if exito is True)
         
-        return resultados
+        return {
+            "enviados": enviados,
+            "fallidos": len(destinatarios) - enviados,
+            "total": len(destinatarios)
+        }
 
 
 # ============================================
 # PLANTILLAS DE EMAIL
 # ============================================
 
-class EmailTemplates:
-    """Plantillas HTML para diferentes tipos de emails"""
-    
-    @staticmethod
-    def base_template(contenido: str, titulo: str = "Pizzería La Fornace") -> str:
-        """Plantilla base para todos los emails"""
-        return f"""
+# Marco HTML común (cabecera y pie) precalculado: por email solo se insertan
+# el título (escapado) y el contenido
+_BASE_INICIO = """
 <!DOCTYPE html>
 <html lang="es">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{titulo}</title>
+    <title>"""
+_BASE_MEDIO = """</title>
 </head>
 <body style="margin: 0; padding: 0; font-family: 'Segoe UI', Arial, sans-serif; background-color: #f5f5f5;">
     <table width="100%" cellpadding="0" cellspacing="0" style="background-color: #f5f5f5; padding: 20px 0;">
@@ -131,7 +190,8 @@ class EmailTemplates:
                     <!-- Content -->
                     <tr>
                         <td style="padding: 30px;">
-                            {contenido}
+                            """
+_BASE_FIN = """
                         </td>
                     </tr>
                     <!-- Footer -->
@@ -148,160 +208,70 @@ class EmailTemplates:
 </body>
 </html>
 """
-    
-    @staticmethod
-    def confirmacion_pedido(
-        pedido_id: int,
-        total: float,
-        direccion: str,
-        eta_minutos: int,
-        items: list,
-        nombre_cliente: str = "Cliente"
-    ) -> str:
-        """
-        Template para confirmación de pedido (B-12)
-        """
-        # Generar lista de items
-        items_html = ""
-        for item in items:
-            nombre = item.get("nombre", "Producto")
-            cantidad = item.get("cantidad", 1)
-            precio = item.get("precio_unitario", 0)
-            items_html += f"""
+
+
+# Fila de la tabla de items del email de confirmación
+_FILA_ITEM = """
             <tr>
                 <td style="padding: 10px; border-bottom: 1px solid #eee;">{nombre}</td>
                 <td style="padding: 10px; border-bottom: 1px solid #eee; text-align: center;">{cantidad}</td>
                 <td style="padding: 10px; border-bottom: 1px solid #eee; text-align: right;">${precio:,.0f}</td>
             </tr>
             """
-        
-        contenido = f"""
-            <h2 style="color: #8B0000; margin-top: 0;">¡Gracias por tu pedido, {nombre_cliente}!</h2>
-            
-            <p style="font-size: 16px; color: #333;">Tu pedido ha sido confirmado exitosamente y está siendo procesado.</p>
-            
-            <div style="background-color: #f9f9f9; border-radius: 8px; padding: 20px; margin: 20px 0;">
-                <h3 style="margin-top: 0; color: #333;">📋 Pedido #{pedido_id}</h3>
-                
-                <table width="100%" cellpadding="0" cellspacing="0" style="margin-bottom: 15px;">
-                    <thead>
-                        <tr style="background-color: #8B0000; color: white;">
-                            <th style="padding: 10px; text-align: left;">Producto</th>
-                            <th style="padding: 10px; text-align: center;">Cant.</th>
-                            <th style="padding: 10px; text-align: right;">Precio</th>
-                        </tr>
-                    </thead>
-                    <tbody>
-                        {items_html}
-                    </tbody>
-                </table>
-                
-                <p style="font-size: 20px; font-weight: bold; color: #8B0000; text-align: right; margin: 0;">
-                    Total: ${total:,.0f}
-                </p>
-            </div>
-            
-            <div style="background-color: #e8f5e9; border-left: 4px solid #4CAF50; padding: 15px; margin: 20px 0;">
-                <h4 style="margin: 0 0 10px 0; color: #2e7d32;">📍 Dirección de entrega</h4>
-                <p style="margin: 0; color: #333;">{direccion}</p>
-            </div>
-            
-            <div style="background-color: #fff3e0; border-left: 4px solid #FF9800; padding: 15px; margin: 20px 0;">
-                <h4 style="margin: 0 0 10px 0; color: #e65100;">⏱️ Tiempo estimado de entrega</h4>
-                <p style="margin: 0; color: #333; font-size: 18px; font-weight: bold;">{eta_minutos} minutos</p>
-            </div>
-            
-            <p style="color: #666; font-size: 14px;">
-                Si tienes alguna pregunta sobre tu pedido, no dudes en contactarnos.
-            </p>
-        """
-        
-        return EmailTemplates.base_template(contenido, f"Confirmación Pedido #{pedido_id}")
-    
-    @staticmethod
-    def cambio_estado_pedido(
-        pedido_id: int,
-        estado: str,
-        nombre_cliente: str = "Cliente"
-    ) -> str:
-        """Template para notificación de cambio de estado"""
-        
-        estados_info = {
-            "confirmado": {
-                "emoji": "✅",
-                "titulo": "Pedido Confirmado",
-                "mensaje": "Tu pedido ha sido confirmado y pronto comenzará su preparación.",
-                "color": "#4CAF50"
-            },
-            "en_preparacion": {
-                "emoji": "👨‍🍳",
-                "titulo": "En Preparación",
-                "mensaje": "¡Buenas noticias! Tu pedido está siendo preparado por nuestros chefs.",
-                "color": "#FF9800"
-            },
-            "en_camino": {
-                "emoji": "🛵",
-                "titulo": "En Camino",
-                "mensaje": "Tu pedido está en camino. ¡Prepárate para recibirlo!",
-                "color": "#2196F3"
-            },
-            "entregado": {
-                "emoji": "🎉",
-                "titulo": "Entregado",
-                "mensaje": "Tu pedido ha sido entregado. ¡Esperamos que lo disfrutes!",
-                "color": "#4CAF50"
-            }
-        }
-        
-        info = estados_info.get(estado, {
-            "emoji": "📦",
-            "titulo": estado.replace("_", " ").title(),
-            "mensaje": f"El estado de tu pedido ha cambiado a: {estado}",
-            "color": "#666666"
-        })
-        
-        contenido = f"""
-            <div style="text-align: center; padding: 20px 0;">
-                <span style="font-size: 64px;">{info['emoji']}</span>
-                <h2 style="color: {info['color']}; margin: 20px 0 10px 0;">{info['titulo']}</h2>
-                <p style="color: #666; font-size: 14px;">Pedido #{pedido_id}</p>
-            </div>
-            
-            <p style="font-size: 16px; color: #333; text-align: center;">
-                Hola {nombre_cliente},<br><br>
-                {info['mensaje']}
-            </p>
-            
-            <div style="text-align: center; margin-top: 30px;">
-                <p style="color: #888; font-size: 12px;">
-                    Puedes ver el estado de tu pedido en tu cuenta.
-                </p>
-            </div>
-        """
-        
-        return EmailTemplates.base_template(contenido, f"Actualización Pedido #{pedido_id}")
-    
-    @staticmethod
-    def promocion(
-        asunto: str,
-        mensaje: str,
-        nombre_cliente: str = "Cliente"
-    ) -> str:
-        """Template para emails promocionales (B-14)"""
-        
-        contenido = f"""
+
+
+# Presentación de cada estado en el email de cambio de estado (solo lectura)
+_ESTADOS_INFO: Mapping[str, dict] = MappingProxyType({
+    "confirmado": {
+        "emoji": "✅",
+        "titulo": "Pedido Confirmado",
+        "mensaje": "Tu pedido ha sido confirmado y pronto comenzará su preparación.",
+        "color": "#4CAF50"
+    },
+    "en_preparacion": {
+        "emoji": "👨‍🍳",
+        "titulo": "En Preparación",
+        "mensaje": "¡Buenas noticias! Tu pedido está siendo preparado por nuestros chefs.",
+        "color": "#FF9800"
+    },
+    "en_camino": {
+        "emoji": "🛵",
+        "titulo": "En Camino",
+        "mensaje": "Tu pedido está en camino. ¡Prepárate para recibirlo!",
+        "color": "#2196F3"
+    },
+    "entregado": {
+        "emoji": "🎉",
+        "titulo": "Entregado",
+        "mensaje": "Tu pedido ha sido entregado. ¡Esperamos que lo disfrutes!",
+        "color": "#4CAF50"
+    }
+})
+
+
+def _plantilla_formato(contenido: str) -> str:
+    """Marco base + contenido como una sola plantilla %-format (con %(titulo)s)"""
+    return "".join((
+        _BASE_INICIO.replace("%", "%%"), "%(titulo)s",
+        _BASE_MEDIO.replace("%", "%%"), contenido,
+        _BASE_FIN.replace("%", "%%")
+    ))
+
+
+# Emails sin bucles: plantilla completa armada una vez; renderizar es un solo %
+_PROMOCION_TPL = _plantilla_formato("""
             <div style="text-align: center; padding: 20px 0;">
                 <span style="font-size: 64px;">🎁</span>
                 <h2 style="color: #8B0000; margin: 20px 0;">¡Oferta Especial!</h2>
             </div>
             
             <p style="font-size: 16px; color: #333;">
-                Hola {nombre_cliente},
+                Hola %(nombre_cliente)s,
             </p>
             
             <div style="background-color: #fff8e1; border: 2px dashed #FFC107; border-radius: 8px; padding: 20px; margin: 20px 0; text-align: center;">
                 <p style="font-size: 18px; color: #333; margin: 0;">
-                    {mensaje}
+                    %(mensaje)s
                 </p>
             </div>
             
@@ -317,22 +287,16 @@ class EmailTemplates:
                 Recibiste este email porque estás suscrito a nuestras promociones.<br>
                 <a href="#" style="color: #8B0000;">Cancelar suscripción</a>
             </p>
-        """
-        
-        return EmailTemplates.base_template(contenido, asunto)
-    
-    @staticmethod
-    def bienvenida(nombre_cliente: str, email: str) -> str:
-        """Template para email de bienvenida al registrarse"""
-        
-        contenido = f"""
+        """)
+
+_BIENVENIDA_TPL = _plantilla_formato("""
             <div style="text-align: center; padding: 20px 0;">
                 <span style="font-size: 64px;">👋</span>
                 <h2 style="color: #8B0000; margin: 20px 0;">¡Bienvenido a La Fornace!</h2>
             </div>
             
             <p style="font-size: 16px; color: #333;">
-                Hola <strong>{nombre_cliente}</strong>,
+                Hola <strong>%(nombre_cliente)s</strong>,
             </p>
             
             <p style="font-size: 16px; color: #333;">
@@ -353,11 +317,174 @@ class EmailTemplates:
             </div>
             
             <p style="color: #666; font-size: 14px;">
-                Tu cuenta está asociada al email: <strong>{email}</strong>
+                Tu cuenta está asociada al email: <strong>%(email)s</strong>
             </p>
-        """
+        """)
+
+
+# Marcador del nombre en la promoción pre-renderizada de una campaña
+MARCADOR_NOMBRE = "\x00NOMBRE_CLIENTE\x00"
+
+
+def render_base_template(contenido: str, titulo: str = "Pizzería La Fornace") -> str:
+    """Plantilla base para todos los emails"""
+    return "".join((_BASE_INICIO, escape(titulo), _BASE_MEDIO, contenido, _BASE_FIN))
+
+
+def render_confirmacion_pedido(
+    pedido_id: int,
+    total: float,
+    direccion: str,
+    eta_minutos: int,
+    items: list,
+    nombre_cliente: str = "Cliente"
+) -> str:
+    """
+    Template para confirmación de pedido (B-12)
+    """
+    # Datos ingresados por usuarios: se escapan una vez antes de interpolar
+    nombre_cliente = escape(nombre_cliente)
+    direccion = escape(direccion)
+    
+    # Generar lista de items (un solo join, sin concatenaciones sucesivas)
+    items_html = "".join([
+        _FILA_ITEM.format(
+            nombre=escape(item.get("nombre", "Producto")),
+            cantidad=item.get("cantidad", 1),
+            precio=item.get("precio_unitario", 0)
+        )
+        for item in items
+    ])
+    
+    contenido = f"""
+        <h2 style="color: #8B0000; margin-top: 0;">¡Gracias por tu pedido, {nombre_cliente}!</h2>
+        
+        <p style="font-size: 16px; color: #333;">Tu pedido ha sido confirmado exitosamente y está siendo procesado.</p>
+        
+        <div style="background-color: #f9f9f9; border-radius: 8px; padding: 20px; margin: 20px 0;">
+            <h3 style="margin-top: 0; color: #333;">📋 Pedido #{pedido_id}</h3>
+            
+            <table width="100%" cellpadding="0" cellspacing="0" style="margin-bottom: 15px;">
+                <thead>
+                    <tr style="background-color: #8B0000; color: white;">
+                        <th style="padding: 10px; text-align: left;">Producto</th>
+                        <th style="padding: 10px; text-align: center;">Cant.</th>
+                        <th style="padding: 10px; text-align: right;">Precio</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {items_html}
+                </tbody>
+            </table>
+            
+            <p style="font-size: 20px; font-weight: bold; color: #8B0000; text-align: right; margin: 0;">
+                Total: ${total:,.0f}
+            </p>
+        </div>
+        
+        <div style="background-color: #e8f5e9; border-left: 4px solid #4CAF50; padding: 15px; margin: 20px 0;">
+            <h4 style="margin: 0 0 10px 0; color: #2e7d32;">📍 Dirección de entrega</h4>
+            <p style="margin: 0; color: #333;">{direccion}</p>
+        </div>
         
-        return EmailTemplates.base_template(contenido, "Bienvenido a Pizzería La Fornace")
+        <div style="background-color: #fff3e0; border-left: 4px solid #FF9800; padding: 15px; margin: 20px 0;">
+            <h4 style="margin: 0 0 10px 0; color: #e65100;">⏱️ Tiempo estimado de entrega</h4>
+            <p style="margin: 0; color: #333; font-size: 18px; font-weight: bold;">{eta_minutos} minutos</p>
+        </div>
+        
+        <p style="color: #666; font-size: 14px;">
+            Si tienes alguna pregunta sobre tu pedido, no dudes en contactarnos.
+        </p>
+    """
+    
+    return render_base_template(contenido, f"Confirmación Pedido #{pedido_id}")
+
+
+def render_cambio_estado_pedido(
+    pedido_id: int,
+    estado: str,
+    nombre_cliente: str = "Cliente"
+) -> str:
+    """Template para notificación de cambio de estado"""
+    nombre_cliente = escape(nombre_cliente)
+    info = _ESTADOS_INFO.get(estado)
+    if info is None:
+        info = {
+            "emoji": "📦",
+            "titulo": estado.replace("_", " ").title(),
+            "mensaje": f"El estado de tu pedido ha cambiado a: {estado}",
+            "color": "#666666"
+        }
+    
+    contenido = f"""
+        <div style="text-align: center; padding: 20px 0;">
+            <span style="font-size: 64px;">{info['emoji']}</span>
+            <h2 style="color: {info['color']}; margin: 20px 0 10px 0;">{info['titulo']}</h2>
+            <p style="color: #666; font-size: 14px;">Pedido #{pedido_id}</p>
+        </div>
+        
+        <p style="font-size: 16px; color: #333; text-align: center;">
+            Hola {nombre_cliente},<br><br>
+            {info['mensaje']}
+        </p>
+        
+        <div style="text-align: center; margin-top: 30px;">
+            <p style="color: #888; font-size: 12px;">
+                Puedes ver el estado de tu pedido en tu cuenta.
+            </p>
+        </div>
+    """
+    
+    return render_base_template(contenido, f"Actualización Pedido #{pedido_id}")
+
+
+def render_promocion(
+    asunto: str,
+    mensaje: str,
+    nombre_cliente: str = "Cliente"
+) -> str:
+    """Template para emails promocionales (B-14)"""
+    return _PROMOCION_TPL % {
+        "titulo": escape(asunto),
+        "nombre_cliente": escape(nombre_cliente),
+        "mensaje": escape(mensaje)
+    }
+
+
+def render_promocion_campania(asunto: str, mensaje: str) -> str:
+    """
+    Promoción renderizada una sola vez por campaña (B-14)
+    
+    Solo cambia el nombre del cliente: se personaliza con
+    ``html.replace(MARCADOR_NOMBRE, escape(nombre))``.
+    """
+    return render_promocion(asunto, mensaje, MARCADOR_NOMBRE)
+
+
+def render_bienvenida(nombre_cliente: str, email: str) -> str:
+    """Template para email de bienvenida al registrarse"""
+    return _BIENVENIDA_TPL % {
+        "titulo": "Bienvenido a Pizzería La Fornace",
+        "nombre_cliente": escape(nombre_cliente),
+        "email": escape(email)
+    }
+
+
+class EmailTemplates:
+    """
+    Plantillas HTML para diferentes tipos de emails
+    
+    Fachada de compatibilidad: las plantillas son funciones de módulo
+    (render_*), que es lo que usan los routers.
+    """
+    
+    MARCADOR_NOMBRE = MARCADOR_NOMBRE
+    base_template = staticmethod(render_base_template)
+    confirmacion_pedido = staticmethod(render_confirmacion_pedido)
+    cambio_estado_pedido = staticmethod(render_cambio_estado_pedido)
+    promocion = staticmethod(render_promocion)
+    promocion_campania = staticmethod(render_promocion_campania)
+    bienvenida = staticmethod(render_bienvenida)
 
 
 # Instancia global del servicio
@@ -1,9 +1,117 @@
 import asyncio
-from database import init_db
+import hashlib
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+from database import init_db, engine
+from models import Base
+
+
+def agregar_columnas_faltantes(conn):
+    """create_all no agrega columnas nuevas a tablas ya existentes"""
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existentes = {col["name"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existentes:
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+                print(f"  + {table.name}.{column.name}")
+
+
+def completar_datos(conn):
+    """Rellenar columnas desnormalizadas en filas anteriores a su creación"""
+    conn.execute(text("""
+        UPDATE solicitudes_anulacion
+        SET user_id = (SELECT user_id FROM pedidos WHERE pedidos.id = solicitudes_anulacion.pedido_id),
+            pedido_fecha = (SELECT fecha FROM pedidos WHERE pedidos.id = solicitudes_anulacion.pedido_id)
+        WHERE user_id IS NULL
+    """))
+
+
+def hashear_tokens_verificacion(conn):
+    """
+    Pasar los tokens de verificación en claro (columna heredada
+    token_verificacion) a token_verificacion_hash y vaciar la columna vieja
+    """
+    existentes = {col["name"] for col in inspect(conn).get_columns("usuarios")}
+    if "token_verificacion" not in existentes:
+        return
+    # Solo usuarios sin verificar: sus enlaces pendientes siguen funcionando
+    pendientes = conn.execute(text("""
+        SELECT id, token_verificacion FROM usuarios
+        WHERE token_verificacion IS NOT NULL AND email_verificado = :falso
+    """), {"falso": False}).all()
+    if pendientes:
+        # SHA-256 en Python (SQLite no lo ofrece en SQL); mismo formato que auth.hash_token
+        conn.execute(
+            text("UPDATE usuarios SET token_verificacion_hash = :hash WHERE id = :id"),
+            [{"id": id_, "hash": hashlib.sha256(token.encode("utf-8")).hexdigest()} for id_, token in pendientes]
+        )
+        print(f"  ~ usuarios: {len(pendientes)} token(s) de verificación hasheado(s)")
+    conn.execute(text("UPDATE usuarios SET token_verificacion = NULL WHERE token_verificacion IS NOT NULL"))
+
+
+def convertir_json_a_jsonb(conn):
+    """En PostgreSQL, migrar columnas JSON existentes a JSONB"""
+    if conn.dialect.name != "postgresql":
+        return
+    columnas = [
+        ("pedidos", "items_json"),
+        ("pdf_exports", "metadata_json"),
+        ("campanias_segmentadas", "criterios_json"),
+    ]
+    for tabla, columna in columnas:
+        tipo = conn.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name = :tabla AND column_name = :columna"
+        ), {"tabla": tabla, "columna": columna}).scalar()
+        if tipo == "json":
+            conn.execute(text(
+                f"ALTER TABLE {tabla} ALTER COLUMN {columna} TYPE jsonb USING {columna}::jsonb"
+            ))
+            print(f"  ~ {tabla}.{columna} -> jsonb")
+
+
+def tamanios_nombre_unico(conn):
+    """
+    create_all no agrega la restricción UNIQUE de tamanios.nombre a tablas
+    ya existentes: renombrar duplicados y crear el índice único
+    """
+    inspector = inspect(conn)
+    unicos = [uc["column_names"] for uc in inspector.get_unique_constraints("tamanios")]
+    unicos += [ix["column_names"] for ix in inspector.get_indexes("tamanios") if ix["unique"]]
+    if ["nombre"] in unicos:
+        return
+    # Se conserva el tamaño más antiguo; los demás quedan como "Nombre (id)".
+    # No se eliminan porque carrito_items referencia tamanio_id.
+    renombrados = conn.execute(text("""
+        UPDATE tamanios
+        SET nombre = SUBSTR(nombre, 1, 40) || ' (' || CAST(id AS VARCHAR(10)) || ')'
+        WHERE id NOT IN (SELECT MIN(id) FROM tamanios GROUP BY nombre)
+    """)).rowcount
+    if renombrados:
+        print(f"  ~ tamanios: {renombrados} nombre(s) duplicado(s) renombrado(s)")
+    conn.execute(text("CREATE UNIQUE INDEX uq_tamanios_nombre ON tamanios (nombre)"))
+    print("  + tamanios.nombre UNIQUE")
+
+
+def crear_indices_faltantes(conn):
+    """create_all no agrega índices nuevos a tablas ya existentes"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
 
 async def main():
     print("Actualizando esquema de base de datos...")
     await init_db()
+    async with engine.begin() as conn:
+        await conn.run_sync(agregar_columnas_faltantes)
+        await conn.run_sync(convertir_json_a_jsonb)
+        await conn.run_sync(tamanios_nombre_unico)
+        await conn.run_sync(crear_indices_faltantes)
+        await conn.run_sync(completar_datos)
+        await conn.run_sync(hashear_tokens_verificacion)
     print("Base de datos actualizada correctamente.")
 
 if __name__ == "__main__":
@@ -34,31 +34,38 @@ async def reset_menu():
             # 1. Limpiar tablas relacionadas con productos
             print("Eliminando datos existentes...")
             
-            # Eliminar items de carrito primero (por FK)
-            await db.execute(delete(CarritoItem))
-            
-            # Eliminar rankings
-            await db.execute(delete(RankingProducto))
-            
-            # Eliminar productos
-            await db.execute(delete(Producto))
-            
-            # Eliminar categorías, tamaños y extras
-            await db.execute(delete(Categoria))
-            await db.execute(delete(Tamanio))
-            await db.execute(delete(Extra))
-            
-            # Reiniciar secuencias de IDs (opcional pero recomendado para limpieza total)
-            # Nota: Esto es específico de PostgreSQL, pero lo dejamos por si acaso se cambia de motor
-            # En SQLite no falla, pero tampoco hace nada con esta sintaxis específica usualmente.
-            # Para SQLite, el autoincrement se resetea si borras la tabla sqlite_sequence, pero delete() no lo hace.
-            try:
-                await db.execute(text("DELETE FROM sqlite_sequence WHERE name='productos'"))
-                await db.execute(text("DELETE FROM sqlite_sequence WHERE name='categorias'"))
-                await db.execute(text("DELETE FROM sqlite_sequence WHERE name='tamanios'"))
-                await db.execute(text("DELETE FROM sqlite_sequence WHERE name='extras'"))
-            except Exception as e:
-                print(f"Nota: No se pudieron reiniciar secuencias (posiblemente no es SQLite): {e}")
+            connection = await db.connection()
+            if connection.dialect.name == "postgresql":
+                # Una sola sentencia: vacía las tablas y reinicia las secuencias de IDs
+                await db.execute(text(
+                    "TRUNCATE carrito_items, carrito_item_extras, ranking_productos, "
+                    "producto_extras, productos, categorias, tamanios, extras "
+                    "RESTART IDENTITY CASCADE"
+                ))
+            else:
+                # Eliminar items de carrito primero (por FK)
+                await db.execute(delete(CarritoItem))
+                
+                # Eliminar rankings
+                await db.execute(delete(RankingProducto))
+                
+                # Eliminar productos
+                await db.execute(delete(Producto))
+                
+                # Eliminar categorías, tamaños y extras
+                await db.execute(delete(Categoria))
+                await db.execute(delete(Tamanio))
+                await db.execute(delete(Extra))
+                
+                # Reiniciar los autoincrement de SQLite en una sola sentencia
+                # (sqlite_sequence solo existe si alguna tabla usa AUTOINCREMENT)
+                try:
+                    await db.execute(text(
+                        "DELETE FROM sqlite_sequence "
+                        "WHERE name IN ('productos', 'categorias', 'tamanios', 'extras')"
+                    ))
+                except Exception as e:
+                    print(f"Nota: No se pudieron reiniciar secuencias: {e}")
 
             print("Datos eliminados correctamente.")
             
@@ -67,28 +74,23 @@ async def reset_menu():
             cat_pizzas = Categoria(nombre="Pizzas", descripcion="Nuestras deliciosas pizzas artesanales", activo=True)
             cat_liquidos = Categoria(nombre="Líquidos", descripcion="Bebidas, jugos y refrescos", activo=True)
             
-            db.add(cat_pizzas)
-            db.add(cat_liquidos)
-            
             # 3. Crear Tamaños Estándar
             print("Creando tamaños...")
             t_personal = Tamanio(nombre="Personal", precio_adicional=0, activo=True)
             t_mediana = Tamanio(nombre="Mediana", precio_adicional=2000, activo=True)
             t_familiar = Tamanio(nombre="Familiar", precio_adicional=4000, activo=True)
             
-            db.add(t_personal)
-            db.add(t_mediana)
-            db.add(t_familiar)
-            
             # 4. Crear Extras Básicos (para que no quede vacío)
             print("Creando extras básicos...")
             e_queso = Extra(nombre="Queso Extra", precio=1000, disponible=True, activo=True)
             e_peperoni = Extra(nombre="Peperoni", precio=1000, disponible=True, activo=True)
             e_champi = Extra(nombre="Champiñones", precio=800, disponible=True, activo=True)
             
-            db.add(e_queso)
-            db.add(e_peperoni)
-            db.add(e_champi)
+            db.add_all([
+                cat_pizzas, cat_liquidos,
+                t_personal, t_mediana, t_familiar,
+                e_queso, e_peperoni, e_champi,
+            ])
             
             await db.commit()
             print("¡Menú reiniciado exitosamente!")
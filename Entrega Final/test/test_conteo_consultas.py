@@ -0,0 +1,149 @@
+"""
+Tests de conteo de consultas SQL por endpoint (detección de N+1)
+
+Usan una base SQLite en memoria y el contador de database.py
+(iniciar_conteo_consultas), el mismo que expone X-Query-Count en DEBUG.
+
+Ejecutar desde "Entrega Final":
+    python -m unittest discover -s test -p "test_*.py"
+"""
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+# Configurar path: módulos de la API
+current_dir = os.path.dirname(os.path.abspath(__file__))
+api_dir = os.path.join(os.path.dirname(current_dir), 'api')
+sys.path.append(api_dir)
+
+# Base en memoria: debe fijarse antes de importar config/database
+os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///:memory:"
+os.environ.setdefault("SECRET_KEY", "clave-de-tests")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("ALLOWED_ORIGINS", "http://localhost")
+
+from fastapi import BackgroundTasks
+from starlette.requests import Request
+from sqlalchemy import insert
+
+from database import AsyncSessionLocal, init_db, iniciar_conteo_consultas
+from models import Categoria, Extra, Pedido, Producto, Usuario, producto_extras
+from routers import productos, reportes
+
+# Pedido de hace HACE_DIAS días: fuera del ranking por defecto (RANKING_DIAS),
+# dentro del rango explícito de los tests
+HACE_DIAS = 60
+
+
+def _request() -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": []})
+
+
+class ConteoConsultasTest(unittest.IsolatedAsyncioTestCase):
+    """Cantidad exacta de consultas por llamada a cada endpoint"""
+    
+    datos_creados = False
+    
+    async def asyncSetUp(self):
+        if not ConteoConsultasTest.datos_creados:
+            await init_db()
+            await self._crear_datos()
+            ConteoConsultasTest.datos_creados = True
+        
+        productos.invalidar_menu()
+        reportes._ranking_calculado_en = None
+        self.db = AsyncSessionLocal()
+    
+    async def asyncTearDown(self):
+        await self.db.close()
+    
+    async def _crear_datos(self):
+        async with AsyncSessionLocal() as db:
+            usuario = Usuario(email="cliente@test.cl", nombre="Cliente", hashed_password="x")
+            categoria = Categoria(nombre="Pizzas")
+            db.add_all([usuario, categoria])
+            await db.flush()
+            
+            pizza = Producto(nombre="Napolitana", precio=Decimal("8990"), categoria_id=categoria.id)
+            queso = Extra(nombre="Queso Extra", precio=Decimal("1000"))
+            peperoni = Extra(nombre="Peperoni", precio=Decimal("1000"))
+            db.add_all([pizza, queso, peperoni])
+            await db.flush()
+            
+            await db.execute(insert(producto_extras).values(producto_id=pizza.id, extra_id=queso.id))
+            db.add(Pedido(
+                user_id=usuario.id,
+                fecha=datetime.utcnow() - timedelta(days=HACE_DIAS),
+                estado="entregado",
+                subtotal=Decimal("17980"),
+                total=Decimal("17980"),
+                direccion="Av. Siempre Viva 123",
+                telefono="+56900000000",
+                items_json={"items": [
+                    {"producto_id": pizza.id, "nombre": pizza.nombre, "cantidad": 2, "precio_unitario": 8990}
+                ]}
+            ))
+            await db.commit()
+    
+    async def test_get_extras(self):
+        """Extras con sus productos: SELECT + selectinload; el segundo pedido sale del cache"""
+        contador = iniciar_conteo_consultas()
+        await productos.get_extras(request=_request(), db=self.db)
+        self.assertEqual(contador[0], 2)
+        
+        contador = iniciar_conteo_consultas()
+        await productos.get_extras(request=_request(), db=self.db)
+        self.assertEqual(contador[0], 0)
+    
+    async def test_ranking_con_fechas(self):
+        """Agregación en SQL + una consulta de productos, sin una por producto"""
+        fecha_fin = datetime.utcnow()
+        contador = iniciar_conteo_consultas()
+        ranking = await reportes.get_ranking_productos(
+            background_tasks=BackgroundTasks(),
+            fecha_inicio=fecha_fin - timedelta(days=HACE_DIAS + 1),
+            fecha_fin=fecha_fin,
+            top_n=10,
+            current_user=None,
+            db=self.db
+        )
+        self.assertEqual(contador[0], 2)
+        self.assertEqual(len(ranking), 1)
+        self.assertEqual(ranking[0].cantidad_vendida, 2)
+    
+    async def test_ranking_precalculado_vacio(self):
+        """Sin ventas en el período la foto queda vacía y no se recalcula en cada request"""
+        background_tasks = BackgroundTasks()
+        contador = iniciar_conteo_consultas()
+        ranking = await reportes.get_ranking_productos(
+            background_tasks=background_tasks,
+            fecha_inicio=None,
+            fecha_fin=None,
+            top_n=10,
+            current_user=None,
+            db=self.db
+        )
+        # Lectura de la foto + recálculo en línea (agregación, productos
+        # existentes, DELETE) + relectura
+        self.assertEqual(contador[0], 5)
+        self.assertEqual(ranking, [])
+        
+        contador = iniciar_conteo_consultas()
+        ranking = await reportes.get_ranking_productos(
+            background_tasks=background_tasks,
+            fecha_inicio=None,
+            fecha_fin=None,
+            top_n=10,
+            current_user=None,
+            db=self.db
+        )
+        self.assertEqual(contador[0], 1)
+        self.assertEqual(ranking, [])
+        self.assertEqual(background_tasks.tasks, [])
+
+
+if __name__ == "__main__":
+    unittest.main()